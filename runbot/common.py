@@ -5,11 +5,14 @@ import itertools
 import logging
 import psycopg2
 import re
+import shutil
 import socket
 import time
 import os
+import uuid
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 
 from babel.dates import format_timedelta
@@ -21,6 +24,9 @@ _logger = logging.getLogger(__name__)
 
 dest_reg = re.compile(r'^\d{5,}-.+$')
 
+_gc_executor = None
+_gc_futures = set()
+
 
 class RunbotException(Exception):
     pass
@@ -149,3 +155,36 @@ def pseudo_markdown(text):
 
     text = re.sub(r'<code>(\d+)</code>', code_replace, text, flags=re.DOTALL)
     return text
+
+
+def gc_submit(func, *args, **kwargs):
+    """Run a cleaning function in the background gc thread"""
+    global _gc_executor
+    if _gc_executor is None:
+        _gc_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='runbot-gc')
+    future = _gc_executor.submit(func, *args, **kwargs)
+    _gc_futures.add(future)
+    future.add_done_callback(_gc_futures.discard)
+    return future
+
+
+def gc_pending():
+    """Return the number of cleaning operations not done yet"""
+    return len(_gc_futures)
+
+
+def rmtree_background(path, trash_dir):
+    """
+    Remove a directory in the background gc thread.
+    The directory is first renamed in trash_dir so that path can be reused immediately.
+    """
+    trash_path = os.path.join(trash_dir, f'{os.path.basename(path.rstrip(os.sep))}-{uuid.uuid4().hex[:8]}')
+    try:
+        os.makedirs(trash_dir, exist_ok=True)
+        os.rename(path, trash_path)
+    except FileNotFoundError:
+        return None
+    except OSError:
+        # trash_dir is not on the same filesystem, remove it in place
+        trash_path = path
+    return gc_submit(shutil.rmtree, trash_path, ignore_errors=True)
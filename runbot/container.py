@@ -15,6 +15,8 @@ import logging
 import os
 import re
 import subprocess
+import threading
+import time
 
 
 _logger = logging.getLogger(__name__)
@@ -95,24 +97,41 @@ class Command():
         return res.read()
 
 
-def docker_build(build_dir, image_tag):
-    return _docker_build(build_dir, image_tag)
+def docker_build(build_dir, image_tag, labels=None):
+    return _docker_build(build_dir, image_tag, labels=labels)
 
 
-def _docker_build(build_dir, image_tag):
+def _docker_build(build_dir, image_tag, labels=None):
     """Build the docker image
     :param build_dir: the build directory that contains Dockerfile.
     :param image_tag: name used to tag the resulting docker image
+    :param labels: dict of labels to add to the resulting docker image
     """
     # synchronise the current user with the odoo user inside the Dockerfile
     with open(os.path.join(build_dir, 'Dockerfile'), 'a') as df:
         df.write(DOCKERUSER)
     log_path = os.path.join(build_dir, 'docker_build.txt')
     logs = open(log_path, 'w')
-    dbuild = subprocess.Popen(['docker', 'build', '--tag', image_tag, '.'], stdout=logs, stderr=logs, cwd=build_dir)
+    label_args = [arg for key, value in (labels or {}).items() for arg in ('--label', f'{key}={value}')]
+    dbuild = subprocess.Popen(['docker', 'build', '--tag', image_tag, *label_args, '.'], stdout=logs, stderr=logs, cwd=build_dir)
     return dbuild.wait()
 
 
+def docker_image_label(image_tag, label):
+    return _docker_image_label(image_tag, label)
+
+
+def _docker_image_label(image_tag, label):
+    """Return the value of a label of a local docker image, None if the image does not exist"""
+    dinspect = subprocess.run(
+        ['docker', 'image', 'inspect', '--format', '{{ index .Config.Labels "%s" }}' % label, image_tag],
+        stderr=subprocess.DEVNULL, stdout=subprocess.PIPE, universal_newlines=True
+    )
+    if dinspect.returncode != 0:
+        return None
+    return dinspect.stdout.strip()
+
+
 def docker_run(*args, **kwargs):
     return _docker_run(*args, **kwargs)
 
@@ -210,6 +229,84 @@ def docker_is_running(container_name):
     return dinspect.returncode == 0
 
 
+class ContainerWatcher():
+
+    def __init__(self):
+        """ Keeps an in-memory table of running containers, fed by a long-lived
+        `docker events` listener, so that container states can be read without
+        spawning a `docker inspect` process per build.
+        """
+        self.running = set()
+        self.changed = threading.Event()
+        self._lock = threading.Lock()
+        self._process = None
+        self._thread = None
+
+    def start(self):
+        if self.is_alive():
+            return
+        # the listener replays the events since a time taken before reading the running
+        # containers, the events happening while docker events subscribes cannot be missed
+        since = time.time() - 1
+        running = set(docker_ps())
+        try:
+            self._process = subprocess.Popen(
+                ['docker', 'events', '--since', f'{since:.3f}', '--filter', 'type=container', '--filter', 'event=start', '--filter', 'event=die', '--format', '{{.Action}} {{.Actor.Attributes.name}}'],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                universal_newlines=True,
+            )
+        except FileNotFoundError:
+            _logger.warning('Docker not found, container watcher not started.')
+            return
+        with self._lock:
+            self.running = running
+        self._thread = threading.Thread(target=self._listen, name='container-watcher', daemon=True)
+        self._thread.start()
+        _logger.info('Container watcher started with %s running containers', len(running))
+
+    def stop(self):
+        if self._process:
+            self._process.terminate()
+        if self._thread:
+            self._thread.join()
+
+    def is_alive(self):
+        return bool(self._thread and self._thread.is_alive())
+
+    def _listen(self):
+        for line in self._process.stdout:
+            self._process_event(line)
+        _logger.warning('Container watcher stopped')
+
+    def _process_event(self, line):
+        action, _, container_name = line.strip().partition(' ')
+        with self._lock:
+            if action == 'start':
+                self.running.add(container_name)
+            elif action == 'die':
+                self.running.discard(container_name)
+        self.changed.set()
+
+    def is_running(self, container_name):
+        """Return None if the watcher is not listening, True if the container is known as running"""
+        if not self.is_alive():
+            return None
+        with self._lock:
+            return container_name in self.running
+
+    def clear(self):
+        """Forget the changes notified so far, to call before reading the containers states"""
+        self.changed.clear()
+
+    def wait(self, timeout):
+        """Wait for a container to start or stop since the last clear, return True if one did"""
+        return self.changed.wait(timeout)
+
+
+container_watcher = ContainerWatcher()
+
+
 def docker_state(container_name, build_dir):
     container_name = sanitize_container_name(container_name)
     exist = os.path.exists(os.path.join(build_dir, f'exist-{container_name}'))
@@ -223,7 +320,12 @@ def docker_state(container_name, build_dir):
         return 'END'
 
     if started:
-        return 'RUNNING' if docker_is_running(container_name) else 'GHOST'
+        running = container_watcher.is_running(container_name)
+        if running is None:
+            # the watcher is not listening, inspect the container
+            running = docker_is_running(container_name)
+        # a start event not processed yet gives a GHOST state for a few seconds, handled like a slow start by the scheduler
+        return 'RUNNING' if running else 'GHOST'
     return 'UNKNOWN'
 
 
@@ -417,6 +417,14 @@ class Runbot(Controller):
         }
         return request.render(view_id if view_id else "runbot.monitoring", qctx)
 
+    @o_route(['/runbot/metrics'], type='http', auth='public', sitemap=False)
+    def metrics(self, token=None, **kwargs):
+        expected_token = request.env['ir.config_parameter'].sudo().get_param('runbot.runbot_metrics_token')
+        if expected_token and token != expected_token:
+            raise Forbidden()
+        content = request.env['runbot.runbot'].sudo()._get_metrics()
+        return Response(content, content_type='text/plain; version=0.0.4; charset=utf-8')
+
     @route(['/runbot/errors',
             '/runbot/errors/page/<int:page>'
             ], type='http', auth='user', website=True, sitemap=False)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Long lived git processes
+
+Spawning a git process for each object lookup is slow on big repositories, a
+`git cat-file --batch-check` process is kept alive for each repository and reused
+to check the existence of many objects. Git reloads its pack list when an object is
+not found, meaning that objects fetched after the start of the process are found too.
+Objects are queried one at a time so that neither git nor runbot can block on a full
+pipe, a process not answering in time is killed and restarted at next query.
+
+The results of the commit comparisons, that only depend on the two compared shas,
+are memoised in a bounded cache shared by the process.
+"""
+import logging
+import os
+import select
+import subprocess
+import threading
+import time
+
+from collections import OrderedDict
+
+_logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_batch_check_processes = {}  # repo path: BatchCheck
+_compare_cache = OrderedDict()  # (repo path, sha, base sha): comparison values
+COMPARE_CACHE_SIZE = 10000
+BATCH_CHECK_TIMEOUT = 10  # seconds
+
+
+class BatchCheck():
+
+    def __init__(self, path):
+        self.path = path
+        self.process = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        self.process = subprocess.Popen(
+            ['git', '-C', self.path, 'cat-file', '--batch-check'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            bufsize=0,
+        )
+
+    def close(self):
+        if self.process:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+            except Exception:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
+    def kill(self):
+        if self.process:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def _readline(self, timeout):
+        """ Read one line of the process output, raise TimeoutError if it is not complete after timeout seconds """
+        deadline = time.time() + timeout
+        stdout = self.process.stdout
+        line = b''
+        while not line.endswith(b'\n'):
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([stdout], [], [], remaining)[0]:
+                raise TimeoutError(f'git cat-file did not answer in {timeout}s in {self.path}')
+            # only one object is queried at a time, the output never contains more than this line
+            chunk = os.read(stdout.fileno(), 4096)
+            if not chunk:
+                raise BrokenPipeError(f'git cat-file stopped in {self.path}')
+            line += chunk
+        return line.decode()
+
+    def _query(self, object_names):
+        if not self.process or self.process.poll() is not None:
+            self._start()
+        lines = []
+        try:
+            for name in object_names:
+                self.process.stdin.write(f'{name}\n'.encode())
+                lines.append(self._readline(BATCH_CHECK_TIMEOUT))
+        except TimeoutError:
+            # the process is stuck, a new one is started at next query
+            _logger.warning('Killing git cat-file process for %s', self.path)
+            self.kill()
+            raise
+        return lines
+
+    def exist(self, object_names):
+        """ Return the subset of object_names existing in the repository """
+        object_names = [name for name in object_names if name and not any(c.isspace() for c in name)]
+        if not object_names:
+            return set()
+        with self.lock:
+            try:
+                lines = self._query(object_names)
+            except TimeoutError:
+                # not retried, the caller falls back on another method
+                raise
+            except (BrokenPipeError, OSError):
+                # the process died (repo removed, git gc, ...), give it a second chance
+                _logger.warning('Restarting git cat-file process for %s', self.path)
+                self.close()
+                lines = self._query(object_names)
+        return {name for name, line in zip(object_names, lines) if not line.rstrip('\n').endswith(' missing')}
+
+
+def batch_check(path):
+    """ Return the BatchCheck of the repository in path, started at first query """
+    with _lock:
+        if path not in _batch_check_processes:
+            _batch_check_processes[path] = BatchCheck(path)
+        return _batch_check_processes[path]
+
+
+def close_batch_check(path):
+    with _lock:
+        process = _batch_check_processes.pop(path, None)
+    if process:
+        process.close()
+
+
+def get_comparison(path, sha, base_sha):
+    with _lock:
+        values = _compare_cache.get((path, sha, base_sha))
+        if values is not None:
+            _compare_cache.move_to_end((path, sha, base_sha))
+        return values
+
+
+def set_comparison(path, sha, base_sha, values):
+    with _lock:
+        _compare_cache[(path, sha, base_sha)] = values
+        while len(_compare_cache) > COMPARE_CACHE_SIZE:
+            _compare_cache.popitem(last=False)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""Metrics of the runbot processes
+
+Values are recorded in memory by the leader and builder loops, recording only
+updates a dict under a lock. Each process periodically saves its values on its
+host (see runbot.host._save_metrics) so that the web server can expose the
+metrics of all processes on /runbot/metrics, in the Prometheus text format.
+
+Counters and summaries are cumulative since the start of the process.
+"""
+import re
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_summaries = defaultdict(lambda: [0, 0.0])
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Increment the counter name, by convention ending with _total"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] += value
+
+
+def observe(name, value, **labels):
+    """Add a value, usually a duration in seconds, to the summary name"""
+    key = _key(name, labels)
+    with _lock:
+        summary = _summaries[key]
+        summary[0] += 1
+        summary[1] += value
+
+
+@contextmanager
+def timed(name, **labels):
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start, **labels)
+
+
+def snapshot():
+    """Return the recorded values as a json serializable list of [name, type, labels, value]"""
+    with _lock:
+        samples = [[name, 'counter', dict(labels), value] for (name, labels), value in _counters.items()]
+        samples += [[name, 'summary', dict(labels), list(summary)] for (name, labels), summary in _summaries.items()]
+    return samples
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _summaries.clear()
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in sorted(labels.items())
+    )
+    return '{%s}' % ','.join(f'{re.sub(r"[^a-zA-Z0-9_]", "_", key)}="{value}"' for key, value in escaped)
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(samples):
+    """Return samples [name, type, labels, value] in the Prometheus text exposition format"""
+    families = defaultdict(list)
+    types = {}
+    for name, metric_type, labels, value in samples:
+        types.setdefault(name, metric_type)
+        families[name].append((labels, value))
+    lines = []
+    for name in sorted(families):
+        metric_type = types[name]
+        lines.append(f'# TYPE {name} {metric_type}')
+        for labels, value in families[name]:
+            if metric_type == 'summary':
+                count, total = value
+                lines.append(f'{name}_count{_format_labels(labels)} {count}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(total)}')
+            else:
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
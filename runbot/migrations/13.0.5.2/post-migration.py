@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+
+from odoo.api import Environment
+from odoo import SUPERUSER_ID
+
+
+def migrate(cr, _version):
+    env = Environment(cr, SUPERUSER_ID, {})
+    pending_builds = env['runbot.build'].search([('local_state', '=', 'pending')])
+    for fname in ('queue_priority', 'estimated_duration'):
+        env.add_to_compute(pending_builds._fields[fname], pending_builds)
+    pending_builds.recompute(['queue_priority', 'estimated_duration'])
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+
+def migrate(cr, _version):
+    # avoid computing the queue fields and the estimated duration of all existing builds, only pending ones are recomputed in post-migration
+    cr.execute('ALTER TABLE runbot_build ADD COLUMN IF NOT EXISTS estimated_duration INTEGER DEFAULT 0')
+    cr.execute('ALTER TABLE runbot_build ADD COLUMN IF NOT EXISTS queue_priority INTEGER DEFAULT 0')
+    cr.execute('ALTER TABLE runbot_build ADD COLUMN IF NOT EXISTS queue_bundle_id INTEGER')
+    cr.execute("""
+        UPDATE runbot_build build
+           SET queue_bundle_id = batch.bundle_id
+          FROM runbot_build_params params
+          JOIN runbot_batch batch ON batch.id = params.create_batch_id
+         WHERE params.id = build.params_id
+    """)
@@ -49,6 +49,25 @@ class Batch(models.Model):
     def get_formated_age(self):
         return s2human_long(self.age)
 
+    def _get_eta(self):
+        """Return the estimated time in seconds before all builds of the batch are done, 0 if unknown"""
+        self.ensure_one()
+        if self.state not in ('preparing', 'ready'):
+            return 0
+        builds = self.all_build_ids.filtered(lambda build: build.local_state in ('pending', 'testing'))
+        durations_cache = {}
+        remaining_durations = []
+        for build in builds:
+            key = (build.trigger_id.id, build.version_id.id)
+            if key not in durations_cache:
+                durations_cache[key] = self.env['runbot.build.duration']._get_durations(build.trigger_id, build.version_id)
+            remaining_durations.append(build._get_remaining_duration(durations_cache[key]))
+        return max(remaining_durations, default=0)
+
+    def get_formated_eta(self):
+        eta = self._get_eta()
+        return s2human_long(eta) if eta else False
+
     def _url(self):
         self.ensure_one()
         return f"/runbot/batch/{self.id}"
@@ -350,47 +369,21 @@ class Batch(models.Model):
                 self.warning('No base head found for repo %s', commit.repo_id.name)
                 continue
             link_commit.base_commit_id = base_head
-            merge_base_sha = False
             try:
                 link_commit.base_ahead = link_commit.base_behind = 0
                 link_commit.file_changed = link_commit.diff_add = link_commit.diff_remove = 0
                 link_commit.merge_base_commit_id = commit.id
                 if commit.name == base_head.name:
                     continue
-                merge_base_sha = commit.repo_id._git(['merge-base', commit.name, base_head.name]).strip()
-                merge_base_commit = self.env['runbot.commit']._get(merge_base_sha, commit.repo_id.id)
-                link_commit.merge_base_commit_id = merge_base_commit.id
-
-                ahead, behind = (
-                    commit.repo_id._git(
-                        [
-                            'rev-list',
-                            '--left-right',
-                            '--count',
-                            f'{commit.name}...{base_head.name}',
-                        ]
-                    )
-                    .strip()
-                    .split('\t')
-                )
-
-                link_commit.base_ahead = int(ahead)
-                link_commit.base_behind = int(behind)
-
-                if merge_base_sha == commit.name:
-                    continue
-
-                if diff := commit.repo_id._git(
-                    ['diff', '--numstat', merge_base_sha, commit.name]
-                ).strip():
-                    for line in diff.split('\n'):
-                        link_commit.file_changed += 1
-                        add, remove, _ = line.split(None, 2)
-                        try:
-                            link_commit.diff_add += int(add)
-                            link_commit.diff_remove += int(remove)
-                        except ValueError:  # binary files
-                            pass
+                comparison = commit.repo_id._compare_commits(commit.name, base_head.name)
+                link_commit.write({
+                    'merge_base_commit_id': self.env['runbot.commit']._get(comparison['merge_base'], commit.repo_id.id).id,
+                    'base_ahead': comparison['base_ahead'],
+                    'base_behind': comparison['base_behind'],
+                    'file_changed': comparison['file_changed'],
+                    'diff_add': comparison['diff_add'],
+                    'diff_remove': comparison['diff_remove'],
+                })
             except subprocess.CalledProcessError:
                 self.warning('Commit info failed between %s and %s', commit.name, base_head.name)
 
@@ -5,23 +5,28 @@ import pwd
 import re
 import shutil
 import subprocess
+import threading
 import time
 import datetime
 import hashlib
-from ..common import dt2time, fqdn, now, grep, local_pgadmin_cursor, s2human, dest_reg, os, list_local_dbs, pseudo_markdown, RunbotException
+from ..common import dt2time, fqdn, now, grep, local_pgadmin_cursor, s2human, dest_reg, os, list_local_dbs, pseudo_markdown, rmtree_background, RunbotException
 from ..container import docker_stop, docker_state, Command, docker_run
 from ..fields import JsonDictField
+from .. import metrics
 from odoo import models, fields, api
 from odoo.exceptions import UserError, ValidationError
 from odoo.http import request
 from odoo.tools import appdirs
 from odoo.tools.safe_eval import safe_eval
 from collections import defaultdict
+from contextlib import contextmanager
 from psycopg2 import sql
 from subprocess import CalledProcessError
 
 _logger = logging.getLogger(__name__)
 
+_log_buffer = threading.local()
+
 result_order = ['ok', 'warn', 'ko', 'skipped', 'killed', 'manually_killed']
 state_order = ['pending', 'testing', 'waiting', 'running', 'done']
 
@@ -33,6 +38,11 @@ COPY_WHITELIST = [
     "orphan_result",
 ]
 
+# queue priority bonus, added to the category build priority
+QUEUE_PRIORITY_BUILD_TYPE = {'rebuild': 20, 'normal': 10}
+QUEUE_PRIORITY_BUNDLE = 100
+QUEUE_PRIORITY_STICKY = 5
+
 
 def make_selection(array):
     return [(elem, elem.replace('_', ' ').capitalize()) if isinstance(elem, str) else elem for elem in array]
@@ -76,25 +86,25 @@ class BuildParameters(models.Model):
     # @api.depends('version_id', 'project_id', 'extra_params', 'config_id', 'config_data', 'modules', 'commit_link_ids', 'builds_reference_ids')
     def _compute_fingerprint(self):
         for param in self:
+            cleaned_vals = {
+                'version_id': param.version_id.id,
+                'project_id': param.project_id.id,
+                'trigger_id': param.trigger_id.id,
+                'extra_params': param.extra_params or '',
+                'config_id': param.config_id.id,
+                'config_data': param.config_data.dict,
+                'modules': param.modules or '',
+                'commit_link_ids': sorted(param.commit_link_ids.commit_id.ids),
+                'builds_reference_ids': sorted(param.builds_reference_ids.ids),
+                'upgrade_from_build_id': param.upgrade_from_build_id.id,
+                'upgrade_to_build_id': param.upgrade_to_build_id.id,
+                'dump_db': param.dump_db.id,
+                'dockerfile_id': param.dockerfile_id.id,
+                'skip_requirements': param.skip_requirements,
+            }
             if param.trigger_id.batch_dependent:
-                cleaned_vals = {
-                    'version_id': param.version_id.id,
-                    'project_id': param.project_id.id,
-                    'trigger_id': param.trigger_id.id,
-                    'extra_params': param.extra_params or '',
-                    'config_id': param.config_id.id,
-                    'config_data': param.config_data.dict,
-                    'modules': param.modules or '',
-                    'commit_link_ids': sorted(param.commit_link_ids.commit_id.ids),
-                    'builds_reference_ids': sorted(param.builds_reference_ids.ids),
-                    'upgrade_from_build_id': param.upgrade_from_build_id.id,
-                    'upgrade_to_build_id': param.upgrade_to_build_id.id,
-                    'dump_db': param.dump_db.id,
-                    'dockerfile_id': param.dockerfile_id.id,
-                    'skip_requirements': param.skip_requirements,
-                }
-                    cleaned_vals['create_batch_id'] = param.create_batch_id.id,
-                param.fingerprint = hashlib.sha256(str(cleaned_vals).encode('utf8')).hexdigest()
+                cleaned_vals['create_batch_id'] = param.create_batch_id.id,
+            param.fingerprint = hashlib.sha256(str(cleaned_vals).encode('utf8')).hexdigest()
 
     @api.depends('commit_link_ids')
     def _compute_commit_ids(self):
@@ -221,6 +231,24 @@ class BuildResult(models.Model):
 
     static_run = fields.Char('Static run URL')
 
+    # queue, used to allocate pending builds
+    queue_priority = fields.Integer('Queue priority', compute='_compute_queue_priority', store=True)
+    queue_bundle_id = fields.Many2one('runbot.bundle', 'Queue bundle', related='params_id.create_batch_id.bundle_id', store=True, index=True)
+    estimated_duration = fields.Integer('Estimated duration', compute='_compute_estimated_duration', store=True,
+                                        help='Sum of the estimated durations of the config steps, from previous builds')
+    overdue_step_id = fields.Many2one('runbot.build.config.step', 'Overdue step', help='Last step that exceeded its usual duration')
+
+    def init(self):
+        """ Partial indexes on the pending queue, only containing the builds waiting for a host """
+        self._cr.execute("""
+            CREATE INDEX IF NOT EXISTS runbot_build_queue_idx ON runbot_build (queue_priority DESC, parent_path)
+            WHERE local_state = 'pending' AND host IS NULL
+        """)
+        self._cr.execute("""
+            CREATE INDEX IF NOT EXISTS runbot_build_queue_age_idx ON runbot_build (create_date)
+            WHERE local_state = 'pending' AND host IS NULL
+        """)
+
     @api.depends('description', 'params_id.config_id')
     def _compute_display_name(self):
         for build in self:
@@ -258,6 +286,74 @@ class BuildResult(models.Model):
             ) + int(build.gc_delay if build.gc_delay else 0)
             build.gc_date = ref_date + datetime.timedelta(days=(max_days))
 
+    @api.depends(
+        'params_id',
+        'params_id.create_batch_id.bundle_id.priority',
+        'params_id.create_batch_id.bundle_id.sticky',
+        'params_id.create_batch_id.category_id.build_priority',
+        'build_type',
+        'parent_id.queue_priority',
+    )
+    def _compute_queue_priority(self):
+        for build in self:
+            if build.parent_id:
+                build.queue_priority = build.parent_id.queue_priority
+                continue
+            batch = build.params_id.create_batch_id
+            priority = batch.category_id.build_priority + QUEUE_PRIORITY_BUILD_TYPE.get(build.build_type, 0)
+            if batch.bundle_id.priority:
+                priority += QUEUE_PRIORITY_BUNDLE
+            if batch.bundle_id.sticky:
+                priority += QUEUE_PRIORITY_STICKY
+            build.queue_priority = priority
+
+    @api.depends('params_id')
+    def _compute_estimated_duration(self):
+        durations_cache = {}
+        for build in self:
+            params = build.params_id
+            key = (params.trigger_id.id, params.version_id.id)
+            if key not in durations_cache:
+                durations_cache[key] = self.env['runbot.build.duration']._get_durations(params.trigger_id, params.version_id)
+            durations = durations_cache[key]
+            build.estimated_duration = sum(durations[step.id].estimate for step in params.config_id.step_ids() if step.id in durations)
+
+    def _get_remaining_duration(self, durations=None):
+        """ Estimated time in seconds before the end of the build steps, 0 if unknown
+
+        durations can be given as returned by runbot.build.duration._get_durations for the
+        trigger and version of the build to avoid reading them for each build
+        """
+        self.ensure_one()
+        if self.local_state == 'pending':
+            return self.estimated_duration
+        if self.local_state != 'testing' or not self.active_step:
+            return 0
+        step_ids = self.params_id.config_id.step_ids()
+        if self.active_step not in step_ids:
+            return 0
+        if durations is None:
+            durations = self.env['runbot.build.duration']._get_durations(self.params_id.trigger_id, self.params_id.version_id)
+        remaining = sum(durations[step.id].estimate for step in step_ids[step_ids.index(self.active_step):] if step.id in durations)
+        active_estimate = durations[self.active_step.id].estimate if self.active_step.id in durations else 0
+        return remaining - min(self.job_time, active_estimate)
+
+    def _check_overdue(self):
+        """ Warn once per step when a step takes longer than the 95th percentile of its previous durations """
+        min_samples = int(self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_duration_min_samples', default=5))
+        for build in self:
+            if build.local_state != 'testing' or not build.active_step or build.overdue_step_id == build.active_step:
+                continue
+            params = build.params_id
+            duration = self.env['runbot.build.duration']._get_durations(params.trigger_id, params.version_id, build.active_step).get(build.active_step.id)
+            if duration and duration.count >= min_samples and build.job_time > duration.p95:
+                build._log(
+                    '_schedule',
+                    f'Step {build.active_step.name} is taking longer than usual ({s2human(build.job_time)}, 95% of the last {duration.count} runs took less than {s2human(duration.p95)})',
+                    level='WARNING',
+                )
+                build.overdue_step_id = build.active_step
+
     @api.depends('description')
     def _compute_md_description(self):
         for build in self:
@@ -339,6 +435,8 @@ class BuildResult(models.Model):
                 else:
                     raise ValidationError('Local result cannot be set to a less critical level')
         res = super(BuildResult, self).write(values)
+        if values.get('local_state') == 'done':
+            self.env['runbot.host']._release_ports(self)
         if 'log_counter' in values:  # not 100% usefull but more correct ( see test_ir_logging)
             self.flush()
         return res
@@ -551,16 +649,17 @@ class BuildResult(models.Model):
         else:
             dests = _filter(dest_list=os.listdir(builds_dir), label='workspace')
 
+        trash_dir = os.path.join(root, 'trash')
         for dest, full in dests:
             build_dir = os.path.join(builds_dir, dest)
             if full:
                 _logger.info('Removing build dir "%s"', dest)
-                shutil.rmtree(build_dir, ignore_errors=True)
+                rmtree_background(build_dir, trash_dir)
                 continue
             for f in os.listdir(build_dir):
                 path = os.path.join(build_dir, f)
                 if os.path.isdir(path) and f not in ('logs', 'tests'):
-                    shutil.rmtree(path)
+                    rmtree_background(path, trash_dir)
                 elif f == 'logs':
                     log_path = os.path.join(build_dir, 'logs')
                     for f in os.listdir(log_path):
@@ -571,18 +670,9 @@ class BuildResult(models.Model):
                             os.unlink(log_file_path)
 
     def _find_port(self):
-        # currently used port
-        ids = self.search([('local_state', 'not in', ['pending', 'done']), ('host', '=', fqdn())])
-        ports = {i['port'] for i in ids.read(['port'])}
-
-        # starting port
-        icp = self.env['ir.config_parameter']
-        port = int(icp.get_param('runbot.runbot_starting_port', default=2000))
-
-        # find next free port
-        while port in ports:
-            port += 3
-        return port
+        """ Reserve a port on the current host, released when the build is done """
+        self.ensure_one()
+        return self.env['runbot.host']._get_current()._allocate_port(self)
 
     def _logger(self, *l):
         l = list(l)
@@ -602,7 +692,7 @@ class BuildResult(models.Model):
                 raise UserError(f"Build {build.id} does not have correct host")
             # allocate port and schedule first job
             values = {
-                'port': self._find_port(),
+                'port': build._find_port(),
                 'job_start': now(),
                 'build_start': now(),
                 'job_end': False,
@@ -646,7 +736,7 @@ class BuildResult(models.Model):
                     try:
                         log_path = build._path('logs', 'wake_up.txt')
 
-                        port = self._find_port()
+                        port = build._find_port()
                         build.write({
                             'job_start': now(),
                             'job_end': False,
@@ -696,6 +786,8 @@ class BuildResult(models.Model):
                         f'{build.active_step.name if build.active_step else "?"} time exceeded ({build.job_time}s)',
                     )
                     build._kill(result='killed')
+                elif build.local_state == 'testing' and icp.get_param('runbot.runbot_duration_warning'):
+                    build._check_overdue()
                 continue
             elif _docker_state in ('UNKNOWN', 'GHOST') and (build.local_state == 'running' or build.active_step._is_docker_step()):  # todo replace with docker_start
                 docker_time = time.time() - dt2time(build.docker_start or build.job_start)
@@ -735,6 +827,8 @@ class BuildResult(models.Model):
             build.active_step._make_stats(build)
 
             build.active_step.log_end(build)
+            if build.active_step._is_docker_step() and build_values.get('local_result', build.local_result) in (False, 'ok', 'warn'):
+                self.env['runbot.build.duration']._add_sample(build, build.active_step, build.job_time)
 
             build_values |= build._next_job_values()
 
@@ -780,6 +874,7 @@ class BuildResult(models.Model):
         self.docker_start = now()
         if self.job_start:
             start_step_time = int(dt2time(self.docker_start) - dt2time(self.job_start))
+            metrics.observe('runbot_docker_start_seconds', start_step_time)
             if start_step_time > 60:
                 _logger.info('Step took %s seconds before starting docker', start_step_time)
         docker_run(**kwargs)
@@ -822,6 +917,7 @@ class BuildResult(models.Model):
             exports[build_export_path] = commit.export()
 
         checkout_time = time.time() - start
+        metrics.observe('runbot_checkout_seconds', checkout_time)
         if checkout_time > 60:
             self._log('checkout', f'Checkout took {int(checkout_time)} seconds')
 
@@ -884,9 +980,9 @@ class BuildResult(models.Model):
         _logger.info(' '.join(cmd))
         subprocess.call(cmd)
 
-    def _local_pg_createdb(self, dbname):
+    def _local_pg_createdb(self, dbname, db_template=None):
         icp = self.env['ir.config_parameter']
-        db_template = icp.get_param('runbot.runbot_db_template', default='template0')
+        db_template = db_template or icp.get_param('runbot.runbot_db_template', default='template0')
         self._local_pg_dropdb(dbname)
         _logger.info("createdb %s", dbname)
         with local_pgadmin_cursor() as local_cr:
@@ -900,7 +996,7 @@ class BuildResult(models.Model):
 
         self.ensure_one()
         _logger.info("Build %s %s %s", self.id, func, message)
-        self.env['ir.logging'].create({
+        values = {
             'build_id': self.id,
             'level': level,
             'type': log_type,
@@ -909,7 +1005,27 @@ class BuildResult(models.Model):
             'path': path,
             'func': func,
             'line': '0',
-        })
+        }
+        if getattr(_log_buffer, 'logs', None) is not None:
+            _log_buffer.logs.append(values)
+        else:
+            self.env['ir.logging'].create(values)
+
+    @contextmanager
+    def _buffered_logs(self):
+        """ Buffer the _log calls made in the block and insert them in a single batch
+        when leaving it, if runbot.runbot_bulk_log is set. Logs are dropped on exception
+        since the transaction is expected to be rolled back.
+        """
+        if getattr(_log_buffer, 'logs', None) is not None or not self.env['ir.config_parameter'].get_param('runbot.runbot_bulk_log'):
+            yield
+            return
+        _log_buffer.logs = logs = []
+        try:
+            yield
+        finally:
+            _log_buffer.logs = None
+        self.env['ir.logging']._bulk_insert(logs)
 
     def _kill(self, result=None):
         host = fqdn()
@@ -1115,8 +1231,7 @@ class BuildResult(models.Model):
         BuildError = self.env['runbot.build.error']
         # only parse logs from builds in error and not already scanned
         builds_to_scan = self.search([('id', 'in', self.ids), ('local_result', '=', 'ko'), ('build_error_ids', '=', False)])
-        ir_logs = self.env['ir.logging'].search([('level', '=', 'ERROR'), ('type', '=', 'server'), ('build_id', 'in', builds_to_scan.ids)])
-        return BuildError._parse_logs(ir_logs)
+        return BuildError._parse_build_logs(builds_to_scan.ids)
 
     def is_file(self, file, mode='r'):
         file_path = self._path(file)
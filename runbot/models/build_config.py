@@ -1,11 +1,14 @@
 import base64
 import glob
+import hashlib
+import heapq
 import json
 import logging
 import fnmatch
 import re
 import shlex
 import time
+from collections import defaultdict
 from unidiff import PatchSet
 from ..common import now, grep, time2str, rfind, s2human, os, RunbotException
 from ..container import docker_get_gateway_ip, Command
@@ -18,8 +21,57 @@ _logger = logging.getLogger(__name__)
 _re_error = r'^(?:\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} \d+ (?:ERROR|CRITICAL) )|(?:Traceback \(most recent call last\):)$'
 _re_warning = r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} \d+ WARNING '
 
+_modules_loaded = '.modules.loading: Modules loaded.'
+_shutdown = 'Initiating shutdown'
+
 PYTHON_DEFAULT = "# type python code here\n\n\n\n\n\n"
 
+_last_log_analysis = None  # (key, LogAnalysis) of the last analysed log file
+
+
+class LogAnalysis():
+
+    chunk_size = 16 * 1024 * 1024
+
+    def __init__(self, log_path, strings=(), regexes=(), stat_regex_ids=None):
+        """ Read a log file once, by chunks of complete lines, looking for all strings,
+        regexes and stats regexes at the same time.
+        Patterns are matched per chunk, a pattern spanning on multiple lines may not be found
+        if the lines are in two different chunks.
+        """
+        self.exists = os.path.isfile(log_path)
+        self.strings = dict.fromkeys(strings, False)
+        self.regexes = {regex: False for regex in regexes}
+        self.stats = {}
+        if self.exists:
+            compiled = {regex: re.compile(regex, re.M) for regex in regexes}
+            with open(log_path, 'r') as log_file:
+                remaining = ''
+                while True:
+                    chunk = log_file.read(self.chunk_size)
+                    if not chunk:
+                        if remaining:
+                            self._analyse(remaining, compiled, stat_regex_ids)
+                        break
+                    chunk = remaining + chunk
+                    last_line_end = chunk.rfind('\n') + 1
+                    chunk, remaining = chunk[:last_line_end], chunk[last_line_end:]
+                    if chunk:
+                        self._analyse(chunk, compiled, stat_regex_ids)
+
+    def _analyse(self, chunk, compiled, stat_regex_ids):
+        for string, found in self.strings.items():
+            if not found and string in chunk:
+                self.strings[string] = True
+        for regex, found in self.regexes.items():
+            if not found and compiled[regex].search(chunk):
+                self.regexes[regex] = True
+        if stat_regex_ids:
+            stat_regex_ids._find_in_text(chunk, self.stats)
+
+    def found(self, pattern):
+        return self.strings.get(pattern) or self.regexes.get(pattern) or False
+
 
 class Config(models.Model):
     _name = 'runbot.build.config'
@@ -83,6 +135,8 @@ class Config(models.Model):
             if step.job_type == 'create_build':
                 for create_config in step.create_config_ids:
                     create_config._check_recustion(visited[:])
+            if step.job_type == 'shard_tests' and step.shard_config_id:
+                step.shard_config_id._check_recustion(visited[:])
 
 
 class ConfigStepUpgradeDb(models.Model):
@@ -111,7 +165,8 @@ class ConfigStep(models.Model):
         ('configure_upgrade', 'Configure Upgrade'),
         ('configure_upgrade_complement', 'Configure Upgrade Complement'),
         ('test_upgrade', 'Test Upgrade'),
-        ('restore', 'Restore')
+        ('restore', 'Restore'),
+        ('shard_tests', 'Shard tests'),
     ], default='install_odoo', required=True, tracking=True)
     protected = fields.Boolean('Protected', default=False, tracking=True)
     default_sequence = fields.Integer('Sequence', default=100, tracking=True)  # or run after? # or in many2many rel?
@@ -122,6 +177,10 @@ class ConfigStep(models.Model):
     build_stat_regex_ids = fields.Many2many('runbot.build.stat.regex', string='Stats Regexes')
     # install_odoo
     create_db = fields.Boolean('Create Db', default=True, tracking=True)  # future
+    db_template_cache = fields.Boolean('Use db template cache', default=False, tracking=True,
+        help="Create the database from a template with the template modules already installed, shared by builds with the same commits on the host")
+    db_template_modules = fields.Char('Template modules', default='base', tracking=True,
+        help="Comma separated list of modules installed in the template, their install tests are not run")
     custom_db_name = fields.Char('Custom Db Name', tracking=True)  # future
     install_modules = fields.Char('Modules to install', help="List of module patterns to install, use * to install all available modules, prefix the pattern with dash to remove the module.", default='')
     db_name = fields.Char('Db Name', compute='_compute_db_name', inverse='_inverse_db_name', tracking=True)
@@ -135,6 +194,9 @@ class ConfigStep(models.Model):
     sub_command = fields.Char('Subcommand', tracking=True)
     extra_params = fields.Char('Extra cmd args', tracking=True)
     additionnal_env = fields.Char('Extra env', help='Example: foo="bar",bar="foo". Cannot contains \' ', tracking=True)
+    dump_format = fields.Selection([('zip', 'Zip (plain sql)'), ('directory', 'Directory (tar.zst)')], default='zip', string='Dump format', tracking=True,
+        help="Directory dumps are made and restored in parallel, the archive is compressed with multi-threaded zstd")
+    dump_jobs = fields.Integer('Dump/restore jobs', default=4, tracking=True, help="Number of parallel jobs used by pg_dump and pg_restore for directory dumps")
     # python
     python_code = fields.Text('Python code', tracking=True, default=PYTHON_DEFAULT)
     python_result_code = fields.Text('Python code for result', tracking=True, default=PYTHON_DEFAULT)
@@ -144,6 +206,14 @@ class ConfigStep(models.Model):
     create_config_ids = fields.Many2many('runbot.build.config', 'runbot_build_config_step_ids_create_config_ids_rel', string='New Build Configs', tracking=True, index=True)
     number_builds = fields.Integer('Number of build to create', default=1, tracking=True)
 
+    # shard_tests
+    shard_count = fields.Integer('Number of shards', default=4, tracking=True)
+    shard_config_id = fields.Many2one('runbot.build.config', 'Shard Config', tracking=True, index=True,
+        help="Config of the shard builds, its install steps only install and test the modules of the shard")
+    shard_stat_regex_id = fields.Many2one('runbot.build.stat.regex', 'Module time stat', tracking=True,
+        help="Build stat giving the test time of a module, its key starting with the module name, used to balance the shards")
+    shard_history = fields.Integer('Shard history', default=5, tracking=True, help="Number of previous builds used to estimate the test time of a module")
+
     force_host = fields.Boolean('Use same host as parent for children', default=False, tracking=True)  # future
     make_orphan = fields.Boolean('No effect on the parent result', help='Created build result will not affect parent build result', default=False, tracking=True)
 
@@ -168,6 +238,8 @@ class ConfigStep(models.Model):
 
     restore_download_db_suffix = fields.Char('Download db suffix')
     restore_rename_db_suffix = fields.Char('Rename db suffix')
+    restore_cache = fields.Boolean('Use host restore cache', default=False, tracking=True,
+        help="Keep the first restore of a dump as a template database on the host, next restores of the same dump on the host are created from it")
 
     @api.constrains('python_code')
     def _check_python_code(self):
@@ -269,6 +341,75 @@ class ConfigStep(models.Model):
                     path=str(child.id),
                 )
 
+    def _run_shard_tests(self, build, log_path):
+        if not self.shard_config_id:
+            build._log('shard_tests', 'No shard config defined', level='ERROR')
+            build._kill(result='ko')
+            return
+        modules = build._get_modules_to_test(modules_patterns=self.install_modules)
+        shards = self._make_shards(modules, self._get_module_times(build, modules))
+        config_data = dict(build.params_id.config_data.dict)
+        for index, (shard_time, shard_modules) in enumerate(shards, start=1):
+            child = build._add_child(
+                {'config_id': self.shard_config_id.id, 'config_data': dict(config_data, shard_modules=','.join(sorted(shard_modules)))},
+                orphan=self.make_orphan,
+                description='Shard %s/%s: %s modules, %s estimated' % (index, len(shards), len(shard_modules), s2human(shard_time)),
+            )
+            build._log(
+                'shard_tests',
+                'created shard %s with %s modules' % (index, len(shard_modules)),
+                log_type='subbuild',
+                path=str(child.id),
+            )
+
+    def _get_module_times(self, build, modules):
+        """
+        Return the average test time of the modules on the last shard_history builds
+        of the same version having the shard_stat_regex_id stats
+        """
+        if not self.shard_stat_regex_id or not modules:
+            return {}
+        prefix = '%s.' % self.shard_stat_regex_id.name
+        self.env['runbot.build.stat'].flush()
+        self.env.cr.execute("""
+            WITH recent AS (
+                SELECT DISTINCT stat.build_id
+                FROM runbot_build_stat stat
+                JOIN runbot_build build ON build.id = stat.build_id
+                WHERE build.version_id = %s AND left(stat.key, %s) = %s
+                ORDER BY stat.build_id DESC
+                LIMIT %s
+            )
+            SELECT stat.build_id, split_part(substr(stat.key, %s), '.', 1) AS module, sum(stat.value)
+            FROM runbot_build_stat stat
+            JOIN recent ON recent.build_id = stat.build_id
+            WHERE left(stat.key, %s) = %s
+            GROUP BY stat.build_id, module
+        """, [build.params_id.version_id.id, len(prefix), prefix, self.shard_history, len(prefix) + 1, len(prefix), prefix])
+        modules = set(modules)
+        times = defaultdict(list)
+        for _build_id, module, value in self.env.cr.fetchall():
+            if module in modules:
+                times[module].append(value)
+        return {module: sum(values) / len(values) for module, values in times.items()}
+
+    def _make_shards(self, modules, module_times):
+        """
+        Split modules in at most shard_count shards of balanced test time, assigning
+        the longest modules first to the shard with the smallest total (LPT).
+        Modules without time are given the median known time.
+        Returns a list of (estimated time, modules) sorted by decreasing time.
+        """
+        known_times = sorted(module_times.values())
+        default_time = known_times[len(known_times) // 2] if known_times else 1
+        nb_shards = max(1, min(self.shard_count, len(modules)))
+        shards = [(0, index, []) for index in range(nb_shards)]
+        for module in sorted(modules, key=lambda module: (-module_times.get(module, default_time), module)):
+            shard_time, index, shard_modules = heapq.heappop(shards)
+            shard_modules.append(module)
+            heapq.heappush(shards, (shard_time + module_times.get(module, default_time), index, shard_modules))
+        return [(shard_time, shard_modules) for shard_time, _index, shard_modules in sorted(shards, key=lambda shard: (-shard[0], shard[1])) if shard_modules]
+
     def make_python_ctx(self, build):
         return {
             'self': self,
@@ -378,11 +519,20 @@ class ConfigStep(models.Model):
         # create db if needed
         db_suffix = build.params_id.config_data.get('db_name') or (build.params_id.dump_db.db_suffix if not self.create_db else False) or self.db_name
         db_name = '%s-%s' % (build.dest, db_suffix)
+        extra_params = build.params_id.extra_params or self.extra_params or ''
+        db_template = self.env['runbot.db.template']
         if self.create_db:
-            build._local_pg_createdb(db_name)
+            if self.db_template_cache:
+                template_modules = self._db_template_modules(modules_to_install)
+                db_template = self._get_db_template(build, template_modules, extra_params)
+            if db_template.state == 'done':
+                db_template._create_db(build, db_name)
+                mods = ','.join(module for module in modules_to_install if module not in template_modules)
+                build._log('install_odoo', 'Database created from template %s with %s installed' % (db_template.name, ','.join(template_modules)))
+            else:
+                build._local_pg_createdb(db_name)
         cmd += ['-d', db_name]
         # list module to install
-        extra_params = build.params_id.extra_params or self.extra_params or ''
         if mods and '-i' not in extra_params:
             cmd += ['-i', mods]
         config_path = build._server("tools/config.py")
@@ -392,7 +542,14 @@ class ConfigStep(models.Model):
             else:
                 build._log('test_all', 'Installing modules without testing', level='WARNING')
         test_tags_in_extra = '--test-tags' in extra_params
-        if self.test_tags or test_tags_in_extra:
+        shard_modules = build.params_id.config_data.get('shard_modules')
+        if shard_modules and self.test_enable and not self.test_tags and not test_tags_in_extra and grep(config_path, "[/module][:class]"):
+            # only run the tests of the shard modules, not the ones of their dependencies
+            test_tags = ','.join('/%s' % module for module in sorted(modules_to_install))
+            if self.enable_auto_tags:
+                test_tags = ','.join([test_tags] + self.env['runbot.build.error'].disabling_tags())
+            cmd.extend(['--test-tags', test_tags])
+        elif self.test_tags or test_tags_in_extra:
             if grep(config_path, "test-tags"):
                 if not test_tags_in_extra:
                     test_tags = self.test_tags.replace(' ', '')
@@ -428,12 +585,22 @@ class ConfigStep(models.Model):
         sql_dest = '%s/dump.sql' % dump_dir
         filestore_path = '/data/build/datadir/filestore/%s' % db_name
         filestore_dest = '%s/filestore/' % dump_dir
-        zip_path = '/data/build/logs/%s.zip' % db_name
-        cmd.finals.append(['pg_dump', db_name, '>', sql_dest])
-        cmd.finals.append(['cp', '-r', filestore_path, filestore_dest])
-        cmd.finals.append(['cd', dump_dir, '&&', 'zip', '-rmq9', zip_path, '*'])
+        self.env['runbot.database'].create({'name': db_name, 'build_id': build.id}).dump_format = self.dump_format
+        if self.dump_format == 'directory':
+            archive_path = '/data/build/logs/%s.tar.zst' % db_name
+            cmd.finals.append(['pg_dump', '-Fd', '-j', str(self.dump_jobs or 1), '-Z0', '-f', os.path.join(dump_dir, 'dump'), db_name])
+            cmd.finals.append(['cp', '-r', filestore_path, filestore_dest])
+            cmd.finals.append(['cd', dump_dir, '&&', 'tar', '-cf', '-', '*', '|', 'zstd', '-T0', '-q', '-o', archive_path, '&&', 'rm', '-rf', dump_dir])
+        else:
+            zip_path = '/data/build/logs/%s.zip' % db_name
+            cmd.finals.append(['pg_dump', db_name, '>', sql_dest])
+            cmd.finals.append(['cp', '-r', filestore_path, filestore_dest])
+            cmd.finals.append(['cd', dump_dir, '&&', 'zip', '-rmq9', zip_path, '*'])
         infos = '{\n    "db_name": "%s",\n    "build_id": %s,\n    "shas": [%s]\n}' % (db_name, build.id, ', '.join(['"%s"' % build_commit.commit_id.dname for build_commit in build.params_id.commit_link_ids]))
         build.write_file('logs/%s/info.json' % db_name, infos)
+        if db_template.state == 'pending':
+            # install the template after the build so that a failure does not affect the build result
+            cmd.finals.append(self._db_template_install_cmd(build, db_template, template_modules, py_version, extra_params))
 
         if self.flamegraph:
             cmd.finals.append(['flamegraph.pl', '--title', 'Flamegraph %s for build %s' % (self.name, build.id), self._perfs_data_path(), '>', self._perfs_data_path(ext='svg')])
@@ -443,6 +610,32 @@ class ConfigStep(models.Model):
         env_variables = self.additionnal_env.split(';') if self.additionnal_env else []
         return dict(cmd=cmd, log_path=log_path, build_dir=build._path(), container_name=build._get_docker_name(), cpu_limit=timeout, ro_volumes=exports, env_variables=env_variables)
 
+    def _db_template_modules(self, modules_to_install):
+        template_modules = {module.strip() for module in (self.db_template_modules or 'base').split(',') if module.strip()}
+        return sorted(module for module in template_modules if module == 'base' or module in modules_to_install)
+
+    def _get_db_template(self, build, template_modules, extra_params):
+        """ return the template to use for build, keyed on everything that can change its content """
+        key = json.dumps({
+            'commits': sorted(build.params_id.commit_ids.mapped('name')),
+            'modules': template_modules,
+            'without_demo': '--without-demo' in extra_params,
+            'dockerfile': [build.params_id.dockerfile_id.image_tag, build.params_id.dockerfile_id.dockerfile],
+        }, sort_keys=True)
+        host = self.env['runbot.host']._get_current()
+        return self.env['runbot.db.template']._get_template(host, hashlib.sha256(key.encode()).hexdigest(), build, self)
+
+    def _db_template_install_cmd(self, build, db_template, template_modules, py_version, extra_params):
+        cmd = build._cmd(py_version=py_version)
+        cmd += ['-d', db_template.name, '-i', ','.join(template_modules), '--stop-after-init', '--max-cron-threads=0']
+        cmd += ['--logfile', '/data/build/logs/%s.txt' % db_template.name]
+        if grep(build._server("tools/config.py"), "log-db"):
+            cmd.append('--log-db=')  # the template database name cannot be linked to a build
+        if '--without-demo' in extra_params:
+            cmd.append('--without-demo=all')
+        # finals run in the same shell after the dump ones that change the working directory (and may remove it)
+        return ['cd', '/data/build', '&&', *cmd.cmd, '&&', 'touch', '/data/build/%s.done' % db_template.name]
+
     def _upgrade_create_childs(self):
         pass
 
@@ -689,24 +882,42 @@ class ConfigStep(models.Model):
             dump_build = params.dump_db.build_id or build.parent_id
             assert download_db_suffix and dump_build
             download_db_name = '%s-%s' % (dump_build.dest, download_db_suffix)
-            zip_name = '%s.zip' % download_db_name
+            dump_db = params.dump_db or dump_build.database_ids.filtered(lambda db: db.name == download_db_name)
+            zip_name = dump_db[:1]._get_dump_filename() if dump_db else '%s.zip' % download_db_name
             dump_url = '%s%s' % (dump_build.http_log_url(), zip_name)
             build._log('test-migration', 'Restoring dump [%s](%s) from build [%s](%s)' % (zip_name, dump_url, dump_build.id, dump_build.build_url), log_type='markdown')
         restore_suffix = self.restore_rename_db_suffix or params.dump_db.db_suffix
         assert restore_suffix
         restore_db_name = '%s-%s' % (build.dest, restore_suffix)
 
+        db_template = self.env['runbot.db.template']
+        if self.restore_cache:
+            key = hashlib.sha256(json.dumps({'restore': dump_url}).encode()).hexdigest()
+            host = self.env['runbot.host']._get_current()
+            db_template = db_template._get_template(host, key, build, self, create_empty=False)
+            if db_template.state == 'pending' and params.dump_db:
+                db_template.database_id = params.dump_db
+        if db_template.state == 'done':
+            db_template._create_db(build, restore_db_name)
+            build._log('test-migration', 'Restored from host template %s' % db_template.name)
+            cmd = ' && '.join([
+                'echo "### listing modules"',
+                """psql %s -c "select name from ir_module_module where state = 'installed'" -t -A > /data/build/logs/restore_modules_installed.txt""" % restore_db_name,
+            ])
+            return dict(cmd=cmd, log_path=log_path, build_dir=build._path(), container_name=build._get_docker_name(), cpu_limit=self.cpu_limit)
+
         build._local_pg_createdb(restore_db_name)
+        directory_dump = zip_name.endswith('.tar.zst')
         cmd = ' && '.join([
             'mkdir /data/build/restore',
             'cd /data/build/restore',
             'wget %s' % dump_url,
-            'unzip -q %s' % zip_name,
+            'zstd -dcq %s | tar -xf -' % zip_name if directory_dump else 'unzip -q %s' % zip_name,
             'echo "### restoring filestore"',
             'mkdir -p /data/build/datadir/filestore/%s' % restore_db_name,
             'mv filestore/* /data/build/datadir/filestore/%s' % restore_db_name,
             'echo "###restoring db"',
-            'psql -q %s < dump.sql' % (restore_db_name),
+            'pg_restore -j %s --no-owner -d %s dump' % (self.dump_jobs or 1, restore_db_name) if directory_dump else 'psql -q %s < dump.sql' % (restore_db_name),
             'cd /data/build',
             'echo "### cleaning"',
             'rm -r restore',
@@ -714,6 +925,14 @@ class ConfigStep(models.Model):
             """psql %s -c "select name from ir_module_module where state = 'installed'" -t -A > /data/build/logs/restore_modules_installed.txt""" % restore_db_name,
 
             ])
+        if db_template.state == 'pending':
+            # snapshot the restored database before it is upgraded, a failure only disables the cache for this dump
+            cmd += ' && (%s || echo "### template creation failed")' % ' && '.join([
+                'echo "### creating host template"',
+                'createdb -T %s %s' % (restore_db_name, db_template.name),
+                'cp -al /data/build/datadir/filestore/%s /data/build/datadir/filestore/%s' % (restore_db_name, db_template.name),
+                'touch /data/build/%s.done' % db_template.name,
+            ])
 
         return dict(cmd=cmd, log_path=log_path, build_dir=build._path(), container_name=build._get_docker_name(), cpu_limit=self.cpu_limit)
 
@@ -801,7 +1020,8 @@ class ConfigStep(models.Model):
         if self.job_type == 'install_odoo':
             kwargs['message'] += ' $$fa-download$$'
             db_suffix = build.params_id.config_data.get('db_name') or self.db_name
-            kwargs['path'] = '%s%s-%s.zip' % (build.http_log_url(), build.dest, db_suffix)
+            extension = 'tar.zst' if self.dump_format == 'directory' else 'zip'
+            kwargs['path'] = '%s%s-%s.%s' % (build.http_log_url(), build.dest, db_suffix, extension)
             kwargs['log_type'] = 'link'
         build._log('', **kwargs)
 
@@ -818,6 +1038,8 @@ class ConfigStep(models.Model):
             build._log('end_job', message, log_type='markdown')
 
     def _modules_to_install(self, build):
+        if shard_modules := build.params_id.config_data.get('shard_modules'):
+            return set(shard_modules.split(','))
         return set(build._get_modules_to_test(modules_patterns=self.install_modules))
 
     def _post_install_commands(self, build, modules_to_install, py_version=None):
@@ -928,35 +1150,56 @@ class ConfigStep(models.Model):
         return 'ok'
 
     def _check_module_loaded(self, build):
-        log_path = build._path('logs', '%s.txt' % self.name)
-        if not grep(log_path, ".modules.loading: Modules loaded."):
+        if not self._get_log_analysis(build).found(_modules_loaded):
             build._log('_make_tests_results', "Modules loaded not found in logs", level="ERROR")
             return 'ko'
         return 'ok'
 
     def _check_error(self, build, regex=None):
         log_path = build._path('logs', '%s.txt' % self.name)
-        regex = regex or _re_error
-        if rfind(log_path, regex):
+        if rfind(log_path, regex) if regex else self._get_log_analysis(build).found(_re_error):
             build._log('_make_tests_results', 'Error or traceback found in logs', level="ERROR")
             return 'ko'
         return 'ok'
 
     def _check_warning(self, build, regex=None):
         log_path = build._path('logs', '%s.txt' % self.name)
-        regex = regex or _re_warning
-        if rfind(log_path, regex):
+        if rfind(log_path, regex) if regex else self._get_log_analysis(build).found(_re_warning):
             build._log('_make_tests_results', 'Warning found in logs', level="WARNING")
             return 'warn'
         return 'ok'
 
     def _check_build_ended(self, build):
-        log_path = build._path('logs', '%s.txt' % self.name)
-        if not grep(log_path, "Initiating shutdown"):
+        if not self._get_log_analysis(build).found(_shutdown):
             build._log('_make_tests_results', 'No "Initiating shutdown" found in logs, maybe because of cpu limit.', level="ERROR")
             return 'ko'
         return 'ok'
 
+    def _get_stat_regex_ids(self):
+        regex_ids = self.build_stat_regex_ids
+        if not regex_ids:
+            regex_ids = regex_ids.search([('generic', '=', True)])
+        return regex_ids
+
+    def _get_log_analysis(self, build):
+        """ Return the analysis of the step log file, shared by all checkers and stats.
+        The last analysis is kept as long as the log file is not modified.
+        """
+        global _last_log_analysis
+        log_path = build._path('logs', '%s.txt' % self.name)
+        stat_regex_ids = self._get_stat_regex_ids() if self.make_stats else self.env['runbot.build.stat.regex']
+        try:
+            log_stat = os.stat(log_path)
+            key = (log_path, log_stat.st_size, log_stat.st_mtime_ns, tuple(stat_regex_ids.ids))
+        except OSError:
+            key = None
+        if key and _last_log_analysis and _last_log_analysis[0] == key:
+            return _last_log_analysis[1]
+        analysis = LogAnalysis(log_path, [_modules_loaded, _shutdown], [_re_error, _re_warning], stat_regex_ids)
+        if key:
+            _last_log_analysis = (key, analysis)
+        return analysis
+
     def _get_log_last_write(self, build):
         log_path = build._path('logs', '%s.txt' % self.name)
         if os.path.isfile(log_path):
@@ -996,10 +1239,7 @@ class ConfigStep(models.Model):
             build._log('make_stats', 'Log **%s.txt** file not found' % self.name, level='INFO', log_type='markdown')
             return
         try:
-            regex_ids = self.build_stat_regex_ids
-            if not regex_ids:
-                regex_ids = regex_ids.search([('generic', '=', True)])
-            key_values = regex_ids._find_in_file(log_path)
+            key_values = self._get_log_analysis(build).stats
             self.env['runbot.build.stat']._write_key_values(build, self, key_values)
         except Exception as e:
             message = '**An error occured while computing statistics of %s:**\n`%s`' % (build.job, str(e).replace('\\n', '\n').replace("\\'", "'"))
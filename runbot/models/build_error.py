@@ -6,11 +6,14 @@ import re
 
 from collections import defaultdict
 from fnmatch import fnmatch
-from odoo import models, fields, api
+from psycopg2.extras import execute_values
+from odoo import models, fields, api, tools
 from odoo.exceptions import ValidationError
 
 _logger = logging.getLogger(__name__)
 
+_PARSE_BATCH_SIZE = 1000
+
 
 class BuildError(models.Model):
 
@@ -57,9 +60,8 @@ class BuildError(models.Model):
 
     @api.model_create_single
     def create(self, vals):
-        cleaners = self.env['runbot.error.regex'].search([('re_type', '=', 'cleaning')])
         content = vals.get('content')
-        cleaned_content = cleaners.r_sub('%', content)
+        cleaned_content = self.env['runbot.error.regex']._clean('%', content)
         vals.update({'cleaned_content': cleaned_content,
                      'fingerprint': self._digest(cleaned_content)
         })
@@ -130,35 +132,69 @@ class BuildError(models.Model):
 
     @api.model
     def _parse_logs(self, ir_logs):
+        return self._parse_log_rows(self._iter_log_rows(log_ids=ir_logs.ids))
+
+    @api.model
+    def _parse_build_logs(self, build_ids):
+        return self._parse_log_rows(self._iter_log_rows(build_ids=build_ids))
 
-        regexes = self.env['runbot.error.regex'].search([])
-        search_regs = regexes.filtered(lambda r: r.re_type == 'filter')
-        cleaning_regs = regexes.filtered(lambda r: r.re_type == 'cleaning')
+    @api.model
+    def _iter_log_rows(self, log_ids=None, build_ids=None, batch_size=_PARSE_BATCH_SIZE):
+        """
+        Yield (id, build_id, message, name, path, func) tuples of server errors
+        logs, read in batches of batch_size rows to keep memory usage bounded
+        """
+        self.env['ir.logging'].flush(['build_id', 'message', 'name', 'path', 'func', 'level', 'type'])
+        if log_ids is not None:
+            condition, ids = 'id = ANY(%s)', list(log_ids)
+        else:
+            condition, ids = 'build_id = ANY(%s)', list(build_ids)
+        if not ids:
+            return
+        last_id = 0
+        while True:
+            self.env.cr.execute(f"""
+                SELECT id, build_id, message, name, path, func
+                FROM ir_logging
+                WHERE {condition} AND id > %s AND level = 'ERROR' AND type = 'server'
+                ORDER BY id
+                LIMIT %s
+            """, (ids, last_id, batch_size))
+            rows = self.env.cr.fetchall()
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+    @api.model
+    def _parse_log_rows(self, rows):
+        Regex = self.env['runbot.error.regex']
 
         hash_dict = defaultdict(list)
-        for log in ir_logs:
-            if search_regs.r_search(log.message):
+        for row in rows:
+            message = row[2] or ''
+            if Regex._filter_match(message):
                 continue
-            fingerprint = self._digest(cleaning_regs.r_sub('%', log.message))
-            hash_dict[fingerprint].append(log)
+            fingerprint = self._digest(Regex._clean('%', message))
+            hash_dict[fingerprint].append(row)
 
         build_errors = self.env['runbot.build.error']
         # add build ids to already detected errors
         existing_errors = self.env['runbot.build.error'].search([('fingerprint', 'in', list(hash_dict.keys())), ('active', '=', True)])
         build_errors |= existing_errors
+        links = set()
         for build_error in existing_errors:
-            for build in {rec.build_id for rec in hash_dict[build_error.fingerprint]}:
-                build.build_error_ids += build_error
-            del hash_dict[build_error.fingerprint]
+            links.update((build_error.id, row[1]) for row in hash_dict.pop(build_error.fingerprint, []))
+        self._link_builds(links)
 
         # create an error for the remaining entries
-        for logs in hash_dict.values():
+        for rows in hash_dict.values():
             build_errors |= self.env['runbot.build.error'].create({
-                'content': logs[0].message,
-                'module_name': logs[0].name,
-                'file_path': logs[0].path,
-                'function': logs[0].func,
-                'build_ids': [(6, False, [r.build_id.id for r in logs])],
+                'content': rows[0][2],
+                'module_name': rows[0][3],
+                'file_path': rows[0][4],
+                'function': rows[0][5],
+                'build_ids': [(6, False, list({row[1] for row in rows}))],
             })
 
         if build_errors:
@@ -173,6 +209,24 @@ class BuildError(models.Model):
                 window_action["res_id"] = build_errors.id
             return window_action
 
+    @api.model
+    def _link_builds(self, links):
+        """ Insert (build_error_id, build_id) pairs in the relation table at once """
+        if not links:
+            return
+        self.flush(['build_ids'])
+        execute_values(self.env.cr, """
+            INSERT INTO runbot_build_error_ids_runbot_build_rel (runbot_build_error_id, runbot_build_id)
+            VALUES %s
+            ON CONFLICT DO NOTHING
+        """, list(links))
+        errors = self.browse({error_id for error_id, _ in links})
+        builds = self.env['runbot.build'].browse({build_id for _, build_id in links})
+        errors.invalidate_cache(['build_ids'], errors.ids)
+        builds.invalidate_cache(['build_error_ids'], builds.ids)
+        errors.modified(['build_ids'])
+        errors.recompute()
+
     def link_errors(self):
         """ Link errors with the first one of the recordset
         choosing parent in error with responsible, random bug and finally fisrt seen
@@ -184,9 +238,9 @@ class BuildError(models.Model):
         build_errors[1:].write({'parent_id': build_errors[0].id})
 
     def clean_content(self):
-        cleaning_regs = self.env['runbot.error.regex'].search([('re_type', '=', 'cleaning')])
+        Regex = self.env['runbot.error.regex']
         for build_error in self:
-            build_error.cleaned_content = cleaning_regs.r_sub('%', build_error.content)
+            build_error.cleaned_content = Regex._clean('%', build_error.content)
 
     @api.model
     def test_tags_list(self):
@@ -223,6 +277,42 @@ class ErrorRegex(models.Model):
     re_type = fields.Selection([('filter', 'Filter out'), ('cleaning', 'Cleaning')], string="Regex type")
     sequence = fields.Integer('Sequence', default=100)
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.clear_caches()
+        return super().create(vals_list)
+
+    def write(self, vals):
+        self.clear_caches()
+        return super().write(vals)
+
+    def unlink(self):
+        self.clear_caches()
+        return super().unlink()
+
+    @api.model
+    @tools.ormcache('re_type')
+    def _get_compiled_regexes(self, re_type):
+        """
+        Return a tuple of compiled patterns for the given regex type.
+        Regexes are compiled separately, combining them would renumber their
+        groups and break the ones using backreferences.
+        """
+        regexes = [r.regex for r in self.search([('re_type', '=', re_type), ('regex', '!=', False)])]
+        return tuple(re.compile(regex) for regex in regexes)
+
+    @api.model
+    def _filter_match(self, s):
+        """ Return True if one of the filter regexes is found in s """
+        return any(pattern.search(s) for pattern in self._get_compiled_regexes('filter'))
+
+    @api.model
+    def _clean(self, replace, s):
+        """ Apply the cleaning regexes to the given string """
+        for pattern in self._get_compiled_regexes('cleaning'):
+            s = pattern.sub(replace, s)
+        return s
+
     def r_sub(self, replace, s):
         """ replaces patterns from the recordset by replace in the given string """
         for c in self:
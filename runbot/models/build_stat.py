@@ -41,6 +41,81 @@ class BuildStat(models.Model):
         return self.create(build_stats)
 
 
+class BuildDuration(models.Model):
+    _name = "runbot.build.duration"
+    _description = "Step duration statistics"
+    _log_access = False
+
+    _sql_constraints = [
+        (
+            "trigger_step_version_unique",
+            "unique (trigger_id, config_step_id, version_id)",
+            "Durations must be unique for the same trigger, step and version",
+        )
+    ]
+
+    trigger_id = fields.Many2one("runbot.trigger", "Trigger", index=True, ondelete="cascade")
+    config_step_id = fields.Many2one(
+        "runbot.build.config.step", "Step", required=True, index=True, ondelete="cascade"
+    )
+    version_id = fields.Many2one("runbot.version", "Version", index=True, ondelete="cascade")
+    samples = fields.Char("Last durations", help="Comma separated durations in seconds, most recent last")
+    count = fields.Integer("Samples count")
+    estimate = fields.Integer("Estimated duration", help="Median of the last durations")
+    p95 = fields.Integer("95th percentile")
+
+    @api.model
+    def _add_sample(self, build, config_step, duration):
+        """ Add the duration of a finished step to the rolling statistics of its trigger, step and version """
+        max_samples = int(self.env["ir.config_parameter"].sudo().get_param("runbot.runbot_duration_samples", default=20))
+        params = build.params_id
+        record = self.search([
+            ("trigger_id", "=", params.trigger_id.id),
+            ("config_step_id", "=", config_step.id),
+            ("version_id", "=", params.version_id.id),
+        ], limit=1)
+        if not record:
+            record = self.create({
+                "trigger_id": params.trigger_id.id,
+                "config_step_id": config_step.id,
+                "version_id": params.version_id.id,
+            })
+        samples = [int(sample) for sample in (record.samples or "").split(",") if sample]
+        samples = (samples + [int(duration)])[-max_samples:]
+        ordered = sorted(samples)
+        record.write({
+            "samples": ",".join(str(sample) for sample in samples),
+            "count": len(samples),
+            "estimate": self._percentile(ordered, 0.5),
+            "p95": self._percentile(ordered, 0.95),
+        })
+        # the estimated duration of pending builds is stored to sort the queue, refresh it with the new estimate
+        pending_builds = self.env["runbot.build"].search([
+            ("local_state", "=", "pending"),
+            ("trigger_id", "=", params.trigger_id.id),
+            ("version_id", "=", params.version_id.id),
+        ])
+        if pending_builds:
+            self.env.add_to_compute(pending_builds._fields["estimated_duration"], pending_builds)
+            pending_builds.recompute(["estimated_duration"])
+        return record
+
+    @api.model
+    def _percentile(self, ordered, ratio):
+        return ordered[int(round(ratio * (len(ordered) - 1)))] if ordered else 0
+
+    @api.model
+    def _get_durations(self, trigger, version, config_steps=None):
+        """ Return a dict {config_step_id: duration record} for the steps with statistics, all steps if config_steps is None """
+        domain = [
+            ("trigger_id", "=", trigger.id),
+            ("version_id", "=", version.id),
+        ]
+        if config_steps is not None:
+            domain.append(("config_step_id", "in", config_steps.ids))
+        return {record.config_step_id.id: record for record in self.search(domain)}
+
+
 class RunbotBuildStatSql(models.Model):
 
     _name = "runbot.build.stat.sql"
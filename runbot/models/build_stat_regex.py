@@ -52,22 +52,26 @@ class BuildStatRegex(models.Model):
             return {}
         key_values = {}
         with open(file_path, "r") as log_file:
-            data = log_file.read()
-            for build_stat_regex in self:
-                for match in re.finditer(build_stat_regex.regex, data):
-                    group_dict = match.groupdict()
-                    try:
-                        value = float(group_dict.get("value"))
-                    except ValueError:
-                        _logger.warning(
-                            'The matched value (%s) of "%s" cannot be converted into float',
-                            group_dict.get("value"), build_stat_regex.regex
-                        )
-                        continue
-                    key = (
-                        f'{build_stat_regex.name}.{group_dict["key"]}'
-                        if "key" in group_dict
-                        else build_stat_regex.name
+            self._find_in_text(log_file.read(), key_values)
+        return key_values
+
+    def _find_in_text(self, data, key_values):
+        """ Search regexes in data and update key_values with the matched values"""
+        for build_stat_regex in self:
+            for match in re.finditer(build_stat_regex.regex, data):
+                group_dict = match.groupdict()
+                try:
+                    value = float(group_dict.get("value"))
+                except ValueError:
+                    _logger.warning(
+                        'The matched value (%s) of "%s" cannot be converted into float',
+                        group_dict.get("value"), build_stat_regex.regex
                     )
-                    key_values[key] = value
+                    continue
+                key = (
+                    f'{build_stat_regex.name}.{group_dict["key"]}'
+                    if "key" in group_dict
+                    else build_stat_regex.name
+                )
+                key_values[key] = value
         return key_values
@@ -2,14 +2,81 @@
 import subprocess
 
 from ..common import os, RunbotException
+from .. import metrics
 import glob
+import json
+import re
 import shutil
+import threading
+import time
 
+import requests
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
 from odoo import models, fields, api, registry
 import logging
 
 _logger = logging.getLogger(__name__)
 
+_export_locks = defaultdict(threading.Lock)
+_export_locks_lock = threading.Lock()
+_status_rate_limits = {}  # remote id: timestamp before which no status should be sent to this remote
+STATUS_DEFAULT_BACKOFF = 60  # seconds
+
+
+def _parse_retry_after(value):
+    """ Return the timestamp of a Retry-After header, given in seconds or as an http date """
+    try:
+        return time.time() + int(value)
+    except ValueError:
+        pass
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        _logger.warning('Invalid Retry-After header %r', value)
+        return time.time() + STATUS_DEFAULT_BACKOFF
+
+
+def _post_status(url, token, payload):
+    """
+    Post a commit status on github, called in the sender threads.
+    :return: (done, retry_at) where done is False if the status should be sent again
+             and retry_at the timestamp before which the remote should not be used
+    """
+    metrics.inc('runbot_github_requests_total', method='post')
+    try:
+        response = requests.post(
+            url,
+            data=json.dumps(payload),
+            auth=(token, 'x-oauth-basic'),
+            headers={'Accept': 'application/vnd.github.she-hulk-preview+json'},
+            timeout=30,
+        )
+    except requests.RequestException as e:
+        _logger.warning('Failed to send status to %s: %s', url, e)
+        return False, None
+    retry_at = None
+    if response.headers.get('Retry-After'):
+        retry_at = _parse_retry_after(response.headers['Retry-After'])
+    elif response.headers.get('X-RateLimit-Remaining') == '0':
+        try:
+            retry_at = float(response.headers.get('X-RateLimit-Reset'))
+        except (TypeError, ValueError):
+            retry_at = time.time() + STATUS_DEFAULT_BACKOFF
+    if response.status_code in (403, 429) and retry_at:
+        _logger.warning('Github rate limit reached for %s, retrying after %s', url, time.ctime(retry_at))
+        return False, retry_at
+    if response.status_code >= 500:
+        # github side error, the status is sent again on next turn
+        _logger.warning('Github error %s on %s, retrying later: %s', response.status_code, url, response.text[:200])
+        return False, None
+    if not response.ok:
+        # same as ignore_errors, the status is not sent again
+        _logger.warning('Ignored github error %s on %s: %s', response.status_code, url, response.text[:200])
+    return True, retry_at
+
 
 class Commit(models.Model):
     _name = 'runbot.commit'
@@ -63,9 +130,22 @@ class Commit(models.Model):
             _logger.info('git export: exporting to %s (already exists)', export_path)
             return export_path
 
+        # sources can be exported by the prefetch threads at the same time
+        with _export_locks_lock:
+            export_lock = _export_locks[export_path]
+        with export_lock:
+            if os.path.isdir(export_path):
+                _logger.info('git export: exporting to %s (exported concurrently)', export_path)
+                return export_path
+            return self._export(export_path)
 
+    def _export(self, export_path):
         _logger.info('git export: exporting to %s (new)', export_path)
-        os.makedirs(export_path)
+        start = time.time()
+        # export in a temporary folder renamed at the end, an existing export_path is always complete
+        tmp_path = f'{export_path}.tmp'
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
 
         self.repo_id._fetch(self.name)
         export_sha = self.name
@@ -73,25 +153,10 @@ class Commit(models.Model):
             export_sha = self.rebase_on_id.name
             self.rebase_on_id.repo_id._fetch(export_sha)
 
-        p1 = subprocess.Popen(
-            ['git', f'--git-dir={self.repo_id.path}', 'archive', export_sha],
-            stderr=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-        )
-        p2 = subprocess.Popen(['tar', '-xmC', export_path], stdin=p1.stdout, stdout=subprocess.PIPE)
-        p1.stdout.close()  # Allow p1 to receive a SIGPIPE if p2 exits.
-        (_, err) = p2.communicate()
-        p1.poll()  # fill the returncode
-        if p1.returncode:
-            _logger.info("git export: removing corrupted export %r", export_path)
-            shutil.rmtree(export_path)
-            raise RunbotException(
-                f"Git archive failed for {self.name} with error code {p1.returncode}. ({p1.stderr.read().decode()})"
-            )
-        if err:
-            _logger.info("git export: removing corrupted export %r", export_path)
-            shutil.rmtree(export_path)
-            raise RunbotException(f"Export for {self.name} failed. ({err})")
+        icp = self.env['ir.config_parameter']
+        if not (icp.get_param('runbot.runbot_export_hardlink') and self._export_from_previous(export_sha, tmp_path)):
+            os.makedirs(tmp_path)
+            self._export_archive(export_sha, tmp_path)
 
         if self.rebase_on_id:
             # we could be smart here and detect if merge_base == commit, in witch case checkouting base_commit is enough. Since we don't have this info
@@ -107,34 +172,117 @@ class Commit(models.Model):
                 stderr=subprocess.PIPE,
                 stdout=subprocess.PIPE,
             )
-            p2 = subprocess.Popen(['patch', '-p0', '-d', export_path], stdin=p1.stdout, stdout=subprocess.PIPE)
+            # the export may be hardlinked to a previous one (_export_from_previous), this relies on GNU patch
+            # writing each patched file to a new file renamed over the original, breaking the hardlink.
+            # A patch tool modifying files in place would also modify the previous export.
+            p2 = subprocess.Popen(['patch', '-p0', '-d', tmp_path], stdin=p1.stdout, stdout=subprocess.PIPE)
             p1.stdout.close()
             (message, err) = p2.communicate()
             p1.poll()
             if err:
-                shutil.rmtree(export_path)
+                shutil.rmtree(tmp_path)
                 raise RunbotException(
                     f"Apply patch failed for {export_sha}...{self.name}. ({err})"
                 )
             if p1.returncode or p2.returncode:
-                shutil.rmtree(export_path)
+                shutil.rmtree(tmp_path)
                 raise RunbotException(
                     f"Apply patch failed for {export_sha}...{self.name} with error code {p1.returncode}+{p2.returncode}. ({message})"
                 )
 
+        os.rename(tmp_path, export_path)
+
         # migration scripts link if necessary
-        icp = self.env['ir.config_parameter']
         ln_param = icp.get_param('runbot_migration_ln', default='')
         migration_repo_id = int(icp.get_param('runbot_migration_repo_id', default=0))
-        if ln_param and migration_repo_id and self.repo_id.server_files:
+        if ln_param and migration_repo_id and self.repo_id.server_files and not os.path.lexists(self._source_path(ln_param)):
             scripts_dir = self.env['runbot.repo'].browse(migration_repo_id).name
             try:
                 os.symlink(f'/data/build/{scripts_dir}', self._source_path(ln_param))
             except FileNotFoundError:
                 _logger.warning('Impossible to create migration symlink')
 
+        metrics.observe('runbot_export_seconds', time.time() - start)
         return export_path
 
+    def _export_archive(self, export_sha, export_path, paths=None):
+        """Extract the tree of export_sha (or only the given paths) in export_path"""
+        p1 = subprocess.Popen(
+            ['git', f'--git-dir={self.repo_id.path}', 'archive', export_sha] + (['--'] + paths if paths else []),
+            stderr=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        p2 = subprocess.Popen(['tar', '-xmC', export_path], stdin=p1.stdout, stdout=subprocess.PIPE)
+        p1.stdout.close()  # Allow p1 to receive a SIGPIPE if p2 exits.
+        (_, err) = p2.communicate()
+        p1.poll()  # fill the returncode
+        if p1.returncode:
+            _logger.info("git export: removing corrupted export %r", export_path)
+            shutil.rmtree(export_path)
+            raise RunbotException(
+                f"Git archive failed for {self.name} with error code {p1.returncode}. ({p1.stderr.read().decode()})"
+            )
+        if err:
+            _logger.info("git export: removing corrupted export %r", export_path)
+            shutil.rmtree(export_path)
+            raise RunbotException(f"Export for {self.name} failed. ({err})")
+
+    def _get_export_diff(self, base_sha, export_sha):
+        """Return the list of (status, path) changed between two commits, None if the diff cannot be computed"""
+        try:
+            output = subprocess.check_output(
+                ['git', f'--git-dir={self.repo_id.path}', 'diff', '--no-renames', '--name-status', '-z', base_sha, export_sha],
+                stderr=subprocess.DEVNULL,
+            ).decode()
+        except subprocess.CalledProcessError:
+            return None
+        parts = output.split('\0')
+        return list(zip(parts[0::2], parts[1::2]))
+
+    def _export_from_previous(self, export_sha, export_path):
+        """Export export_sha by hardlinking a previous export of the same repo and only
+        extracting files changed since this export.
+        Exports are mounted read only in the containers, hardlinked files are never modified.
+        :return: True if the export succeeded, False if a full export is needed
+        """
+        repo_sources = os.path.dirname(export_path)
+        max_diff = int(self.env['ir.config_parameter'].get_param('runbot.runbot_export_max_diff', default=5000))
+        candidates = [
+            path for path in glob.glob(os.path.join(repo_sources, '*'))
+            if re.match(r'^[0-9a-f]{40}$', os.path.basename(path)) and os.path.basename(path) != export_sha
+        ]
+        candidates = sorted(candidates, key=os.path.getmtime, reverse=True)[:5]
+        best = None
+        for candidate in candidates:
+            diff = self._get_export_diff(os.path.basename(candidate), export_sha)
+            if diff is not None and len(diff) <= max_diff and (best is None or len(diff) < len(best[1])):
+                best = (candidate, diff)
+        if not best:
+            return False
+
+        base_path, diff = best
+        _logger.info('git export: hardlinking %s and applying %s changes', base_path, len(diff))
+        try:
+            subprocess.check_output(['cp', '-al', base_path, export_path], stderr=subprocess.STDOUT)
+            # changed files are unlinked first, modifying them in place would also modify the base export
+            for _status, path in diff:
+                file_path = os.path.join(export_path, path)
+                if os.path.islink(file_path) or os.path.isfile(file_path):
+                    os.unlink(file_path)
+                    parent = os.path.dirname(file_path)
+                    while parent != export_path and not os.listdir(parent):
+                        os.rmdir(parent)
+                        parent = os.path.dirname(parent)
+            to_extract = [path for status, path in diff if status != 'D']
+            for i in range(0, len(to_extract), 500):
+                self._export_archive(export_sha, export_path, to_extract[i:i + 500])
+        except (subprocess.CalledProcessError, OSError, RunbotException) as e:
+            _logger.warning('git export: hardlink export of %s failed, falling back on full export (%s)', export_sha, e)
+            if os.path.isdir(export_path):
+                shutil.rmtree(export_path)
+            return False
+        return True
+
     def read_source(self, file, mode='r'):
         file_path = self._source_path(file)
         try:
@@ -202,8 +350,18 @@ class CommitStatus(models.Model):
     target_url = fields.Char('Url')
     description = fields.Char('Description')
     sent_date = fields.Datetime('Sent Date')
+    send_state = fields.Selection([
+        ('pending', 'Pending'),
+        ('sent', 'Sent'),
+        ('superseded', 'Superseded'),
+    ], 'Outbox state', index=True, help='State in the outbox, empty when the status was sent directly')
+    sent_remote_ids = fields.Many2many('runbot.remote', string='Sent to remotes', help='Remotes that already received a pending status of the outbox')
 
     def _send(self, post_commit=True):
+        if self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_status_outbox'):
+            # delivered later by _send_pending, in a background thread of the leader
+            self.send_state = 'pending'
+            return
         user_id = self.env.user.id
         _dbname = self.env.cr.dbname
         _context = self.env.context
@@ -251,3 +409,70 @@ class CommitStatus(models.Model):
                 self._cr.after('commit', send_github_status_async)
             else:
                 send_github_status(self.env)
+
+    @api.model
+    def _send_pending(self, max_workers=4, limit=500):
+        """
+        Send the statuses of the outbox. Only the last status of a (commit, context) is sent,
+        older pending ones are superseded. The http requests are sent in a pool of threads,
+        the database is only accessed by the caller. Remotes that reached the github rate
+        limit are skipped until the reset time, their statuses remain pending. A status is
+        only sent again to the remotes that did not receive it yet.
+        :return: the sent statuses
+        """
+        self.flush(['send_state', 'commit_id', 'context'])
+        self.env.cr.execute("""
+            UPDATE runbot_commit_status status SET send_state = 'superseded'
+            WHERE status.send_state = 'pending' AND EXISTS (
+                SELECT 1 FROM runbot_commit_status newer
+                WHERE newer.commit_id = status.commit_id AND newer.context = status.context AND newer.id > status.id
+            )
+        """)
+        if self.env.cr.rowcount:
+            metrics.inc('runbot_github_statuses_total', self.env.cr.rowcount, result='superseded')
+        self.invalidate_cache(['send_state'])
+
+        pending = self.search([('send_state', '=', 'pending')], order='id', limit=limit)
+        now = time.time()
+        jobs = {}  # (status, remote): job arguments
+        for status in pending:
+            remotes = status.commit_id.repo_id.remote_ids.sudo()
+            if no_token_remotes := remotes.filtered(lambda remote: not remote.token):
+                _logger.warning('No token on remote %s, skipping status', no_token_remotes.mapped('name'))
+            for remote in remotes - no_token_remotes - status.sent_remote_ids:
+                if _status_rate_limits.get(remote.id, 0) > now:
+                    continue
+                payload = {
+                    'context': status.context,
+                    'state': status.state,
+                    'target_url': status.target_url,
+                    'description': status.description,
+                }
+                url = remote._get_github_url(f'/repos/:owner/:repo/statuses/{status.commit_id.name}')
+                jobs[(status, remote)] = (url, remote.token, payload)
+        if not pending:
+            return self.browse()
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='runbot-status') as executor:
+            futures = {key: executor.submit(_post_status, *args) for key, args in jobs.items()}
+        for (status, remote), future in futures.items():
+            try:
+                done, retry_at = future.result()
+            except Exception:
+                _logger.exception('Failed to send status %s to %s', status.id, remote.name)
+                done, retry_at = False, None
+            if retry_at:
+                _status_rate_limits[remote.id] = retry_at
+            if done:
+                status.sent_remote_ids |= remote
+        # a status skipped or not done on a remote stays pending, it will only be sent again to this remote
+        sent = pending.filtered(lambda status: all(
+            remote in status.sent_remote_ids
+            for remote in status.commit_id.repo_id.remote_ids.sudo() if remote.token
+        ))
+        for status in sent:
+            _logger.info('github updated %s status %s to %s', status.context, status.commit_id.name, status.state)
+        sent.write({'send_state': 'sent', 'sent_date': fields.Datetime.now()})
+        metrics.inc('runbot_github_statuses_total', len(sent), result='sent')
+        return sent
+
@@ -1,5 +1,12 @@
+import datetime
 import logging
+import shutil
+import subprocess
+
+from psycopg2 import sql
+
 from odoo import models, fields, api
+from ..common import local_pgadmin_cursor, os
 _logger = logging.getLogger(__name__)
 
 
@@ -10,11 +17,17 @@ class Database(models.Model):
     name = fields.Char('Host name', required=True, unique=True)
     build_id = fields.Many2one('runbot.build', index=True, required=True)
     db_suffix = fields.Char(compute='_compute_db_suffix')
+    dump_format = fields.Selection([('zip', 'Zip (plain sql)'), ('directory', 'Directory (tar.zst)')], default='zip')
 
     def _compute_db_suffix(self):
         for record in self:
             record.db_suffix = record.name.replace(f'{record.build_id.dest}-', '')
 
+    def _get_dump_filename(self):
+        self.ensure_one()
+        extension = 'tar.zst' if self.dump_format == 'directory' else 'zip'
+        return f'{self.name}.{extension}'
+
     @api.model_create_single
     def create(self, values):
         if res := self.search(
@@ -22,3 +35,123 @@ class Database(models.Model):
         ):
             return res
         return super().create(values)
+
+
+class DbTemplate(models.Model):
+    _name = 'runbot.db.template'
+    _description = "Database template"
+    _order = 'last_used desc, id desc'
+
+    name = fields.Char('Database name', required=True)
+    key = fields.Char('Cache key', required=True, index=True)
+    host_id = fields.Many2one('runbot.host', 'Host', required=True, index=True, ondelete='cascade')
+    build_id = fields.Many2one('runbot.build', 'Creating build', ondelete='set null')
+    step_id = fields.Many2one('runbot.build.config.step', 'Creating step', ondelete='set null')
+    database_id = fields.Many2one('runbot.database', 'Restored dump', index=True, ondelete='set null')
+    state = fields.Selection([('pending', 'Pending'), ('done', 'Done')], default='pending', required=True)
+    last_used = fields.Datetime('Last used', default=fields.Datetime.now)
+    size = fields.Integer('Size (MB)')
+
+    _sql_constraints = [('runbot_db_template_host_key_unique', 'unique(host_id, key)', 'A template with this key already exists on this host')]
+
+    def _get_filestore_path(self):
+        self.ensure_one()
+        return os.path.join(self.env['runbot.runbot']._root(), 'db_template', self.name)
+
+    def _get_done_marker(self):
+        """ path of the file touched by the creating build once the template is installed """
+        self.ensure_one()
+        return self.build_id._path(f'{self.name}.done')
+
+    @api.model
+    def _get_template(self, host, key, build, step, create_empty=True):
+        """
+        Return the done template for key on host, or a new pending template
+        that the given build must install. Return an empty recordset if the
+        template is being installed by another build.
+        If create_empty is False, the build is responsible of creating the
+        template database, e.g. with createdb -T.
+        """
+        template = self.search([('host_id', '=', host.id), ('key', '=', key)])
+        template._update_pending()
+        if not template.exists():
+            template = self.create({
+                'name': f'runbot_template_{key[:16]}',
+                'key': key,
+                'host_id': host.id,
+                'build_id': build.id,
+                'step_id': step.id,
+            })
+            if create_empty:
+                template._create_empty_db()
+            return template
+        if template.state == 'done':
+            template.last_used = fields.Datetime.now()
+            return template
+        return self.browse()
+
+    def _update_pending(self):
+        """ mark as done templates installed by their build, drop the ones that failed """
+        for template in self.filtered(lambda t: t.state == 'pending'):
+            build = template.build_id
+            if build and os.path.exists(template._get_done_marker()):
+                source = build._path('datadir', 'filestore', template.name)
+                if os.path.isdir(source):
+                    shutil.move(source, template._get_filestore_path())
+                with local_pgadmin_cursor() as local_cr:
+                    local_cr.execute('SELECT pg_database_size(%s)', [template.name])
+                    size = local_cr.fetchone()[0]
+                template.write({'state': 'done', 'size': size // (1024 * 1024), 'last_used': fields.Datetime.now()})
+                _logger.info('Database template %s is ready', template.name)
+                self._gc(template.host_id)
+            elif not build or build.local_state != 'testing' or build.active_step != template.step_id:
+                _logger.info('Database template %s was not installed, dropping it', template.name)
+                template._drop()
+
+    @api.model
+    def _cleanup(self, host):
+        """ update the pending templates of host, even if no build asks for them, and drop unused ones """
+        self.search([('host_id', '=', host.id), ('state', '=', 'pending')])._update_pending()
+        self._gc(host)
+
+    def _create_empty_db(self):
+        self.ensure_one()
+        db_template = self.env['ir.config_parameter'].get_param('runbot.runbot_db_template', default='template0')
+        with local_pgadmin_cursor() as local_cr:
+            local_cr.execute(sql.SQL('DROP DATABASE IF EXISTS {}').format(sql.Identifier(self.name)))
+            local_cr.execute(sql.SQL("""CREATE DATABASE {} TEMPLATE %s LC_COLLATE 'C' ENCODING 'unicode'""").format(sql.Identifier(self.name)), (db_template,))
+
+    def _create_db(self, build, dbname):
+        """ create dbname from the template database and hardlink its filestore in the build datadir """
+        self.ensure_one()
+        build._local_pg_createdb(dbname, db_template=self.name)
+        filestore_path = self._get_filestore_path()
+        if os.path.isdir(filestore_path):
+            filestore_dir = build._path('datadir', 'filestore')
+            os.makedirs(filestore_dir, exist_ok=True)
+            subprocess.run(['cp', '-al', filestore_path, os.path.join(filestore_dir, dbname)], check=True)
+
+    def _drop(self):
+        for template in self:
+            with local_pgadmin_cursor() as local_cr:
+                local_cr.execute('SELECT pg_terminate_backend(pid) FROM pg_stat_activity WHERE datname=%s', [template.name])
+                local_cr.execute(sql.SQL('DROP DATABASE IF EXISTS {}').format(sql.Identifier(template.name)))
+            shutil.rmtree(template._get_filestore_path(), ignore_errors=True)
+        self.unlink()
+
+    @api.model
+    def _gc(self, host):
+        """ drop templates unused for too long and least recently used ones above the size limit """
+        icp = self.env['ir.config_parameter']
+        max_size = int(icp.get_param('runbot.runbot_db_template_max_size', default=10240))
+        max_age = int(icp.get_param('runbot.runbot_db_template_max_age', default=2))
+        min_date = fields.Datetime.now() - datetime.timedelta(days=max_age)
+        to_drop = self.browse()
+        total_size = 0
+        for template in self.search([('host_id', '=', host.id), ('state', '=', 'done')], order='last_used desc, id desc'):
+            total_size += template.size
+            if template.last_used < min_date or total_size > max_size:
+                to_drop |= template
+        if to_drop:
+            _logger.info('Dropping database templates %s', ', '.join(to_drop.mapped('name')))
+            to_drop._drop()
@@ -2,10 +2,11 @@
 
 import logging
 
-from collections import defaultdict
+from collections import Counter, defaultdict
+from psycopg2.extras import execute_values
 
 from ..common import pseudo_markdown
-from odoo import models, fields, tools
+from odoo import api, models, fields, tools
 from odoo.exceptions import UserError
 
 _logger = logging.getLogger(__name__)
@@ -31,6 +32,10 @@ class runbot_event(models.Model):
         self._cr.execute("""
 CREATE OR REPLACE FUNCTION runbot_set_logging_build() RETURNS TRIGGER AS $runbot_set_logging_build$
 BEGIN
+  IF (current_setting('runbot.skip_log_trigger', true) = 'on') THEN
+    -- log lines inserted by ir.logging._bulk_insert, build bookkeeping is done once for the batch
+    RETURN NEW;
+  END IF;
   IF (NEW.build_id IS NULL AND NEW.dbname IS NOT NULL AND NEW.dbname != current_database()) THEN
     NEW.build_id := split_part(NEW.dbname, '-', 1)::integer;
     SELECT active_step INTO NEW.active_step_id FROM runbot_build WHERE runbot_build.id = NEW.build_id;
@@ -41,11 +46,8 @@ BEGIN
     BEGIN
         UPDATE runbot_build b
             SET log_counter = log_counter - 1
-        WHERE b.id = NEW.build_id;
-        SELECT log_counter
-        INTO counter
-        FROM runbot_build
-        WHERE runbot_build.id = NEW.build_id;
+        WHERE b.id = NEW.build_id
+        RETURNING log_counter INTO counter;
         IF (counter = 0) THEN
             NEW.message = 'Log limit reached (full logs are still available in the log file)';
             NEW.level = 'SEPARATOR';
@@ -58,12 +60,14 @@ BEGIN
     END;
   END IF;
   IF (NEW.build_id IS NOT NULL AND UPPER(NEW.level) NOT IN ('INFO', 'SEPARATOR')) THEN
+    DECLARE
+        new_result VARCHAR := CASE WHEN UPPER(NEW.level) = 'WARNING' THEN 'warn' ELSE 'ko' END;
     BEGIN
+        -- avoid to lock and rewrite the build row when the result is already set
         UPDATE runbot_build b
-            SET triggered_result = CASE WHEN UPPER(NEW.level) = 'WARNING' THEN 'warn'
-                                        ELSE 'ko'
-                                   END
-        WHERE b.id = NEW.build_id;
+            SET triggered_result = new_result
+        WHERE b.id = NEW.build_id
+          AND b.triggered_result IS DISTINCT FROM new_result;
     END;
   END IF;
 RETURN NEW;
@@ -76,6 +80,70 @@ FOR EACH ROW EXECUTE PROCEDURE runbot_set_logging_build();
 
         """)
 
+    @api.model
+    def _bulk_insert(self, vals_list):
+        """ Insert build log lines with a single query.
+        The log counter and triggered result bookkeeping done by the runbot_set_logging_build
+        trigger is done once per build for the whole batch, with the same log limit semantics.
+        :param vals_list: list of dict with build_id, type, level, name, message, path, func and line
+        """
+        if not vals_list:
+            return
+        self.env['runbot.build'].flush(['log_counter', 'triggered_result'])
+        cr = self.env.cr
+
+        counters = {}
+        server_lines = Counter(vals['build_id'] for vals in vals_list if vals['type'] == 'server')
+        if server_lines:
+            counters = dict(execute_values(cr, """
+                UPDATE runbot_build b
+                    SET log_counter = b.log_counter - c.count
+                FROM (VALUES %s) AS c(id, count)
+                WHERE b.id = c.id
+                RETURNING b.id, b.log_counter + c.count
+            """, list(server_lines.items()), fetch=True))
+
+        rows = []
+        triggered_results = {}
+        for vals in vals_list:
+            build_id = vals['build_id']
+            vals = dict(vals)
+            if vals['type'] == 'server' and build_id in counters:
+                counters[build_id] -= 1
+                if counters[build_id] == 0:
+                    vals.update(
+                        message='Log limit reached (full logs are still available in the log file)',
+                        level='SEPARATOR',
+                        func='',
+                        type='runbot',
+                    )
+                elif counters[build_id] < 0:
+                    continue
+            if vals['level'].upper() not in ('INFO', 'SEPARATOR'):
+                triggered_results[build_id] = 'warn' if vals['level'].upper() == 'WARNING' else 'ko'
+            rows.append((
+                self.env.uid, build_id, vals.get('active_step_id'), vals['type'], vals['level'],
+                vals['name'], vals['message'], vals['path'], vals['func'], vals['line'],
+            ))
+
+        # the setting is local to the transaction, a rollback also resets it
+        cr.execute("SELECT set_config('runbot.skip_log_trigger', 'on', true)")
+        execute_values(cr, """
+            INSERT INTO ir_logging(create_date, create_uid, build_id, active_step_id, type, level, name, message, path, func, line)
+            VALUES %s
+        """, rows, template="(NOW() at time zone 'UTC', %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
+        cr.execute("SELECT set_config('runbot.skip_log_trigger', 'off', true)")
+
+        if triggered_results:
+            execute_values(cr, """
+                UPDATE runbot_build b
+                    SET triggered_result = c.result
+                FROM (VALUES %s) AS c(id, result)
+                WHERE b.id = c.id
+                  AND b.triggered_result IS DISTINCT FROM c.result
+            """, list(triggered_results.items()))
+        self.env['runbot.build'].invalidate_cache(['log_counter', 'triggered_result'], list(set(counters) | set(triggered_results)))
+
     def _markdown(self):
         """ Apply pseudo markdown parser for message.
         """
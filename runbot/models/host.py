@@ -1,12 +1,28 @@
+import glob
+import hashlib
+import json
 import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait
+
 from odoo import models, fields, api
 from odoo.tools import config
 from ..common import fqdn, local_pgadmin_cursor, os
-from ..container import docker_build
+from ..container import docker_build, docker_image_label, DOCKERUSER
+from ..fields import JsonDictField
+from .. import metrics
 _logger = logging.getLogger(__name__)
 
 forced_host_name = None
 
+DOCKERFILE_HASH_LABEL = 'runbot.dockerfile_hash'
+
+_docker_build_executor = None
+_docker_building = {}  # image tag: (dockerfile id, future of the docker build)
+_last_locality_report = 0
+_last_metrics_save = 0
+
 class Host(models.Model):
     _name = 'runbot.host'
     _description = "Host"
@@ -30,6 +46,13 @@ class Host(models.Model):
     last_exception = fields.Char('Last exception')
     exception_count = fields.Integer('Exception count')
     psql_conn_count = fields.Integer('SQL connections count', default=0)
+    # locality, used to allocate builds to hosts where they are cheaper to start
+    exported_commit_ids = fields.Many2many('runbot.commit', 'runbot_host_exported_commit_rel', string='Exported sources')
+    dockerfile_ids = fields.Many2many('runbot.dockerfile', 'runbot_host_dockerfile_rel', string='Available docker images')
+    loop_metrics = JsonDictField('Loop metrics', help='Last metrics saved by each process of the host')
+    # profiling
+    profile_next_turns = fields.Boolean('Profile next turns', help='Profile the next runbot_profile_turns loop turns of the host processes')
+    profile_ids = fields.One2many('runbot.host.profile', 'host_id', string='Profiles')
 
     def _compute_nb(self):
         groups = self.env['runbot.build'].read_group(
@@ -69,33 +92,187 @@ class Host(models.Model):
 
     def _bootstrap(self):
         """ Create needed directories in static """
-        dirs = ['build', 'nginx', 'repo', 'sources', 'src', 'docker']
+        dirs = ['build', 'nginx', 'repo', 'sources', 'src', 'docker', 'trash', 'profiles']
         static_path = self._get_work_path()
         static_dirs = {d: os.path.join(static_path, d) for d in dirs}
         for path in static_dirs.values():
             os.makedirs(path, exist_ok=True)
         self._bootstrap_db_template()
+        self._sync_ports()
 
     def _docker_build(self):
         """ build docker images needed by locally pending builds"""
         _logger.info('Building docker image...')
         self.ensure_one()
+        global _docker_build_executor
+        get_param = self.env['ir.config_parameter'].get_param
+        nb_workers = max(int(get_param('runbot.runbot_docker_build_workers', default=1)), 1)
+        background = get_param('runbot.runbot_docker_build_background')
         static_path = self._get_work_path()
         self.clear_caches()  # needed to ensure that content is updated on all hosts
+        self._docker_build_collect()
+        futures = []
         for dockerfile in self.env['runbot.dockerfile'].search([('to_build', '=', True)]):
-            _logger.info('Building %s, %s', dockerfile.name, hash(str(dockerfile.dockerfile)))
+            if dockerfile.image_tag in _docker_building:
+                continue
+            dockerfile_hash = hashlib.sha256((dockerfile.dockerfile + DOCKERUSER).encode()).hexdigest()
+            if docker_image_label(dockerfile.image_tag, DOCKERFILE_HASH_LABEL) == dockerfile_hash:
+                _logger.info('Skipping %s, image is up to date', dockerfile.name)
+                self.dockerfile_ids |= dockerfile
+                continue
+            self.dockerfile_ids -= dockerfile
+            _logger.info('Building %s, %s', dockerfile.name, dockerfile_hash)
             docker_build_path = os.path.join(static_path, 'docker', dockerfile.image_tag)
             os.makedirs(docker_build_path, exist_ok=True)
             with open(os.path.join(docker_build_path, 'Dockerfile'), 'w') as Dockerfile:
                 Dockerfile.write(dockerfile.dockerfile)
-            build_process = docker_build(docker_build_path, dockerfile.image_tag)
-            if build_process != 0:
+            if _docker_build_executor is None:
+                _docker_build_executor = ThreadPoolExecutor(max_workers=nb_workers, thread_name_prefix='runbot-docker-build')
+            future = _docker_build_executor.submit(docker_build, docker_build_path, dockerfile.image_tag, {DOCKERFILE_HASH_LABEL: dockerfile_hash})
+            _docker_building[dockerfile.image_tag] = (dockerfile.id, future)
+            futures.append(future)
+        if futures and not background:
+            wait(futures)
+        self._docker_build_collect()
+
+    def _docker_build_collect(self):
+        """ handle the result of finished docker builds """
+        for image_tag, (dockerfile_id, future) in list(_docker_building.items()):
+            if not future.done():
+                continue
+            del _docker_building[image_tag]
+            try:
+                build_process = future.result()
+            except Exception:
+                _logger.exception('Dockerfile build "%s" crashed', image_tag)
+                build_process = -1
+            dockerfile = self.env['runbot.dockerfile'].browse(dockerfile_id)
+            if build_process == 0:
+                self.dockerfile_ids |= dockerfile
+            else:
                 dockerfile.to_build = False
-                message = f'Dockerfile build "{dockerfile.image_tag}" failed on host {self.name}'
+                message = f'Dockerfile build "{image_tag}" failed on host {self.name}'
                 dockerfile.message_post(body=message)
                 self.env['runbot.runbot'].warning(message)
                 _logger.warning(message)
 
+    def _get_building_image_tags(self):
+        """ return the image tags of the docker images being built in background """
+        self._docker_build_collect()
+        return set(_docker_building)
+
+    def _report_locality(self):
+        """ update the sources exported on the host, at most every runbot_locality_report_interval seconds """
+        global _last_locality_report
+        self.ensure_one()
+        interval = int(self.env['ir.config_parameter'].get_param('runbot.runbot_locality_report_interval', default=60))
+        if time.time() - _last_locality_report < interval:
+            return
+        _last_locality_report = time.time()
+        sources_path = os.path.join(self.env['runbot.runbot']._root(), 'sources')
+        exported = set()
+        for source_dir in glob.glob(os.path.join(sources_path, '*', '*')):
+            repo_name, sha = os.path.relpath(source_dir, sources_path).split(os.sep)
+            if not sha.endswith('.tmp'):
+                exported.add((repo_name, sha))
+        commits = self.env['runbot.commit'].search([('name', 'in', [sha for _, sha in exported])])
+        commits = commits.filtered(lambda commit: (commit.repo_id.name, commit.name) in exported)
+        if commits != self.exported_commit_ids:
+            self.exported_commit_ids = commits
+
+    def _save_metrics(self, process):
+        """ save the metrics of the current process on the host, at most every runbot_metrics_interval seconds """
+        global _last_metrics_save
+        self.ensure_one()
+        interval = int(self.env['ir.config_parameter'].get_param('runbot.runbot_metrics_interval', default=30))
+        if interval <= 0 or time.time() - _last_metrics_save < interval:
+            return
+        _last_metrics_save = time.time()
+        values = {'date': time.time(), 'samples': metrics.snapshot()}
+        # each process only updates its own key, the leader and the builder can share a host
+        self.env.cr.execute(
+            "UPDATE runbot_host SET loop_metrics = coalesce(loop_metrics, '{}'::jsonb) || jsonb_build_object(%s, %s::jsonb) WHERE id = %s",
+            [process, json.dumps(values), self.id]
+        )
+        self.invalidate_cache(['loop_metrics'], self.ids)
+
+    def _allocate_port(self, build):
+        """
+        Return a free port of the host for build, the port and the two following ones
+        are reserved until the build is done. Released ports are reused first, a new one
+        is added after the highest known port when none is free.
+        """
+        self.ensure_one()
+        starting_port = int(self.env['ir.config_parameter'].get_param('runbot.runbot_starting_port', default=2000))
+        self._release_ports(build)
+        self.env.cr.execute("""
+            UPDATE runbot_host_port SET build_id = %s
+            WHERE id = (
+                SELECT id FROM runbot_host_port
+                WHERE host_id = %s AND build_id IS NULL AND port >= %s
+                ORDER BY port
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING port
+        """, [build.id, self.id, starting_port])
+        row = self.env.cr.fetchone()
+        while not row:
+            # a concurrent allocation may insert the same port, just try the next one
+            self.env.cr.execute("""
+                INSERT INTO runbot_host_port (host_id, port, build_id)
+                SELECT %s, GREATEST(MAX(port) + 3, %s), %s FROM runbot_host_port WHERE host_id = %s
+                ON CONFLICT DO NOTHING
+                RETURNING port
+            """, [self.id, starting_port, build.id, self.id])
+            row = self.env.cr.fetchone()
+        self.env['runbot.host.port'].invalidate_cache()
+        return row[0]
+
+    @api.model
+    def _release_ports(self, builds):
+        if builds:
+            self.env.cr.execute("UPDATE runbot_host_port SET build_id = NULL WHERE build_id IN %s", [tuple(builds.ids)])
+            self.env['runbot.host.port'].invalidate_cache()
+
+    def _sync_ports(self):
+        """ Reserve the ports of the active builds of the host and release the other ones """
+        self.ensure_one()
+        self.env['runbot.build'].flush(['host', 'local_state', 'port'])
+        self.env.cr.execute("""
+            UPDATE runbot_host_port host_port SET build_id = NULL
+            FROM runbot_build build
+            WHERE host_port.build_id = build.id AND host_port.host_id = %s
+            AND (build.local_state NOT IN ('testing', 'running') OR build.host != %s)
+        """, [self.id, self.name])
+        self.env.cr.execute("""
+            INSERT INTO runbot_host_port (host_id, port, build_id)
+            SELECT %s, port, id FROM runbot_build
+            WHERE host = %s AND local_state IN ('testing', 'running') AND port IS NOT NULL
+            ON CONFLICT (host_id, port) DO UPDATE SET build_id = EXCLUDED.build_id
+        """, [self.id, self.name])
+        self.env['runbot.host.port'].invalidate_cache()
+
+    def _add_profile(self, turns, duration, query_count, query_time, report, profile=None):
+        """ write a loop profile report in the static dir of the host, with the cProfile data if given """
+        self.ensure_one()
+        name = '%s-%s' % (self.name, time.strftime('%Y%m%d-%H%M%S'))
+        profiles_path = os.path.join(self._get_work_path(), 'profiles')
+        os.makedirs(profiles_path, exist_ok=True)
+        with open(os.path.join(profiles_path, '%s.txt' % name), 'w') as report_file:
+            report_file.write(report)
+        if profile is not None:
+            profile.dump_stats(os.path.join(profiles_path, '%s.prof' % name))
+        return self.env['runbot.host.profile'].create({
+            'name': name,
+            'host_id': self.id,
+            'turns': turns,
+            'duration': duration,
+            'query_count': query_count,
+            'query_time': query_time,
+            'summary': '\n'.join(report.splitlines()[:100]),
+        })
+
     def _get_work_path(self):
         return os.path.abspath(os.path.join(os.path.dirname(__file__), '../static'))
 
@@ -129,3 +306,48 @@ class Host(models.Model):
         nb_reserved = self.env['runbot.host'].search_count([('assigned_only', '=', True)])
         if nb_reserved < (nb_hosts / 2):
             self.assigned_only = True
+
+
+class HostPort(models.Model):
+    _name = 'runbot.host.port'
+    _description = "Host port"
+    _log_access = False
+    _order = 'host_id, port'
+
+    host_id = fields.Many2one('runbot.host', 'Host', required=True, ondelete='cascade')
+    port = fields.Integer('Port', required=True)
+    build_id = fields.Many2one('runbot.build', 'Build', index=True, ondelete='set null')
+
+    _sql_constraints = [
+        ('host_port_unique', 'unique (host_id, port)', 'A port can only be defined once per host'),
+    ]
+
+    def init(self):
+        self._cr.execute("""
+            CREATE INDEX IF NOT EXISTS runbot_host_port_free_idx
+            ON runbot_host_port (host_id, port) WHERE build_id IS NULL
+        """)
+
+
+class HostProfile(models.Model):
+    _name = 'runbot.host.profile'
+    _description = "Host loop profile"
+    _order = 'id desc'
+
+    name = fields.Char('Name', required=True)
+    host_id = fields.Many2one('runbot.host', 'Host', required=True, index=True, ondelete='cascade')
+    turns = fields.Integer('Profiled turns')
+    duration = fields.Float('Duration (s)')
+    query_count = fields.Integer('Queries')
+    query_time = fields.Float('Queries time (s)')
+    summary = fields.Text('Summary')
+    report_path = fields.Char('Report path', compute='_compute_report_urls')
+    report_url = fields.Char('Report', compute='_compute_report_urls')
+    profile_url = fields.Char('cProfile data', compute='_compute_report_urls')
+
+    def _compute_report_urls(self):
+        for profile in self:
+            profile.report_path = os.path.join(profile.host_id._get_work_path(), 'profiles', '%s.txt' % profile.name)
+            base_url = 'http://%s/runbot/static/profiles/%s' % (profile.host_id.name, profile.name)
+            profile.report_url = '%s.txt' % base_url
+            profile.profile_url = '%s.prof' % base_url
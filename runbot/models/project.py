@@ -11,6 +11,7 @@ class Project(models.Model):
     trigger_ids = fields.One2many('runbot.trigger', 'project_id', string='Triggers')
     dockerfile_id = fields.Many2one('runbot.dockerfile', index=True, help="Project Default Dockerfile")
     repo_ids = fields.One2many('runbot.repo', 'project_id', string='Repos')
+    build_share = fields.Integer('Build share', default=1, help='Weight of the project when sharing the hosts between projects with pending builds')
 
 
 class Category(models.Model):
@@ -20,3 +21,4 @@ class Category(models.Model):
     name = fields.Char("Name")
     icon = fields.Char("Font awesome icon")
     view_id = fields.Many2one('ir.ui.view', "Link template")
+    build_priority = fields.Integer('Build priority', default=0, help='Builds of a category with a higher priority are allocated first')
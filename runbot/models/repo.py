@@ -9,10 +9,14 @@ import time
 import dateutil
 import requests
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from pathlib import Path
 
 from odoo import models, fields, api
 from ..common import os, RunbotException
+from .. import metrics
+from ..git_batch import batch_check, get_comparison, set_comparison
 from odoo.exceptions import UserError
 from odoo.tools.safe_eval import safe_eval
 
@@ -25,6 +29,27 @@ def _sanitize(name):
     return name
 
 
+def _fetch_with_retries(fetch, max_tries=5):
+    """Call fetch until it succeeds, waiting longer between each try
+    Does not access the database, can be used outside of the main thread.
+    :return: tuple (success, error output of the last try, duration)
+    """
+    start = time.time()
+    try_count = 0
+    delay = 0
+    error = None
+    while try_count < max_tries:
+        time.sleep(delay)
+        try:
+            fetch()
+            return True, None, time.time() - start
+        except subprocess.CalledProcessError as e:
+            try_count += 1
+            delay = delay * 1.5 if delay else 0.5
+            error = e.output.decode()
+    return False, error, time.time() - start
+
+
 class Trigger(models.Model):
     """
     List of repo parts that must be part of the same bundle
@@ -167,13 +192,18 @@ class Remote(models.Model):
         result = list(generator)
         return result[0] if result else False
 
+    def _get_github_url(self, url):
+        """Return the api url of the remote for url, where :owner and :repo are replaced"""
+        self.ensure_one()
+        url = url.replace(':owner', self.owner)
+        url = url.replace(':repo', self.repo_name)
+        return f'https://api.{self.repo_domain}{url}'
+
     def _github_generator(self, url, payload=None, ignore_errors=False, nb_tries=2, recursive=False):
         """Return a http request to be sent to github"""
         for remote in self:
             if remote.owner and remote.repo_name and remote.repo_domain:
-                url = url.replace(':owner', remote.owner)
-                url = url.replace(':repo', remote.repo_name)
-                url = f'https://api.{remote.repo_domain}{url}'
+                url = remote._get_github_url(url)
                 session = requests.Session()
                 if remote.token:
                     session.auth = (remote.token, 'x-oauth-basic')
@@ -184,6 +214,7 @@ class Remote(models.Model):
                     try_count = 0
                     while try_count < nb_tries:
                         try:
+                            metrics.inc('runbot_github_requests_total', method='post' if payload else 'get')
                             if payload:
                                 response = session.post(url, data=json.dumps(payload))
                             else:
@@ -252,6 +283,7 @@ class Repo(models.Model):
     single_version = fields.Many2one('runbot.version', "Single version", help="Limit the repo to a single version for non versionned repo")
     forbidden_regex = fields.Char('Forbidden regex', help="Regex that forid bundle creation if branch name is matching", tracking=True)
     invalid_branch_message = fields.Char('Forbidden branch message', tracking=True)
+    fetch_duration = fields.Float('Last fetch duration', readonly=True, help="Duration of the last fetch in seconds, including retries")
 
     def _compute_get_ref_time(self):
         self.env.cr.execute("""
@@ -307,8 +339,8 @@ class Repo(models.Model):
         for repo in self:
             repo.path = os.path.join(root, 'repo', _sanitize(repo.name))
 
-    def _git(self, cmd, errors='strict'):
-        """Execute a git command 'cmd'"""
+    def _git_command(self, cmd):
+        """Return the full command line to execute git command 'cmd' on this repo"""
         self.ensure_one()
         config_args = []
         if self.identity_file:
@@ -316,7 +348,11 @@ class Repo(models.Model):
                 '-c',
                 f'core.sshCommand=ssh -i {str(Path.home())}/.ssh/{self.identity_file}',
             ]
-        cmd = ['git', '-C', self.path] + config_args + cmd
+        return ['git', '-C', self.path] + config_args + cmd
+
+    def _git(self, cmd, errors='strict'):
+        """Execute a git command 'cmd'"""
+        cmd = self._git_command(cmd)
         _logger.info("git command: %s", ' '.join(cmd))
         return subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode(errors=errors)
 
@@ -340,11 +376,55 @@ class Repo(models.Model):
     def _hash_exists(self, commit_hash):
         """ Verify that a commit hash exists in the repo """
         self.ensure_one()
+        return commit_hash in self._hashes_exist([commit_hash])
+
+    def _hashes_exist(self, commit_hashes):
+        """ Return the subset of commit_hashes existing in the repo, checked by a long lived git process """
+        self.ensure_one()
         try:
-            self._git(['cat-file', '-e', commit_hash])
-        except subprocess.CalledProcessError:
-            return False
-        return True
+            return batch_check(self.path).exist(commit_hashes)
+        except Exception as e:
+            _logger.warning('git cat-file --batch-check failed for repo %s (%s), checking hashes one by one', self.name, e)
+        existing = set()
+        for commit_hash in commit_hashes:
+            try:
+                self._git(['cat-file', '-e', commit_hash])
+                existing.add(commit_hash)
+            except subprocess.CalledProcessError:
+                pass
+        return existing
+
+    def _compare_commits(self, sha, base_sha):
+        """
+        Return the merge base of sha and base_sha, the number of commits ahead and behind
+        base_sha and the stats of the diff between the merge base and sha.
+        The result only depends on the two shas and is memoised.
+        """
+        self.ensure_one()
+        if comparison := get_comparison(self.path, sha, base_sha):
+            return comparison
+        merge_base_sha = self._git(['merge-base', sha, base_sha]).strip()
+        ahead, behind = self._git(['rev-list', '--left-right', '--count', f'{sha}...{base_sha}']).strip().split('\t')
+        comparison = {
+            'merge_base': merge_base_sha,
+            'base_ahead': int(ahead),
+            'base_behind': int(behind),
+            'file_changed': 0,
+            'diff_add': 0,
+            'diff_remove': 0,
+        }
+        if merge_base_sha != sha:
+            if diff := self._git(['diff', '--numstat', merge_base_sha, sha]).strip():
+                for line in diff.split('\n'):
+                    comparison['file_changed'] += 1
+                    add, remove, _ = line.split(None, 2)
+                    try:
+                        comparison['diff_add'] += int(add)
+                        comparison['diff_remove'] += int(remove)
+                    except ValueError:  # binary files
+                        pass
+        set_comparison(self.path, sha, base_sha, comparison)
+        return comparison
 
     def _is_branch_forbidden(self, branch_name):
         self.ensure_one()
@@ -361,6 +441,7 @@ class Repo(models.Model):
 
     def _get_refs(self, max_age=30, ignore=None):
         """Find new refs
+        Only the refs that changed since the last committed snapshot are returned.
         :return: list of tuples with following refs informations:
         name, sha, date, author, author_email, subject, committer, committer_email
         """
@@ -379,15 +460,49 @@ class Repo(models.Model):
                 if not git_refs:
                     return []
                 refs = [tuple(line.split('\x00')) for line in git_refs.split('\n')]
-                refs = [r for r in refs if dateutil.parser.parse(r[2][:19]) + datetime.timedelta(days=max_age) > datetime.datetime.now() or self.env['runbot.branch'].match_is_base(r[0].split('\n')[-1])]
+                existing_ref_names = {r[0] for r in refs}
+                snapshot = self._read_ref_snapshot()
+                refs = [r for r in refs if snapshot.get(r[0]) != r[1]]
                 if ignore:
                     refs = [r for r in refs if r[0].split('/')[-1] not in ignore]
+                # iso dates can be compared as strings, no need to parse them
+                min_date = (datetime.datetime.now() - datetime.timedelta(days=max_age)).strftime('%Y-%m-%d %H:%M:%S')
+                refs = [r for r in refs if r[2][:19] > min_date or self.env['runbot.branch'].match_is_base(r[0].split('\n')[-1])]
+                # only the returned refs are recorded, the ones skipped in this turn are considered again in the next ones.
+                # the snapshot is only replaced if the refs are successfully processed
+                new_snapshot = {ref_name: sha for ref_name, sha in snapshot.items() if ref_name in existing_ref_names}
+                new_snapshot.update({r[0]: r[1] for r in refs})
+                self._cr.after('commit', partial(self._write_ref_snapshot, self._get_ref_snapshot_path(), new_snapshot))
                 return refs
             except Exception:
                 _logger.exception('Fail to get refs for repo %s', self.name)
                 self.env['runbot.runbot'].warning('Fail to get refs for repo %s', self.name)
         return []
 
+    def _get_ref_snapshot_path(self):
+        self.ensure_one()
+        return os.path.join(self.path, 'runbot_refs.json')
+
+    def _read_ref_snapshot(self):
+        """ Return the {refname: sha} dict of the refs processed during the last committed update.
+        Removing the snapshot file forces a full scan of the refs.
+        """
+        try:
+            with open(self._get_ref_snapshot_path()) as snapshot_file:
+                return json.load(snapshot_file)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _write_ref_snapshot(path, snapshot):
+        try:
+            tmp_path = f'{path}.tmp'
+            with open(tmp_path, 'w') as snapshot_file:
+                json.dump(snapshot, snapshot_file)
+            os.replace(tmp_path, path)
+        except OSError:
+            _logger.exception('Fail to write ref snapshot %s', path)
+
     def _find_or_create_branches(self, refs):
         """Parse refs and create branches that does not exists yet
         :param refs: list of tuples returned by _get_refs()
@@ -475,13 +590,42 @@ class Repo(models.Model):
         updated = False
         for repo in self:
             if repo.remote_ids and self._update(poll_delay=30 if force else 60*5):
-                max_age = int(self.env['ir.config_parameter'].get_param('runbot.runbot_max_age', default=30))
-                ref = repo._get_refs(max_age, ignore=ignore)
-                ref_branches = repo._find_or_create_branches(ref)
-                repo._find_new_commits(ref, ref_branches)
+                repo._update_refs(ignore=ignore)
                 updated = True
         return updated
 
+    def _update_refs(self, ignore=None):
+        """ Create branches and commits for the refs of an up to date repo"""
+        self.ensure_one()
+        max_age = int(self.env['ir.config_parameter'].get_param('runbot.runbot_max_age', default=30))
+        ref = self._get_refs(max_age, ignore=ignore)
+        ref_branches = self._find_or_create_branches(ref)
+        self._find_new_commits(ref, ref_branches)
+
+    def _update_concurrently(self, force=False, max_workers=4):
+        """ Fetch repos in a pool of threads and yield each repo as soon as its fetch succeeded.
+        Only the git processes are running in the threads, the database is only
+        accessed by the caller, meaning that it is safe to commit between two iterations.
+        """
+        poll_delay = 30 if force else 60*5
+        fetches = {}
+        for repo in self.filtered('remote_ids'):
+            try:
+                if repo._need_update(poll_delay=poll_delay):
+                    _logger.info('Updating repo %s', repo.name)
+                    fetches[repo] = repo._get_fetch()
+            except Exception:
+                _logger.exception('Fail to update repo %s', repo.name)
+        if not fetches:
+            return
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='runbot-fetch') as executor:
+            futures = {executor.submit(_fetch_with_retries, fetch): repo for repo, fetch in fetches.items()}
+            for future in as_completed(futures):
+                repo = futures[future]
+                if repo._fetch_done(*future.result()):
+                    yield repo
+
     def _update_git_config(self):
         """ Update repo git config file """
         for repo in self:
@@ -511,8 +655,8 @@ class Repo(models.Model):
             self._update_git_config()
             return True
 
-    def _update_git(self, force=False, poll_delay=5*60):
-        """ Update the git repo on FS """
+    def _need_update(self, force=False, poll_delay=5*60):
+        """ Check if the git repo on FS needs to be fetched, initialize it if needed"""
         self.ensure_one()
         repo = self
         if not repo.remote_ids:
@@ -530,33 +674,49 @@ class Repo(models.Model):
                 repo.last_processed_hook_time = repo.hook_time
             if repo.mode == 'poll' and (time.time() < fetch_time + poll_delay):
                 return False
+        return True
 
-        _logger.info('Updating repo %s', repo.name)
+    def _update_git(self, force=False, poll_delay=5*60):
+        """ Update the git repo on FS """
+        self.ensure_one()
+        if not self._need_update(force, poll_delay):
+            return False
+        _logger.info('Updating repo %s', self.name)
         return self._update_fetch_cmd()
 
     def _update_fetch_cmd(self):
         # Extracted from update_git to be easily overriden in external module
         self.ensure_one()
-        try_count = 0
-        success = False
-        delay = 0
-        while not success and try_count < 5:
-            time.sleep(delay)
-            try:
-                self._git(['fetch', '-p', '--all', ])
-                success = True
-            except subprocess.CalledProcessError as e:
-                try_count += 1
-                delay = delay * 1.5 if delay else 0.5
-                if try_count > 4:
-                    message = f'Failed to fetch repo {self.name}: {e.output.decode()}'
-                    host = self.env['runbot.host']._get_current()
-                    host.message_post(body=message)
-                    self.env['runbot.runbot'].warning(
-                        f'Host {host.name} got reserved because of fetch failure'
-                    )
-                    _logger.exception(message)
-                    host.disable()
+        return self._fetch_done(*_fetch_with_retries(self._get_fetch()))
+
+    def _get_fetch(self):
+        """ Return a callable fetching the repo, used by _update_fetch_cmd and _update_concurrently.
+        The callable does not access the database so that it can be called in a fetch thread,
+        override this method in external modules to change how repos are fetched.
+        """
+        self.ensure_one()
+        cmd = self._git_command(['fetch', '-p', '--all'])
+
+        def fetch():
+            _logger.info("git command: %s", ' '.join(cmd))
+            return subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        return fetch
+
+    def _fetch_done(self, success, error, duration):
+        """ Record the fetch duration and disable the host if the fetch failed"""
+        self.ensure_one()
+        self.fetch_duration = duration
+        metrics.observe('runbot_fetch_seconds', duration, repo=self.name)
+        if not success:
+            metrics.inc('runbot_fetch_failures_total', repo=self.name)
+            message = f'Failed to fetch repo {self.name}: {error}'
+            host = self.env['runbot.host']._get_current()
+            host.message_post(body=message)
+            self.env['runbot.runbot'].warning(
+                f'Host {host.name} got reserved because of fetch failure'
+            )
+            _logger.error(message)
+            host.disable()
         return success
 
     def _update(self, force=False, poll_delay=5*60):
@@ -27,9 +27,53 @@ class ResConfigSettings(models.TransientModel):
 
     runbot_db_gc_days = fields.Integer('Days before gc', default=30, config_parameter='runbot.db_gc_days')
     runbot_db_gc_days_child = fields.Integer('Days before gc of child', default=15, config_parameter='runbot.db_gc_days_child')
+    runbot_db_template_max_size = fields.Integer('Db templates max size (MB)', default=10240, config_parameter='runbot.runbot_db_template_max_size',
+                                                 help='Least recently used database templates are dropped above this size')
+    runbot_db_template_max_age = fields.Integer('Days before db templates gc', default=2, config_parameter='runbot.runbot_db_template_max_age')
+    runbot_gc_high_watermark = fields.Integer('Disk usage high watermark (%)', default=0, config_parameter='runbot.runbot_gc_high_watermark',
+                                              help='Evict sources, databases and workspaces of done builds above this disk usage, 0 to disable')
+    runbot_gc_low_watermark = fields.Integer('Disk usage low watermark (%)', config_parameter='runbot.runbot_gc_low_watermark',
+                                             help='Stop evicting below this disk usage, defaults to 10% below the high watermark')
+    runbot_gc_batch_size = fields.Integer('Eviction batch size', default=10, config_parameter='runbot.runbot_gc_batch_size')
+    runbot_gc_pg_path = fields.Char('Postgres data path', config_parameter='runbot.runbot_gc_pg_path',
+                                    help='Also monitor the disk usage of this path, e.g. the postgres data directory when on another disk')
     runbot_full_gc_days = fields.Integer('Days before directory removal', default=365, config_parameter='runbot.full_gc_days',
                                          help='Counting from the db removal date')
 
+    runbot_status_outbox = fields.Boolean('Github status outbox', config_parameter='runbot.runbot_status_outbox',
+                                          help='Queue the commit statuses and send them in a background thread of the leader, only sending the last status of a commit context')
+    runbot_status_workers = fields.Integer('Parallel status requests', default=4, config_parameter='runbot.runbot_status_workers')
+    runbot_fetch_workers = fields.Integer('Parallel fetches', default=1, config_parameter='runbot.runbot_fetch_workers',
+                                          help='Number of repos fetched at the same time, 1 to fetch them sequentially')
+    runbot_export_hardlink = fields.Boolean('Incremental exports', config_parameter='runbot.runbot_export_hardlink',
+                                            help='Export sources by hardlinking a previous export and only extracting changed files')
+    runbot_prefetch_workers = fields.Integer('Prefetch workers', default=0, config_parameter='runbot.runbot_prefetch_workers',
+                                             help='Number of threads exporting in background the sources of pending builds, 0 to disable')
+    runbot_locality_allocation = fields.Boolean('Locality aware allocation', config_parameter='runbot.runbot_locality_allocation',
+                                                help='Hosts take first the pending builds whose sources, docker image, restore dump or parent build are already on the host')
+    runbot_fair_queue = fields.Boolean('Fair share allocation', config_parameter='runbot.runbot_fair_queue',
+                                       help='Hosts take first the pending builds with the highest priority, then share the slots between projects and bundles')
+    runbot_queue_window = fields.Integer('Queue window', default=500, config_parameter='runbot.runbot_queue_window',
+                                         help='Number of pending builds, by priority, considered for a fair share allocation')
+    runbot_shortest_job_first = fields.Boolean('Shortest builds first', config_parameter='runbot.runbot_shortest_job_first',
+                                               help='Hosts take first the pending builds with the shortest estimated duration')
+    runbot_allocation_max_wait = fields.Integer('Allocation max wait (s)', default=300, config_parameter='runbot.runbot_allocation_max_wait',
+                                                help='Pending builds older than this are allocated first, whatever their locality or priority')
+    runbot_duration_samples = fields.Integer('Duration samples', default=20, config_parameter='runbot.runbot_duration_samples',
+                                             help='Number of previous durations kept to estimate the duration of a step')
+    runbot_duration_warning = fields.Boolean('Warn on long steps', config_parameter='runbot.runbot_duration_warning',
+                                             help='Log a warning when a step takes longer than 95% of its previous durations')
+    runbot_metrics_interval = fields.Integer('Metrics save interval (s)', default=30, config_parameter='runbot.runbot_metrics_interval',
+                                             help='Interval between two saves of the loop metrics of a host, exposed on /runbot/metrics, 0 to disable')
+    runbot_metrics_token = fields.Char('Metrics token', config_parameter='runbot.runbot_metrics_token',
+                                       help='If set, /runbot/metrics requires this value as token parameter')
+    runbot_profile_turns = fields.Integer('Profiled turns', default=10, config_parameter='runbot.runbot_profile_turns',
+                                          help='Number of consecutive loop turns profiled when asked from the host form or with SIGUSR1')
+    runbot_docker_build_workers = fields.Integer('Parallel docker builds', default=1, config_parameter='runbot.runbot_docker_build_workers',
+                                                 help='Number of docker images built at the same time')
+    runbot_docker_build_background = fields.Boolean('Background docker builds', config_parameter='runbot.runbot_docker_build_background',
+                                                    help='Build docker images without blocking the scheduler, builds needing an image being built wait for it')
+
     runbot_pending_warning = fields.Integer('Pending warning limit', default=5, config_parameter='runbot.pending.warning')
     runbot_pending_critical = fields.Integer('Pending critical limit', default=5, config_parameter='runbot.pending.critical')
 
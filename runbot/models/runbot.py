@@ -7,19 +7,53 @@ import signal
 import subprocess
 import shutil
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from requests.exceptions import HTTPError
 
-from ..common import fqdn, dest_reg, os
-from ..container import docker_ps, docker_stop
+from ..common import fqdn, dest_reg, os, gc_pending, gc_submit, list_local_dbs, rmtree_background
+from ..container import docker_ps, docker_stop, container_watcher
+from .. import metrics
 
-from odoo import models, fields
+from odoo import models, fields, api, registry, SUPERUSER_ID
 from odoo.osv import expression
 from odoo.tools import config
 from odoo.modules.module import get_module_resource
 
 _logger = logging.getLogger(__name__)
 
+_prefetch_executor = None
+_prefetching = {}  # commit id: future of the background export
+_status_executor = None
+_status_sending = None  # future of the background delivery of the status outbox
+_gc_pressure = False  # disk usage went above the high watermark and not yet below the low one
+_nginx_state = {}  # nginx dir: signature of the config and running builds written by this process
+
+
+def _prefetch_commit(dbname, commit_id):
+    """Export the sources of a commit using a dedicated cursor, called in a prefetch thread"""
+    try:
+        with api.Environment.manage(), registry(dbname).cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            commit = env['runbot.commit'].browse(commit_id)
+            # fetching a missing commit is left to the scheduler, it can disable the host or update the repo
+            if not all(c.repo_id._hash_exists(c.name) for c in commit | commit.rebase_on_id):
+                return
+            commit.export()
+    except Exception:
+        _logger.exception('Failed to prefetch sources of commit %s', commit_id)
+
+
+def _send_status_outbox(dbname, max_workers):
+    """Send the pending commit statuses using a dedicated cursor, called in the status thread"""
+    try:
+        with api.Environment.manage(), registry(dbname).cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            env['runbot.commit.status']._send_pending(max_workers=max_workers)
+    except Exception:
+        _logger.exception('Failed to send pending commit statuses')
+
 # after this point, not realy a repo buisness
 class Runbot(models.AbstractModel):
     _name = 'runbot.runbot'
@@ -36,25 +70,148 @@ class Runbot(models.AbstractModel):
         return os.path.abspath(default)
 
     def _scheduler(self, host):
+        if self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_batched_scheduler'):
+            return self._scheduler_batched(host)
         self._gc_testing(host)
         self._commit()
         for build in self._get_builds_with_requested_actions(host):
             build._process_requested_actions()
             self._commit()
         for build in self._get_builds_to_schedule(host):
-            build._schedule()
+            with build._buffered_logs():
+                build._schedule()
             self._commit()
         self._assign_pending_builds(host, host.nb_worker, [('build_type', '!=', 'scheduled')])
         self._commit()
         self._assign_pending_builds(host, host.nb_worker-1 or host.nb_worker)
         self._commit()
+        self._prefetch_sources(host)
         for build in self._get_builds_to_init(host):
-            build._init_pendings(host)
+            with build._buffered_logs():
+                build._init_pendings(host)
             self._commit()
         self._gc_running(host)
         self._commit()
         self._reload_nginx()
 
+    @contextmanager
+    def _timed_phase(self, timings, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            timings[phase] = timings.get(phase, 0) + duration
+            metrics.observe('runbot_scheduler_phase_seconds', duration, phase=phase)
+
+    def _get_host_working_set(self, host):
+        """
+        Select in one query all builds of the host the scheduler can act on,
+        with the fields used by the scheduler phases.
+        """
+        builds = self.env['runbot.build'].search(self.build_domain_host(host, [
+            '|',
+            ('local_state', 'in', ('pending', 'testing', 'running')),
+            ('requested_action', 'in', ('wake_up', 'deathrow')),
+        ]))
+        return self._read_working_set(builds)
+
+    def _read_working_set(self, builds):
+        """ Read in one query the fields used by the scheduler phases """
+        builds = builds.exists()
+        builds.read(['local_state', 'requested_action', 'killable', 'keep_running', 'job_start', 'active_step', 'parent_path'])
+        builds.mapped('active_step.job_type')
+        return builds
+
+    def _commit_working_set(self, builds):
+        """ Commit the phase, the cache being cleared by the commit the working set is read again """
+        self._commit()
+        return self._read_working_set(builds)
+
+    def _scheduler_batched(self, host):
+        """
+        Same phases as _scheduler, evaluated on a working set selected once per turn.
+        Changes are committed once per phase, except for builds woken up, killed,
+        or changing state while scheduled or initialized since a docker may have been
+        started or stopped for them. Since a commit clears the cache, the fields of the
+        working set are read again in one query after each phase.
+        """
+        timings = {}
+        Build = self.env['runbot.build']
+
+        with self._timed_phase(timings, 'load'):
+            builds = self._get_host_working_set(host)
+
+        with self._timed_phase(timings, 'gc_testing'):
+            testing_builds = builds.filtered(lambda b: b.local_state in ('testing', 'pending') and b.requested_action != 'deathrow')
+            if len(testing_builds) >= host.nb_worker and Build.search_count([('local_state', '=', 'pending'), ('host', '=', False)]):
+                for build in testing_builds:
+                    if build.killable:
+                        build.top_parent._ask_kill(message='Build automatically killed, new build found.')
+            builds = self._commit_working_set(builds)
+
+        with self._timed_phase(timings, 'requested_actions'):
+            # wake up starts a docker, each build is committed to keep its state consistent with its container
+            if requested := builds.filtered(lambda b: b.requested_action in ('wake_up', 'deathrow')):
+                for build in requested:
+                    build._process_requested_actions()
+                    self._commit()
+                builds = self._read_working_set(builds)
+
+        with self._timed_phase(timings, 'schedule'):
+            for build in builds.filtered(lambda b: b.local_state in ('testing', 'running')):
+                state = (build.local_state, build.active_step.id)
+                with build._buffered_logs():
+                    build._schedule()
+                if (build.local_state, build.active_step.id) != state:
+                    self._commit()
+            builds = self._commit_working_set(builds)
+
+        with self._timed_phase(timings, 'assign'):
+            for nb_worker, domain in (
+                (host.nb_worker, [('build_type', '!=', 'scheduled')]),
+                (host.nb_worker - 1 or host.nb_worker, None),
+            ):
+                if host.assigned_only or nb_worker <= 0:
+                    break
+                reserved_slots = len(builds.filtered(lambda b: b.local_state in ('testing', 'pending')))
+                if allocated := self._allocate_builds(host, nb_worker - reserved_slots, domain):
+                    _logger.info('Builds %s where allocated to runbot', allocated)
+                    builds |= Build.browse([build_id for build_id, in allocated])
+            builds = self._commit_working_set(builds)
+
+        with self._timed_phase(timings, 'prefetch'):
+            self._prefetch_sources(host)
+
+        with self._timed_phase(timings, 'init'):
+            available_slots = host.nb_worker - len(builds.filtered(lambda b: b.local_state == 'testing'))
+            if available_slots > 0:
+                pendings = self._filter_initializable(host, builds.filtered(lambda b: b.local_state == 'pending')).sorted('id', reverse=True)
+                for build in pendings[:available_slots]:
+                    with build._buffered_logs():
+                        build._init_pendings(host)
+                    self._commit()
+                builds = self._read_working_set(builds)
+
+        with self._timed_phase(timings, 'gc_running'):
+            running_max = host.get_running_max()
+            cannot_be_killed = builds.filtered('keep_running')
+            sticky_bundles = self.env['runbot.bundle'].search([('sticky', '=', True), ('project_id.keep_sticky_running', '=', True)])
+            cannot_be_killed |= sticky_bundles.mapped('last_batchs.slot_ids.build_id').filtered(lambda b: b.host == host.name)[:running_max]
+            running = (builds - cannot_be_killed).filtered(lambda b: b.local_state == 'running').sorted('job_start', reverse=True)
+            running[running_max:]._kill()
+            self._commit()
+
+        with self._timed_phase(timings, 'nginx'):
+            self._reload_nginx()
+
+        _logger.info(
+            'Scheduler turn on %s builds: %s',
+            len(builds),
+            ', '.join(f'{phase} {duration:.3f}s' for phase, duration in timings.items()),
+        )
+        return timings
+
     def build_domain_host(self, host, domain=None):
         domain = domain or []
         return [('host', '=', host.name)] + domain
@@ -81,7 +238,56 @@ class Runbot(models.AbstractModel):
         available_slots = host.nb_worker - used_slots
         if available_slots <= 0:
             return self.env['runbot.build']
-        return self.env['runbot.build'].search(domain_host + [('local_state', '=', 'pending')], limit=available_slots)
+        if not self._get_prefetching_commit_ids() and not host._get_building_image_tags():
+            return self.env['runbot.build'].search(domain_host + [('local_state', '=', 'pending')], limit=available_slots)
+        pendings = self.env['runbot.build'].search(domain_host + [('local_state', '=', 'pending')])
+        return self._filter_initializable(host, pendings)[:available_slots]
+
+    def _filter_initializable(self, host, builds):
+        """
+        Remove builds waiting for background work, sources still exported
+        or docker image still built, they are initialized on a next turn
+        """
+        prefetching = self._get_prefetching_commit_ids()
+        building = host._get_building_image_tags()
+        if not prefetching and not building:
+            return builds
+        return builds.filtered(
+            lambda build: not prefetching & set(build.params_id.commit_ids.ids)
+            and build.params_id.dockerfile_id.image_tag not in building
+        )
+
+    def _get_prefetching_commit_ids(self):
+        for commit_id, future in list(_prefetching.items()):
+            if future.done():
+                del _prefetching[commit_id]
+        return set(_prefetching)
+
+    def _prefetch_sources(self, host):
+        """Export in background the sources of the builds assigned to the host and waiting for a slot"""
+        global _prefetch_executor
+        nb_workers = int(self.env['ir.config_parameter'].get_param('runbot.runbot_prefetch_workers', default=0))
+        if nb_workers <= 0:
+            return
+        if _prefetch_executor is None:
+            _prefetch_executor = ThreadPoolExecutor(max_workers=nb_workers, thread_name_prefix='runbot-prefetch')
+        prefetching = self._get_prefetching_commit_ids()
+        pendings = self.env['runbot.build'].search(self.build_domain_host(host, [('local_state', '=', 'pending')]))
+        for commit in pendings.mapped('params_id.commit_ids'):
+            if commit.id not in prefetching and not os.path.isdir(commit._source_path()):
+                _logger.info('Prefetching sources of %s', commit.dname)
+                _prefetching[commit.id] = _prefetch_executor.submit(_prefetch_commit, self.env.cr.dbname, commit.id)
+
+    def _send_status_outbox(self):
+        """Send in background the statuses of the outbox, github latency does not slow down the fetch loop.
+        A new delivery is only started once the previous one is done, the statuses created in between are sent together."""
+        global _status_executor, _status_sending
+        if _status_sending and not _status_sending.done():
+            return
+        if _status_executor is None:
+            _status_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='runbot-status-outbox')
+        status_workers = int(self.env['ir.config_parameter'].get_param('runbot.runbot_status_workers', default=4))
+        _status_sending = _status_executor.submit(_send_status_outbox, self.env.cr.dbname, status_workers)
 
     def _gc_running(self, host):
         running_max = host.get_running_max()
@@ -123,6 +329,32 @@ class Runbot(models.AbstractModel):
         assert e.get_tables() == ['"runbot_build"']
         where_clause, where_params = e.to_sql()
 
+        icp = self.env['ir.config_parameter']
+        locality = icp.get_param('runbot.runbot_locality_allocation')
+        fair_queue = icp.get_param('runbot.runbot_fair_queue')
+        shortest_first = icp.get_param('runbot.runbot_shortest_job_first')
+        from_clause, from_params = 'runbot_build', []
+        order_terms, order_params = [], []
+        if locality or fair_queue or shortest_first:
+            # builds pending for too long are taken first, so that no build can starve
+            max_wait = int(icp.get_param('runbot.runbot_allocation_max_wait', default=300))
+            order_terms.append("CASE WHEN runbot_build.create_date < (now() at time zone 'utc') - %s * interval '1 second' THEN 0 ELSE 1 END")
+            order_params.append(max_wait)
+            if fair_queue:
+                from_clause, from_params = self._get_queue_window(where_clause, where_params, max_wait, nb_slots)
+                term, params = self._get_fair_share_order()
+                order_terms.append(term)
+                order_params += params
+            if shortest_first:
+                # short builds are packed in the slots left by the long ones
+                self.env['runbot.build'].flush(['estimated_duration'])
+                order_terms.append('runbot_build.estimated_duration ASC')
+            if locality:
+                term, params = self._get_locality_order(host)
+                order_terms.append(term)
+                order_params += params
+        order_terms.append('runbot_build.parent_path')
+
         # self-assign to be sure that another runbot batch cannot self assign the same builds
         query = """UPDATE
                         runbot_build
@@ -131,23 +363,123 @@ class Runbot(models.AbstractModel):
                     WHERE
                         runbot_build.id IN (
                             SELECT runbot_build.id
-                            FROM runbot_build
+                            FROM %s
                             WHERE
                                 %s
                             ORDER BY
-                                parent_path
+                                %s
                             FOR UPDATE OF runbot_build SKIP LOCKED
                             LIMIT %%s
                         )
-                    RETURNING id""" % where_clause
-        self.env.cr.execute(query, [host.name] + where_params + [nb_slots])
+                    RETURNING id""" % (from_clause, where_clause, ', '.join(order_terms))
+        self.env.cr.execute(query, [host.name] + from_params + where_params + order_params + [nb_slots])
         return self.env.cr.fetchall()
 
+    def _get_queue_window(self, where_clause, where_params, max_wait, nb_slots):
+        """
+        Return a FROM clause and its parameters restricting the allocation to the
+        head of the pending queue: the runbot_queue_window builds with the highest
+        priority and the oldest builds pending for more than max_wait seconds.
+        Both are read from the partial indexes on the pending builds.
+        """
+        window = int(self.env['ir.config_parameter'].get_param('runbot.runbot_queue_window', default=500))
+        from_clause = """runbot_build
+                            JOIN (
+                                (
+                                    SELECT runbot_build.id FROM runbot_build
+                                    WHERE %s
+                                    ORDER BY runbot_build.queue_priority DESC, runbot_build.parent_path
+                                    LIMIT %%s
+                                ) UNION (
+                                    SELECT runbot_build.id FROM runbot_build
+                                    WHERE %s AND runbot_build.create_date < (now() at time zone 'utc') - %%s * interval '1 second'
+                                    ORDER BY runbot_build.create_date
+                                    LIMIT %%s
+                                )
+                            ) queue ON queue.id = runbot_build.id""" % (where_clause, where_clause)
+        return from_clause, where_params + [window] + where_params + [max_wait, nb_slots]
+
+    def _get_fair_share_order(self):
+        """
+        Return ORDER BY terms and their parameters taking the builds by priority,
+        then sharing the hosts between projects, weighted by their build_share,
+        and between the bundles of a project: the builds of the project and bundle
+        with the fewest allocated builds are taken first.
+        """
+        self.env['runbot.build'].flush(['queue_priority', 'queue_bundle_id', 'host', 'local_state'])
+        self.env['runbot.project'].flush(['build_share'])
+        order_by = """
+            runbot_build.queue_priority DESC,
+            (
+                SELECT (
+                    SELECT count(*)
+                    FROM runbot_build allocated
+                    JOIN runbot_build_params allocated_params ON allocated_params.id = allocated.params_id
+                    WHERE allocated_params.project_id = params.project_id
+                    AND allocated.local_state IN ('pending', 'testing') AND allocated.host IS NOT NULL
+                )::float / GREATEST(project.build_share, 1)
+                FROM runbot_build_params params
+                JOIN runbot_project project ON project.id = params.project_id
+                WHERE params.id = runbot_build.params_id
+            ) ASC,
+            (
+                SELECT count(*)
+                FROM runbot_build allocated
+                WHERE allocated.queue_bundle_id = runbot_build.queue_bundle_id
+                AND allocated.local_state IN ('pending', 'testing') AND allocated.host IS NOT NULL
+            ) ASC"""
+        return order_by, []
+
+    def _get_locality_order(self, host):
+        """
+        Return an ORDER BY term and its parameters preferring the pending builds
+        that are cheap to start on host: exported sources, docker image, cached
+        restore dump and parent build on the same host.
+        """
+        host._report_locality()
+        self.env['runbot.host'].flush(['exported_commit_ids', 'dockerfile_ids'])
+        order_by = """
+            (
+                SELECT count(*)
+                FROM runbot_build_params_runbot_commit_link_rel rel
+                JOIN runbot_commit_link link ON link.id = rel.runbot_commit_link_id
+                JOIN runbot_host_exported_commit_rel exported ON exported.runbot_commit_id = link.commit_id AND exported.runbot_host_id = %s
+                WHERE rel.runbot_build_params_id = runbot_build.params_id
+            ) + (
+                SELECT
+                    CASE WHEN EXISTS (
+                        SELECT 1 FROM runbot_host_dockerfile_rel image
+                        WHERE image.runbot_dockerfile_id = params.dockerfile_id AND image.runbot_host_id = %s
+                    ) THEN 2 ELSE 0 END
+                    + CASE WHEN EXISTS (
+                        SELECT 1 FROM runbot_db_template template
+                        WHERE template.database_id = params.dump_db AND template.host_id = %s AND template.state = 'done'
+                    ) THEN 2 ELSE 0 END
+                FROM runbot_build_params params
+                WHERE params.id = runbot_build.params_id
+            ) + (
+                CASE WHEN EXISTS (
+                    SELECT 1 FROM runbot_build parent
+                    WHERE parent.id = runbot_build.parent_id AND parent.host = %s
+                ) THEN 1 ELSE 0 END
+            ) DESC"""
+        return order_by, [host.id, host.id, host.id, host.name]
+
     def _domain(self):
         return self.env.get('ir.config_parameter').sudo().get_param('runbot.runbot_domain', fqdn())
 
     def _reload_nginx(self):
+        """
+        Update the nginx config of the host and reload nginx if needed.
+        Each running build has its own file included by the main config, only the files
+        of the builds that started or stopped are written. The running builds of the last
+        call are kept in memory, nothing is rendered when they did not change.
+        :return: True if the config changed
+        """
         env = self.env
+        icp = env['ir.config_parameter'].sudo()
+        if not icp.get_param('runbot.runbot_nginx', True):
+            return False
         settings = {'port': config.get('http_port')}
         settings['runbot_domain'] = self._domain()
         settings['runbot_static'] = os.path.join(get_module_resource('runbot', 'static'), '')
@@ -155,35 +487,65 @@ class Runbot(models.AbstractModel):
         settings['nginx_dir'] = nginx_dir
         settings['re_escape'] = re.escape
         settings['fqdn'] = fqdn()
-
-        icp = env['ir.config_parameter'].sudo()
-        if nginx := icp.get_param('runbot.runbot_nginx', True):
-            settings['builds'] = env['runbot.build'].search([('local_state', '=', 'running'), ('host', '=', fqdn())])
-
+        nginx_conf_path = os.path.join(nginx_dir, 'nginx.conf')
+        builds_dir = os.path.join(nginx_dir, 'builds')
+
+        env['runbot.build'].flush(['local_state', 'host', 'port', 'dest'])
+        env.cr.execute("""
+            SELECT dest, id, port FROM runbot_build
+            WHERE local_state = 'running' AND host = %s
+        """, [settings['fqdn']])
+        running = {dest: (build_id, port) for dest, build_id, port in env.cr.fetchall()}
+        main_signature = tuple(value for key, value in sorted(settings.items()) if key != 're_escape')
+
+        state = _nginx_state.setdefault(nginx_dir, {})
+        if state.get('main') == main_signature and state.get('builds') == running and os.path.isfile(nginx_conf_path):
+            return False
+
+        changed = False
+        os.makedirs(builds_dir, exist_ok=True)
+        if state.get('main') != main_signature or not os.path.isfile(nginx_conf_path):
             nginx_config = env['ir.ui.view'].render_template("runbot.nginx_config", settings)
-            os.makedirs(nginx_dir, exist_ok=True)
-            content = None
-            nginx_conf_path = os.path.join(nginx_dir, 'nginx.conf')
-            content = ''
-            if os.path.isfile(nginx_conf_path):
-                with open(nginx_conf_path, 'rb') as f:
-                    content = f.read()
-            if content != nginx_config:
-                _logger.info('reload nginx')
-                with open(nginx_conf_path, 'wb') as f:
-                    f.write(nginx_config)
-                try:
-                    pid = int(open(os.path.join(nginx_dir, 'nginx.pid')).read().strip(' \n'))
-                    os.kill(pid, signal.SIGHUP)
-                except Exception:
-                    _logger.info('start nginx')
-                    if subprocess.call(['/usr/sbin/nginx', '-p', nginx_dir, '-c', 'nginx.conf']):
-                        # obscure nginx bug leaving orphan worker listening on nginx port
-                        if not subprocess.call(['pkill', '-f', '-P1', 'nginx: worker']):
-                            _logger.warning('failed to start nginx - orphan worker killed, retrying')
-                            subprocess.call(['/usr/sbin/nginx', '-p', nginx_dir, '-c', 'nginx.conf'])
-                        else:
-                            _logger.warning('failed to start nginx - failed to kill orphan worker - oh well')
+            changed |= self._write_nginx_file(nginx_conf_path, nginx_config)
+
+        previous = state.get('builds') if state.get('main') == main_signature else None
+        if previous is None:
+            # first call of this process or settings changed, compare with the files on disk
+            previous = {filename[:-5]: None for filename in os.listdir(builds_dir) if filename.endswith('.conf')}
+        for dest in previous.keys() - running.keys():
+            os.remove(os.path.join(builds_dir, f'{dest}.conf'))
+            changed = True
+        new_build_ids = [build_id for dest, (build_id, port) in running.items() if previous.get(dest) != (build_id, port)]
+        for build in env['runbot.build'].browse(new_build_ids):
+            build_config = env['ir.ui.view'].render_template("runbot.nginx_build_config", dict(settings, build=build))
+            changed |= self._write_nginx_file(os.path.join(builds_dir, f'{build.dest}.conf'), build_config)
+        state.update(main=main_signature, builds=running)
+
+        if changed:
+            _logger.info('reload nginx')
+            try:
+                pid = int(open(os.path.join(nginx_dir, 'nginx.pid')).read().strip(' \n'))
+                os.kill(pid, signal.SIGHUP)
+            except Exception:
+                _logger.info('start nginx')
+                if subprocess.call(['/usr/sbin/nginx', '-p', nginx_dir, '-c', 'nginx.conf']):
+                    # obscure nginx bug leaving orphan worker listening on nginx port
+                    if not subprocess.call(['pkill', '-f', '-P1', 'nginx: worker']):
+                        _logger.warning('failed to start nginx - orphan worker killed, retrying')
+                        subprocess.call(['/usr/sbin/nginx', '-p', nginx_dir, '-c', 'nginx.conf'])
+                    else:
+                        _logger.warning('failed to start nginx - failed to kill orphan worker - oh well')
+        return changed
+
+    def _write_nginx_file(self, path, content):
+        """Write content in path if it differs from the current one, return True if written"""
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                if f.read() == content:
+                    return False
+        with open(path, 'wb') as f:
+            f.write(content)
+        return True
 
     def _get_cron_period(self):
         """ Compute a randomized cron period with a 2 min margin below
@@ -235,14 +597,24 @@ class Runbot(models.AbstractModel):
         time.sleep(t)
 
     def _fetch_loop_turn(self, host, pull_info_failures, default_sleep=1):
+        start = time.time()
         with self.manage_host_exception(host) as manager:
             repos = self.env['runbot.repo'].search([('mode', '!=', 'disabled')])
             processing_batch = self.env['runbot.batch'].search([('state', 'in', ('preparing', 'ready'))], order='id asc')
             preparing_batch = processing_batch.filtered(lambda b: b.state == 'preparing')
             self._commit()
-            for repo in repos:
+            fetch_workers = int(self.env['ir.config_parameter'].get_param('runbot.runbot_fetch_workers', default=1))
+            if fetch_workers > 1:
+                # refs of each repo are processed as soon as its fetch is done, while other repos are still fetching
+                updated_repos = repos._update_concurrently(force=bool(preparing_batch), max_workers=fetch_workers)
+            else:
+                updated_repos = repos
+            for repo in updated_repos:
                 try:
-                    repo._update_batches(force=bool(preparing_batch), ignore=pull_info_failures)
+                    if fetch_workers > 1:
+                        repo._update_refs(ignore=pull_info_failures)
+                    else:
+                        repo._update_batches(force=bool(preparing_batch), ignore=pull_info_failures)
                     self._commit() # commit is mainly here to avoid to lose progression in case of fetch failure or concurrent update
                 except HTTPError as e:
                     # Sometimes a pr pull info can fail.
@@ -267,18 +639,29 @@ class Runbot(models.AbstractModel):
                         self._commit()
             self._commit()
 
+            if self.env['ir.config_parameter'].get_param('runbot.runbot_status_outbox'):
+                self._send_status_outbox()
+
             # cleanup old pull_info_failures
             for pr_number, t in pull_info_failures.items():
                 if t + 15*60 < time.time():
                     _logger.warning('Removing %s from pull_info_failures', pr_number)
                     del self.pull_info_failures[pr_number]
 
+            metrics.observe('runbot_leader_turn_seconds', time.time() - start)
+            host._save_metrics('leader')
+
         return manager.get('sleep', default_sleep)
 
     def _scheduler_loop_turn(self, host, default_sleep=1):
         _logger.info('Scheduling...')
+        container_watcher.start()  # (re)start listening to docker events if needed
         with self.manage_host_exception(host) as manager:
-            self._scheduler(host)
+            with metrics.timed('runbot_scheduler_turn_seconds'):
+                self._scheduler(host)
+                self._gc_disk_pressure(host)
+                self.env['runbot.db.template']._cleanup(host)
+            host._save_metrics('builder')
         return manager.get('sleep', default_sleep)
 
     @contextmanager
@@ -310,13 +693,7 @@ class Runbot(models.AbstractModel):
             if self.pool._init:
                 return
             _logger.info('Source cleaning')
-            # we can remove a source only if no build are using them as name or rependency_ids aka as commit
-            cannot_be_deleted_builds = self.env['runbot.build'].search([('host', '=', fqdn()), ('local_state', '!=', 'done')])
-            cannot_be_deleted_builds |= cannot_be_deleted_builds.mapped('params_id.builds_reference_ids')
-            cannot_be_deleted_path = set()
-            for build in cannot_be_deleted_builds:
-                for build_commit in build.params_id.commit_link_ids:
-                    cannot_be_deleted_path.add(build_commit.commit_id._source_path())
+            cannot_be_deleted_path = self._get_used_source_paths()
 
             to_delete = set()
             to_keep = set()
@@ -324,6 +701,8 @@ class Runbot(models.AbstractModel):
             for repo in repos:
                 repo_source = os.path.join(self._root(), 'sources', repo.name, '*')
                 for source_dir in glob.glob(repo_source):
+                    if source_dir.endswith('.tmp'):
+                        continue  # export in progress, renamed once complete
                     if source_dir not in cannot_be_deleted_path:
                         to_delete.add(source_dir)
                     else:
@@ -340,13 +719,105 @@ class Runbot(models.AbstractModel):
                 for source_dir in to_delete:
                     _logger.info(f'Deleting source: {source_dir}')
                     assert 'static' in source_dir
-                    shutil.rmtree(source_dir)
+                    rmtree_background(source_dir, os.path.join(self._root(), 'trash'))
                 _logger.info(
                     f'{len(to_delete)}/{len(to_delete + to_keep)} source folder where deleted ({len(to_keep)} kept)'
                 )
         except:
             _logger.exception('An exception occured while cleaning sources')
 
+    def _get_used_source_paths(self):
+        # we can remove a source only if no build are using them as name or rependency_ids aka as commit
+        cannot_be_deleted_builds = self.env['runbot.build'].search([('host', '=', fqdn()), ('local_state', '!=', 'done')])
+        cannot_be_deleted_builds |= cannot_be_deleted_builds.mapped('params_id.builds_reference_ids')
+        cannot_be_deleted_path = set()
+        for build in cannot_be_deleted_builds:
+            for build_commit in build.params_id.commit_link_ids:
+                cannot_be_deleted_path.add(build_commit.commit_id._source_path())
+        return cannot_be_deleted_path
+
+    def _get_disk_usage(self):
+        """ Return the highest used percentage of the monitored filesystems: static folder and postgres data if configured """
+        paths = [self._root()]
+        if pg_path := self.env['ir.config_parameter'].get_param('runbot.runbot_gc_pg_path'):
+            paths.append(pg_path)
+        usages = []
+        for path in paths:
+            usage = shutil.disk_usage(path)
+            usages.append(100 * usage.used / usage.total)
+        return max(usages)
+
+    def _gc_disk_pressure(self, host):
+        """
+        Evict least recently used sources, then databases and workspaces of done builds,
+        when the disk usage goes above the high watermark and until it goes below the low watermark.
+        Deletions are done in the background, a new batch is only evicted once the previous one is deleted.
+        """
+        global _gc_pressure
+        get_param = self.env['ir.config_parameter'].get_param
+        high_watermark = float(get_param('runbot.runbot_gc_high_watermark', default=0))
+        if not high_watermark or gc_pending():
+            return
+        low_watermark = float(get_param('runbot.runbot_gc_low_watermark', default=0)) or high_watermark - 10
+        usage = self._get_disk_usage()
+        if usage >= high_watermark:
+            _gc_pressure = True
+        elif usage <= low_watermark:
+            _gc_pressure = False
+        if not _gc_pressure:
+            return
+        batch_size = int(get_param('runbot.runbot_gc_batch_size', default=10))
+        _logger.warning('Disk usage at %.1f%%, evicting up to %s items', usage, batch_size)
+        if not self._gc_evict_sources(batch_size) and not self._gc_evict_builds(host, batch_size):
+            _logger.warning('Disk usage at %.1f%% but nothing left to evict', usage)
+
+    def _gc_evict_sources(self, limit):
+        used_paths = self._get_used_source_paths()
+        sources = [
+            source_dir
+            for source_dir in glob.glob(os.path.join(self._root(), 'sources', '*', '*'))
+            if source_dir not in used_paths and not source_dir.endswith('.tmp')
+        ]
+        sources = sorted(sources, key=os.path.getmtime)[:limit]
+        trash_dir = os.path.join(self._root(), 'trash')
+        for source_dir in sources:
+            _logger.info('Evicting source %s', source_dir)
+            rmtree_background(source_dir, trash_dir)
+        return len(sources)
+
+    def _gc_evict_builds(self, host, limit):
+        """ drop databases and remove workspaces of done builds, logs are kept """
+        Build = self.env['runbot.build']
+        builds_dir = os.path.join(self._root(), 'build')
+        dbs_by_build_id = defaultdict(list)
+        for db in list_local_dbs():
+            if dest_reg.match(db):
+                dbs_by_build_id[int(db.split('-')[0])].append(db)
+        dirs_by_build_id = defaultdict(list)
+        for dest in os.listdir(builds_dir):
+            if dest_reg.match(dest):
+                build_dir = os.path.join(builds_dir, dest)
+                workspace = [os.path.join(build_dir, f) for f in os.listdir(build_dir) if f not in ('logs', 'tests')]
+                if workspace:
+                    dirs_by_build_id[int(dest.split('-')[0])] += workspace
+        builds = Build.search([
+            ('id', 'in', list(set(dbs_by_build_id) | set(dirs_by_build_id))),
+            ('host', '=', host.name),
+            ('local_state', '=', 'done'),
+            ('requested_action', '=', False),
+        ], order='job_end asc, id asc', limit=limit)
+        trash_dir = os.path.join(self._root(), 'trash')
+        for build in builds:
+            _logger.info('Evicting databases and workspace of build %s', build.dest)
+            for db in dbs_by_build_id[build.id]:
+                gc_submit(Build._local_pg_dropdb, db)
+            for path in dirs_by_build_id[build.id]:
+                if os.path.isdir(path):
+                    rmtree_background(path, trash_dir)
+                else:
+                    os.unlink(path)
+        return len(builds)
+
     def _docker_cleanup(self):
         _logger.info('Docker cleaning')
         docker_ps_result = docker_ps()
@@ -364,6 +835,39 @@ class Runbot(models.AbstractModel):
         if ignored := {dc for dc in docker_ps_result if not dest_reg.match(dc)}:
             _logger.info('docker (%s) not deleted because not dest format', list(ignored))
 
+    def _get_metrics(self):
+        """
+        Return the metrics of all hosts and the current queue depths
+        in the Prometheus text exposition format
+        """
+        samples = []
+        for host in self.env['runbot.host'].sudo().search([]):
+            for process, values in (host.loop_metrics or {}).items():
+                for name, metric_type, labels, value in values.get('samples', []):
+                    samples.append([name, metric_type, dict(labels, host=host.name, process=process), value])
+                samples.append(['runbot_metrics_timestamp_seconds', 'gauge', {'host': host.name, 'process': process}, values.get('date', 0)])
+            samples.append(['runbot_host_workers', 'gauge', {'host': host.name}, host.nb_worker])
+            samples.append(['runbot_host_exceptions', 'gauge', {'host': host.name}, host.exception_count])
+            samples.append(['runbot_host_psql_connections', 'gauge', {'host': host.name}, host.psql_conn_count])
+            if host.last_end_loop:
+                samples.append(['runbot_host_last_end_loop_timestamp_seconds', 'gauge', {'host': host.name}, host.last_end_loop.timestamp()])
+
+        self.env.cr.execute("""
+            SELECT local_state, host IS NOT NULL, count(*), extract(epoch FROM (now() at time zone 'utc') - min(create_date))
+            FROM runbot_build
+            WHERE local_state IN ('pending', 'testing', 'running')
+            GROUP BY local_state, host IS NOT NULL
+        """)
+        for state, allocated, count, oldest in self.env.cr.fetchall():
+            labels = {'state': state, 'allocated': str(allocated).lower()}
+            samples.append(['runbot_builds', 'gauge', labels, count])
+            if state == 'pending':
+                samples.append(['runbot_pending_oldest_age_seconds', 'gauge', labels, float(oldest or 0)])
+        self.env.cr.execute("SELECT state, count(*) FROM runbot_batch WHERE state IN ('preparing', 'ready') GROUP BY state")
+        for state, count in self.env.cr.fetchall():
+            samples.append(['runbot_batches', 'gauge', {'state': state}, count])
+        return metrics.render(samples)
+
     def warning(self, message, *args):
         if args:
             message = message % args
@@ -135,8 +135,10 @@ class RunbotCase(TransactionCase):
         self.start_patcher('isfile', 'odoo.addons.runbot.common.os.path.isfile', True)
         self.start_patcher('docker_run', 'odoo.addons.runbot.container._docker_run')
         self.start_patcher('docker_build', 'odoo.addons.runbot.container._docker_build')
+        self.start_patcher('docker_image_label', 'odoo.addons.runbot.container._docker_image_label', None)
         self.start_patcher('docker_ps', 'odoo.addons.runbot.container._docker_ps', [])
         self.start_patcher('docker_stop', 'odoo.addons.runbot.container._docker_stop')
+        self.start_patcher('container_watcher_start', 'odoo.addons.runbot.container.ContainerWatcher.start', None)
         self.start_patcher('docker_get_gateway_ip', 'odoo.addons.runbot.models.build_config.docker_get_gateway_ip', None)
 
         self.start_patcher('cr_commit', 'odoo.sql_db.Cursor.commit', None)
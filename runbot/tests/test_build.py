@@ -190,6 +190,15 @@ class TestBuildResult(RunbotCase):
         with self.assertRaises(ValidationError):
             builds.write({'local_result': 'ok'})
 
+    def test_find_port(self):
+        builds = self.Build.create([{'params_id': self.base_params.id, 'host': 'host.runbot.com', 'local_state': 'testing'} for _ in range(3)])
+        self.assertEqual([build._find_port() for build in builds], [2000, 2003, 2006])
+        builds[1]._kill()
+        other_build = self.Build.create({'params_id': self.base_params.id, 'host': 'host.runbot.com', 'local_state': 'testing'})
+        self.assertEqual(other_build._find_port(), 2003, 'Released port should be reused')
+        self.assertEqual(builds[2]._find_port(), 2006, 'Build port should be released before a new allocation')
+        self.assertEqual(self.Build.create({'params_id': self.base_params.id})._find_port(), 2009)
+
     def test_markdown_description(self):
         build = self.Build.create({
             'params_id': self.server_params.id,
@@ -195,6 +195,133 @@ class TestBuildConfigStep(RunbotCase):
 
         config_step._run_install_odoo(self.parent_build, 'dev/null/logpath')
 
+    @patch('odoo.addons.runbot.models.build.BuildResult._checkout')
+    def test_dump_directory(self, mock_checkout):
+        config_step = self.ConfigStep.create({
+            'name': 'all',
+            'job_type': 'install_odoo',
+            'dump_format': 'directory',
+            'dump_jobs': 8,
+        })
+        dest = self.parent_build.dest
+        cmd = config_step._run_install_odoo(self.parent_build, 'dev/null/logpath')['cmd']
+        self.assertEqual(cmd.finals[0], ['pg_dump', '-Fd', '-j', '8', '-Z0', '-f', f'/data/build/logs/{dest}-all/dump', f'{dest}-all'])
+        self.assertIn('zstd', cmd.finals[2])
+        self.assertIn(f'/data/build/logs/{dest}-all.tar.zst', cmd.finals[2])
+        database = self.parent_build.database_ids.filtered(lambda db: db.name == f'{dest}-all')
+        self.assertEqual(database.dump_format, 'directory')
+
+        restore_step = self.ConfigStep.create({
+            'name': 'restore',
+            'job_type': 'restore',
+            'restore_rename_db_suffix': 'restored',
+            'dump_jobs': 4,
+        })
+        restore_build = self.Build.create({'params_id': self.base_params.copy({'dump_db': database.id}).id})
+        cmd = restore_step._run_restore(restore_build, 'dev/null/logpath')['cmd']
+        self.assertIn(f'wget {self.parent_build.http_log_url()}{dest}-all.tar.zst', cmd)
+        self.assertIn(f'zstd -dcq {dest}-all.tar.zst | tar -xf -', cmd)
+        self.assertIn(f'pg_restore -j 4 --no-owner -d {restore_build.dest}-restored dump', cmd)
+
+    @patch('odoo.addons.runbot.models.database.local_pgadmin_cursor')
+    @patch('odoo.addons.runbot.models.build_config.ConfigStep._modules_to_install')
+    @patch('odoo.addons.runbot.models.build.BuildResult._checkout')
+    def test_db_template(self, mock_checkout, mock_modules_to_install, mock_pgadmin_cursor):
+        mock_modules_to_install.return_value = {'base', 'web', 'account'}
+        mock_pgadmin_cursor.return_value.__enter__.return_value.fetchone.return_value = [50 * 1024 * 1024]
+        config_step = self.ConfigStep.create({
+            'name': 'all',
+            'job_type': 'install_odoo',
+            'db_template_cache': True,
+            'db_template_modules': 'base,web,mail',
+        })
+        self.parent_build.write({'local_state': 'testing', 'active_step': config_step.id})
+        dest = self.parent_build.dest
+
+        # first build installs the template after its own install
+        res = config_step._run_install_odoo(self.parent_build, 'dev/null/logpath')
+        template = self.env['runbot.db.template'].search([])
+        self.assertEqual(template.state, 'pending')
+        self.assertEqual(template.build_id, self.parent_build)
+        self.patchers['_local_pg_createdb'].assert_called_with(f'{dest}-all')
+        cmd = res['cmd']
+        self.assertEqual(set(cmd.cmd[cmd.cmd.index('-i') + 1].split(',')), {'base', 'web', 'account'})
+        template_cmd = cmd.finals[-1]
+        self.assertEqual(template_cmd[template_cmd.index('-d') + 1], template.name)
+        self.assertEqual(template_cmd[template_cmd.index('-i') + 1], 'base,web')
+        self.assertEqual(template_cmd[-2:], ['touch', f'/data/build/{template.name}.done'])
+        # finals share the shell of the dump commands, that leave the build directory
+        full_cmd = cmd.build()
+        template_install = f' ; {" ".join(template_cmd)}'
+        self.assertTrue(full_cmd.endswith(template_install))
+        self.assertTrue(template_install.startswith(' ; cd /data/build && python3 server/server.py '), 'The template should be installed from the build directory')
+        self.assertGreater(full_cmd.index(template_install), full_cmd.index(f'cd /data/build/logs/{dest}-all/ && zip -rmq9'))
+
+        # next builds with the same commits only install the delta
+        other_build = self.Build.create({'params_id': self.parent_build.params_id.id, 'local_state': 'testing', 'active_step': config_step.id})
+        with patch('odoo.addons.runbot.models.database.os.path.exists', return_value=True), \
+                patch('odoo.addons.runbot.models.database.shutil.move'), \
+                patch('odoo.addons.runbot.models.database.subprocess.run'):
+            res = config_step._run_install_odoo(other_build, 'dev/null/logpath')
+        self.assertEqual(template.state, 'done')
+        self.assertEqual(template.size, 50)
+        self.patchers['_local_pg_createdb'].assert_called_with(f'{other_build.dest}-all', db_template=template.name)
+        cmd = res['cmd']
+        self.assertEqual(cmd.cmd[cmd.cmd.index('-i') + 1], 'account')
+        self.assertNotIn(template.name, [arg for final in cmd.finals for arg in final])
+
+        # templates above the size limit are dropped
+        self.env['ir.config_parameter'].set_param('runbot.runbot_db_template_max_size', 10)
+        self.env['runbot.db.template']._gc(template.host_id)
+        self.assertFalse(template.exists())
+
+    @patch('odoo.addons.runbot.models.database.local_pgadmin_cursor')
+    def test_db_template_cleanup(self, mock_pgadmin_cursor):
+        host = self.env['runbot.host']._get_current()
+        config_step = self.ConfigStep.create({'name': 'all', 'job_type': 'install_odoo'})
+        self.parent_build.write({'local_state': 'testing', 'active_step': config_step.id})
+        template = self.env['runbot.db.template']._get_template(host, 'cleanup_key', self.parent_build, config_step, create_empty=False)
+        self.assertEqual(template.state, 'pending')
+
+        # the template is kept while its build installs it
+        self.env['runbot.db.template']._cleanup(host)
+        self.assertTrue(template.exists())
+
+        # a template whose build stopped before installing it is dropped even if no other build asks for it
+        self.parent_build.local_state = 'done'
+        self.env['runbot.db.template']._cleanup(host)
+        self.assertFalse(template.exists())
+
+    @patch('odoo.addons.runbot.models.database.local_pgadmin_cursor')
+    def test_restore_cache(self, mock_pgadmin_cursor):
+        mock_pgadmin_cursor.return_value.__enter__.return_value.fetchone.return_value = [0]
+        config_step = self.ConfigStep.create({
+            'name': 'restore',
+            'job_type': 'restore',
+            'restore_rename_db_suffix': 'restored',
+            'restore_cache': True,
+        })
+        params = self.base_params.copy({'config_data': {'dump_url': 'http://host.runbot.com/runbot/static/build/00001-master/logs/00001-master-all.zip'}})
+        first_build = self.Build.create({'params_id': params.id, 'local_state': 'testing', 'active_step': config_step.id})
+        second_build = self.Build.create({'params_id': params.id, 'local_state': 'testing', 'active_step': config_step.id})
+
+        # the first restore of a dump creates the template from the restored database
+        cmd = config_step._run_restore(first_build, 'dev/null/logpath')['cmd']
+        template = self.env['runbot.db.template'].search([])
+        self.assertEqual(template.state, 'pending')
+        self.assertIn('psql -q %s-restored < dump.sql' % first_build.dest, cmd)
+        self.assertIn('createdb -T %s-restored %s' % (first_build.dest, template.name), cmd)
+
+        # next restores of the same dump on the host are created from the template
+        with patch('odoo.addons.runbot.models.database.os.path.exists', return_value=True), \
+                patch('odoo.addons.runbot.models.database.shutil.move'), \
+                patch('odoo.addons.runbot.models.database.subprocess.run'):
+            cmd = config_step._run_restore(second_build, 'dev/null/logpath')['cmd']
+        self.assertEqual(template.state, 'done')
+        self.patchers['_local_pg_createdb'].assert_called_with('%s-restored' % second_build.dest, db_template=template.name)
+        self.assertNotIn('wget', cmd)
+        self.assertIn('restore_modules_installed.txt', cmd)
+
     @patch('odoo.addons.runbot.models.build.BuildResult._checkout')
     def test_install_tags(self, mock_checkout):
         config_step = self.ConfigStep.create({
@@ -229,6 +356,49 @@ class TestBuildConfigStep(RunbotCase):
         self.patchers['docker_run'].side_effect = docker_run2
         config_step._run_install_odoo(self.parent_build, 'dev/null/logpath')
 
+    @patch('odoo.addons.runbot.models.build.BuildResult._get_modules_to_test')
+    @patch('odoo.addons.runbot.models.build.BuildResult._checkout')
+    def test_shard_tests(self, mock_checkout, mock_modules_to_test):
+        mock_modules_to_test.return_value = ['account', 'base', 'crm', 'mail', 'stock', 'web']
+        stat_regex = self.env['runbot.build.stat.regex'].create({'name': 'test_time', 'regex': r'odoo.addons.(?P<key>.+) tested in (?P<value>[\d.]+)s'})
+        previous_build = self.Build.create({'params_id': self.base_params.id})
+        self.env['runbot.build.stat']._write_key_values(previous_build, self.env['runbot.build.config.step'], {
+            'test_time.account.tests.test_invoice': 300,
+            'test_time.account.tests.test_payment': 100,
+            'test_time.stock.tests.test_move': 250,
+            'test_time.mail.tests.test_mail': 50,
+            'test_time.crm.tests.test_lead': 40,
+        })
+        shard_config = self.Config.create({'name': 'shard_config'})
+        install_step = self.ConfigStep.create({'name': 'shard_install', 'job_type': 'install_odoo'})
+        config_step = self.ConfigStep.create({
+            'name': 'shards',
+            'job_type': 'shard_tests',
+            'shard_count': 3,
+            'shard_config_id': shard_config.id,
+            'shard_stat_regex_id': stat_regex.id,
+        })
+
+        self.assertEqual(config_step._get_module_times(self.parent_build, mock_modules_to_test.return_value), {
+            'account': 400, 'stock': 250, 'mail': 50, 'crm': 40,
+        })
+
+        config_step._run_shard_tests(self.parent_build, '/tmp/essai')
+        children = self.parent_build.children_ids.sorted('id')
+        self.assertEqual(len(children), 3)
+        self.assertEqual(children.mapped('params_id.config_id'), shard_config)
+        self.assertEqual(
+            [child.params_id.config_data['shard_modules'] for child in children],
+            ['base,web', 'account', 'crm,mail,stock'],
+            'Modules are balanced on their previous test time, unknown modules get the median time',
+        )
+
+        # the install step of a shard only installs and tests the modules of the shard
+        res = install_step._run_install_odoo(children[0], 'dev/null/logpath')
+        cmd = res['cmd']
+        self.assertEqual(set(cmd.cmd[cmd.cmd.index('-i') + 1].split(',')), {'base', 'web'})
+        self.assertEqual(cmd.cmd[cmd.cmd.index('--test-tags') + 1], '/base,/web')
+
     @patch('odoo.addons.runbot.models.build.BuildResult._checkout')
     def test_db_name(self, mock_checkout):
         config_step = self.ConfigStep.create({
@@ -452,6 +622,37 @@ Initiating shutdown
         self.assertEqual(logs, [('INFO', f'Getting results for build {build.dest}')])
         self.assertEqual(result, {'job_end': '1970-01-01 02:00:00', 'local_result': 'warn'})
 
+    @patch('odoo.addons.runbot.models.build_config.os.path.getmtime')
+    @patch('odoo.addons.runbot.models.build_config.os.stat')
+    def test_make_result_single_read(self, mock_stat, mock_getmtime):
+        """ Test that checkers and stats share a single read of the log file """
+        mock_stat.return_value.st_size = 1000
+        mock_stat.return_value.st_mtime_ns = 7200
+        mock_getmtime.return_value = 7200
+        self.start_patcher('exists', 'odoo.addons.runbot.models.build_config.os.path.exists', True)
+        file_content = """
+odoo.stuff.modules.loading: Modules loaded.
+2020-03-02 22:06:58,391 17 INFO xxx odoo.modules.module: odoo.addons.website_blog.tests.test_ui tested in 10.35s, 2501 queries
+2019-12-17 17:34:37,692 17 WARNING dbname path.to.test: timeout exceded
+Initiating shutdown
+"""
+        config_step = self.ConfigStep.create({
+            'name': 'all',
+            'job_type': 'install_odoo',
+            'test_tags': '/module,:class.method',
+            'make_stats': True,
+            'build_stat_regex_ids': [(0, 0, {"name": "query_count", "regex": r"odoo.addons.(?P<key>.+) tested in .+, (?P<value>\d+) queries", "generic": False})],
+        })
+        build = self.Build.create({
+            'params_id': self.base_params.id,
+        })
+        with patch('builtins.open', mock_open(read_data=file_content)) as mock_file:
+            result = config_step._make_results(build)
+            config_step._make_stats(build)
+        self.assertEqual(result['local_result'], 'warn')
+        self.assertEqual(mock_file.call_count, 1)
+        self.assertEqual(self.env['runbot.build.stat'].search_count([('build_id', '=', build.id), ('key', '=', 'query_count.website_blog.tests.test_ui'), ('value', '=', 2501.0)]), 1)
+
     @patch('odoo.addons.runbot.models.build_config.ConfigStep._make_tests_results')
     def test_make_python_result(self, mock_make_tests_results):
         config_step = self.ConfigStep.create({
@@ -89,6 +89,51 @@ class TestBuildError(RunbotCase):
         self.assertIn(ko_build_new, new_build_error.build_ids, 'The parsed build with a re-apearing error should generate a new runbot.build.error')
         self.assertIn(build_error, new_build_error.error_history_ids, 'The old error should appear in history')
 
+    def test_build_scan_batched(self):
+        IrLog = self.env['ir.logging']
+        Regex = self.env['runbot.error.regex']
+        builds = self.Build
+        for _ in range(3):
+            builds |= self.create_test_build({'local_result': 'ko'})
+        existing_error = self.BuildError.create({'content': 'existing error'})
+
+        def log(build, message):
+            IrLog.create({
+                'message': message,
+                'build_id': build.id,
+                'level': 'ERROR',
+                'type': 'server',
+                'name': 'test-build-error-name',
+                'path': 'test-build-error-path',
+                'func': 'test-build-error-func',
+                'line': 1,
+            })
+
+        for build in builds:
+            log(build, 'existing error')
+            log(build, 'new error')
+            log(build, 'filtered error')
+
+        Regex.create({'regex': '^(filtered)', 're_type': 'filter'})
+        self.assertTrue(Regex._filter_match('filtered error'), 'The regex cache should be cleared when a regex is created')
+        Regex.create({'regex': r'(\w+) \1 error', 're_type': 'filter'})
+        self.assertTrue(Regex._filter_match('repeated repeated error'), 'Backreferences should match the groups of their own regex')
+        self.assertFalse(Regex._filter_match('repeated once error'))
+
+        rows = list(self.BuildError._iter_log_rows(build_ids=builds.ids, batch_size=2))
+        self.assertEqual(len(rows), 9)
+        self.assertEqual(rows, sorted(rows))
+
+        self.BuildError._parse_log_rows(rows)
+        self.assertEqual(existing_error.build_ids, builds)
+        self.assertEqual(existing_error.build_count, 3)
+        self.assertEqual(builds[0].build_error_ids.mapped('content'), ['existing error', 'new error'])
+        self.assertFalse(self.BuildError.search([('content', '=', 'filtered error')]))
+
+        # parsing twice does not duplicate the links
+        self.BuildError._parse_build_logs(builds.ids)
+        self.assertEqual(existing_error.build_count, 3)
+
     def test_build_error_links(self):
         build_a = self.create_test_build({'local_result': 'ko'})
         build_b = self.create_test_build({'local_result': 'ko'})
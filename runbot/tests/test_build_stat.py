@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
+import datetime
+
 from psycopg2 import IntegrityError
 from unittest.mock import patch, mock_open
+from odoo import fields
 from odoo.exceptions import ValidationError
 from odoo.tools import mute_logger
 from .common import RunbotCase
@@ -127,3 +130,62 @@ chocolate 15
 
         self.assertEqual(self.BuildStat.search_count([('key', '=', 'query_count.website_blog.tests.test_ui'), ('value', '=', 2501.0)]), 1)
         self.assertEqual(self.BuildStat.search_count([('key', '=', 'query_count.website_event.tests.test_ui'), ('value', '=', 2435.0)]), 1)
+
+
+class TestBuildDuration(RunbotCase):
+    def setUp(self):
+        super().setUp()
+        self.BuildDuration = self.env['runbot.build.duration']
+        self.install_step = self.env['runbot.build.config.step'].create({'name': 'install', 'job_type': 'install_odoo'})
+        self.test_step = self.env['runbot.build.config.step'].create({'name': 'test', 'job_type': 'install_odoo'})
+        config = self.env['runbot.build.config'].create({
+            'name': 'Duration config',
+            'step_order_ids': [
+                (0, 0, {'sequence': 10, 'step_id': self.install_step.id}),
+                (0, 0, {'sequence': 20, 'step_id': self.test_step.id}),
+            ],
+        })
+        self.params = self.base_params.copy({'config_id': config.id})
+
+    def test_duration_samples(self):
+        self.env['ir.config_parameter'].set_param('runbot.runbot_duration_samples', 10)
+        build = self.Build.create({'params_id': self.params.id})
+        for duration in range(1, 13):
+            record = self.BuildDuration._add_sample(build, self.install_step, duration * 10)
+        self.BuildDuration._add_sample(build, self.test_step, 60)
+        self.assertEqual(record.count, 10, 'Only the last samples are kept')
+        self.assertEqual(record.samples, '30,40,50,60,70,80,90,100,110,120')
+        self.assertEqual(record.estimate, 70)
+        self.assertEqual(record.p95, 120)
+
+        new_build = self.Build.create({'params_id': self.params.id, 'local_state': 'pending'})
+        self.assertEqual(new_build.estimated_duration, 130)
+        self.assertEqual(new_build._get_remaining_duration(), 130)
+
+        new_build.write({'local_state': 'testing', 'active_step': self.test_step.id, 'job_start': fields.Datetime.now() - datetime.timedelta(seconds=20)})
+        self.assertEqual(new_build._get_remaining_duration(), 40)
+
+    def test_duration_pending_estimate(self):
+        build = self.Build.create({'params_id': self.params.id})
+        self.BuildDuration._add_sample(build, self.install_step, 60)
+        pending_build = self.Build.create({'params_id': self.params.id, 'local_state': 'pending'})
+        self.assertEqual(pending_build.estimated_duration, 60)
+
+        self.BuildDuration._add_sample(build, self.test_step, 30)
+        self.assertEqual(pending_build.estimated_duration, 90, 'Estimated duration of pending builds should follow new samples')
+
+        pending_build.local_state = 'done'
+        self.BuildDuration._add_sample(build, self.test_step, 100)
+        self.BuildDuration._add_sample(build, self.test_step, 100)
+        self.assertEqual(pending_build.estimated_duration, 90, 'Only pending builds are updated')
+
+    def test_duration_warning(self):
+        build = self.Build.create({'params_id': self.params.id})
+        for duration in range(5):
+            self.BuildDuration._add_sample(build, self.install_step, 60)
+
+        build.write({'local_state': 'testing', 'active_step': self.install_step.id, 'job_start': fields.Datetime.now() - datetime.timedelta(minutes=5)})
+        build._check_overdue()
+        build._check_overdue()
+        self.assertEqual(build.overdue_step_id, self.install_step)
+        self.assertEqual(len(build.log_ids.filtered(lambda log: 'longer than usual' in log.message)), 1, 'The warning is logged once per step')
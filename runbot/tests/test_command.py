@@ -1,6 +1,12 @@
 # -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import time
+from unittest.mock import Mock, patch
 from odoo.tests import common
-from ..container import Command
+from odoo.tools import mute_logger
+from ..container import Command, ContainerWatcher, docker_state
 from ..container import sanitize_container_name
 
 
@@ -61,3 +67,54 @@ class TestSanitizeContainerName(common.TransactionCase):
         # 5. test both
         invalid_name = '_.3155889-saas-13.4-##container/-all_at_install'
         self.assertEqual(sanitize_container_name(invalid_name), valid_name)
+
+
+class TestContainerWatcher(common.TransactionCase):
+
+    def test_container_watcher_events(self):
+        watcher = ContainerWatcher()
+        self.assertIsNone(watcher.is_running('12-abcdef_all'), 'A watcher not listening should not give any state')
+        watcher._thread = Mock(is_alive=Mock(return_value=True))
+        watcher._process_event('start 12-abcdef_all\n')
+        watcher._process_event('start 13-abcdef_all\n')
+        self.assertTrue(watcher.is_running('12-abcdef_all'))
+        self.assertTrue(watcher.wait(0))
+        self.assertTrue(watcher.wait(0), 'A change should be reported until it is cleared')
+        watcher.clear()
+        self.assertFalse(watcher.wait(0))
+        watcher._process_event('die 12-abcdef_all\n')
+        self.assertFalse(watcher.is_running('12-abcdef_all'))
+        self.assertTrue(watcher.is_running('13-abcdef_all'))
+
+    @patch('odoo.addons.runbot.container.docker_ps', return_value=['12-abcdef_all'])
+    @patch('odoo.addons.runbot.container.subprocess.Popen')
+    def test_container_watcher_start(self, mock_popen, mock_docker_ps):
+        start = time.time()
+        mock_popen.return_value.stdout = iter([])
+        watcher = ContainerWatcher()
+        with mute_logger('odoo.addons.runbot.container'):
+            watcher.start()
+            watcher._thread.join()
+        self.assertEqual(watcher.running, {'12-abcdef_all'})
+        # events are replayed from before the running containers were read
+        cmd = mock_popen.call_args[0][0]
+        self.assertLess(float(cmd[cmd.index('--since') + 1]), start)
+
+    @patch('odoo.addons.runbot.container.docker_is_running')
+    def test_docker_state(self, mock_docker_is_running):
+        build_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, build_dir)
+        for prefix in ('exist', 'start'):
+            open(os.path.join(build_dir, f'{prefix}-12-abcdef_all'), 'w').close()
+        watcher = ContainerWatcher()
+        mock_docker_is_running.return_value = True
+        with patch('odoo.addons.runbot.container.container_watcher', watcher):
+            # the container is inspected when the watcher is not listening
+            self.assertEqual(docker_state('12-abcdef_all', build_dir), 'RUNNING')
+            self.assertEqual(mock_docker_is_running.call_count, 1)
+
+            watcher._thread = Mock(is_alive=Mock(return_value=True))
+            self.assertEqual(docker_state('12-abcdef_all', build_dir), 'GHOST')
+            watcher._process_event('start 12-abcdef_all\n')
+            self.assertEqual(docker_state('12-abcdef_all', build_dir), 'RUNNING')
+            self.assertEqual(mock_docker_is_running.call_count, 1, 'The container should not be inspected when the watcher is listening')
@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
 import datetime
-from unittest.mock import patch
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from unittest.mock import Mock, patch
 from werkzeug.urls import url_parse
 
 from odoo.tests.common import HttpCase, new_test_user, tagged
 from odoo.tools import mute_logger
+from odoo.addons.runbot.models.commit import _parse_retry_after
+from .common import RunbotCase
 
 
 @tagged('post_install', '-at_install')
@@ -92,3 +100,214 @@ class TestCommitStatus(HttpCase):
             response = self.url_open(f'/runbot/commit/resend/{last_commit_status.id}')
             self.assertEqual(response.status_code, 200)
             send_patcher.assert_not_called()
+
+
+class TestCommitStatusOutbox(RunbotCase):
+
+    def setUp(self):
+        super().setUp()
+        self.env['ir.config_parameter'].sudo().set_param('runbot.runbot_status_outbox', True)
+        self.server_commit = self.env['runbot.commit'].create({
+            'name': 'dfdfcfcf0000ffffffffffffffffffffffffffff',
+            'repo_id': self.repo_server.id
+        })
+        self.start_patcher('rate_limits', 'odoo.addons.runbot.models.commit._status_rate_limits', new={})
+
+    def test_status_outbox(self):
+        for state in ('pending', 'failure', 'success'):
+            self.server_commit._github_status(False, 'ci/test', state, 'https://www.somewhere.com')
+        self.server_commit._github_status(False, 'ci/other', 'pending', 'https://www.somewhere.com')
+        statuses = self.env['runbot.commit.status'].search([('commit_id', '=', self.server_commit.id)], order='id')
+        self.assertEqual(statuses.mapped('send_state'), ['pending'] * 4)
+
+        response = Mock(ok=True, status_code=201, headers={})
+        with patch('odoo.addons.runbot.models.commit.requests.post', return_value=response) as mock_post:
+            sent = self.env['runbot.commit.status']._send_pending()
+        self.assertEqual(sent, statuses[2:])
+        self.assertEqual(statuses.mapped('send_state'), ['superseded', 'superseded', 'sent', 'sent'])
+        self.assertEqual(mock_post.call_count, 4, 'Two statuses sent on the two remotes of the repo')
+        posted = {(call[0][0], json.loads(call[1]['data'])['state']) for call in mock_post.call_args_list}
+        self.assertEqual(posted, {
+            ('https://api.example.com/repos/base/server/statuses/dfdfcfcf0000ffffffffffffffffffffffffffff', 'success'),
+            ('https://api.example.com/repos/dev/server/statuses/dfdfcfcf0000ffffffffffffffffffffffffffff', 'success'),
+            ('https://api.example.com/repos/base/server/statuses/dfdfcfcf0000ffffffffffffffffffffffffffff', 'pending'),
+            ('https://api.example.com/repos/dev/server/statuses/dfdfcfcf0000ffffffffffffffffffffffffffff', 'pending'),
+        })
+
+    def test_status_outbox_rate_limit(self):
+        self.server_commit._github_status(False, 'ci/test', 'success', 'https://www.somewhere.com')
+        status = self.env['runbot.commit.status'].search([('commit_id', '=', self.server_commit.id)])
+        response = Mock(ok=False, status_code=403, text='rate limit', headers={'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(time.time() + 60)})
+        with patch('odoo.addons.runbot.models.commit.requests.post', return_value=response) as mock_post, \
+                mute_logger('odoo.addons.runbot.models.commit'):
+            self.assertFalse(self.env['runbot.commit.status']._send_pending())
+            self.assertEqual(mock_post.call_count, 2)
+            self.assertEqual(status.send_state, 'pending')
+            # rate limited remotes are not used until the reset time
+            self.assertFalse(self.env['runbot.commit.status']._send_pending())
+            self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(status.send_state, 'pending')
+
+    def test_status_outbox_errors(self):
+        self.server_commit._github_status(False, 'ci/test', 'success', 'https://www.somewhere.com')
+        status = self.env['runbot.commit.status'].search([('commit_id', '=', self.server_commit.id)])
+
+        # server errors are retried
+        response = Mock(ok=False, status_code=502, text='bad gateway', headers={})
+        with patch('odoo.addons.runbot.models.commit.requests.post', return_value=response), \
+                mute_logger('odoo.addons.runbot.models.commit'):
+            self.assertFalse(self.env['runbot.commit.status']._send_pending())
+        self.assertEqual(status.send_state, 'pending')
+
+        # client errors are not
+        response = Mock(ok=False, status_code=422, text='unprocessable', headers={})
+        with patch('odoo.addons.runbot.models.commit.requests.post', return_value=response), \
+                mute_logger('odoo.addons.runbot.models.commit'):
+            self.assertEqual(self.env['runbot.commit.status']._send_pending(), status)
+        self.assertEqual(status.send_state, 'sent')
+
+    def test_status_outbox_partial_delivery(self):
+        self.server_commit._github_status(False, 'ci/test', 'success', 'https://www.somewhere.com')
+        status = self.env['runbot.commit.status'].search([('commit_id', '=', self.server_commit.id)])
+
+        def mock_post(url, **kwargs):
+            if '/base/' in url:
+                return Mock(ok=True, status_code=201, headers={})
+            return Mock(ok=False, status_code=502, text='bad gateway', headers={})
+
+        with patch('odoo.addons.runbot.models.commit.requests.post', side_effect=mock_post), \
+                mute_logger('odoo.addons.runbot.models.commit'):
+            self.assertFalse(self.env['runbot.commit.status']._send_pending())
+        self.assertEqual(status.send_state, 'pending')
+        self.assertEqual(status.sent_remote_ids, self.remote_server)
+
+        # only the remote that failed receives the status again
+        response = Mock(ok=True, status_code=201, headers={})
+        with patch('odoo.addons.runbot.models.commit.requests.post', return_value=response) as mock_post:
+            self.assertEqual(self.env['runbot.commit.status']._send_pending(), status)
+        self.assertEqual(mock_post.call_count, 1)
+        self.assertIn('/dev/server/', mock_post.call_args[0][0])
+        self.assertEqual(status.send_state, 'sent')
+
+    def test_status_outbox_retry_after_date(self):
+        self.server_commit._github_status(False, 'ci/test', 'success', 'https://www.somewhere.com')
+        status = self.env['runbot.commit.status'].search([('commit_id', '=', self.server_commit.id)])
+        retry_date = datetime.datetime.utcnow() + datetime.timedelta(minutes=2)
+        response = Mock(ok=False, status_code=429, text='slow down', headers={'Retry-After': retry_date.strftime('%a, %d %b %Y %H:%M:%S GMT')})
+        with patch('odoo.addons.runbot.models.commit.requests.post', return_value=response), \
+                mute_logger('odoo.addons.runbot.models.commit'):
+            self.assertFalse(self.env['runbot.commit.status']._send_pending())
+        self.assertEqual(status.send_state, 'pending')
+        self.assertAlmostEqual(self.patchers['rate_limits'][self.remote_server.id], retry_date.replace(tzinfo=datetime.timezone.utc).timestamp(), delta=1)
+
+        # an invalid header does not abort the delivery
+        self.assertGreater(_parse_retry_after('soon'), time.time())
+
+
+class TestCommitExport(RunbotCase):
+
+    def setUp(self):
+        super().setUp()
+        # exports are done on a real filesystem
+        for patcher_name in ('isdir', 'isfile', 'makedirs', 'mkdir', 'getmtime', 'repo_root_patcher'):
+            self.stop_patcher(patcher_name)
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        root = os.path.join(tmp_dir, 'static')
+        self.start_patcher('repo_root_patcher', 'odoo.addons.runbot.models.runbot.Runbot._root', root)
+        self.start_patcher('repo_fetch', 'odoo.addons.runbot.models.repo.Repo._fetch', None)
+        self.env['ir.config_parameter'].sudo().set_param('runbot.runbot_export_hardlink', True)
+
+        self.base_sha = 'a' * 40
+        self.commit = self.Commit.create({'name': 'b' * 40, 'repo_id': self.repo_server.id})
+        self.sources = os.path.join(root, 'sources', self.repo_server.name)
+        self.base_path = os.path.join(self.sources, self.base_sha)
+        self._write_files(self.base_path, {
+            'kept.txt': 'kept',
+            'modified.txt': 'base',
+            'deleted.txt': 'deleted',
+            'old/renamed.txt': 'renamed',
+        })
+        self.new_files = {
+            'kept.txt': 'kept',
+            'modified.txt': 'new',
+            'added.txt': 'added',
+            'new/renamed.txt': 'renamed',
+        }
+        self.diff = [
+            ('M', 'modified.txt'),
+            ('D', 'deleted.txt'),
+            ('D', 'old/renamed.txt'),
+            ('A', 'new/renamed.txt'),
+            ('A', 'added.txt'),
+        ]
+        self.archive_calls = []
+        self.start_patcher('export_archive', 'odoo.addons.runbot.models.commit.Commit._export_archive', new=self._export_archive)
+
+    def _write_files(self, path, files):
+        for file_name, content in files.items():
+            file_path = os.path.join(path, file_name)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, 'w') as f:
+                f.write(content)
+
+    def _read_files(self, path):
+        files = {}
+        for dirpath, _dirnames, filenames in os.walk(path):
+            for file_name in filenames:
+                file_path = os.path.join(dirpath, file_name)
+                with open(file_path) as f:
+                    files[os.path.relpath(file_path, path)] = f.read()
+        return files
+
+    def _export_archive(self, export_sha, export_path, paths=None):
+        self.archive_calls.append(paths)
+        self._write_files(export_path, {
+            file_name: content for file_name, content in self.new_files.items() if paths is None or file_name in paths
+        })
+
+    def test_export_from_previous(self):
+        with patch('odoo.addons.runbot.models.commit.Commit._get_export_diff', return_value=self.diff):
+            export_path = self.commit._source_path()
+            self.assertEqual(self.commit.export(), export_path)
+        self.assertEqual(self.archive_calls, [['new/renamed.txt', 'added.txt']], 'Only added and modified files should be extracted')
+        self.assertEqual(self._read_files(export_path), self.new_files)
+        self.assertFalse(os.path.exists(os.path.join(export_path, 'old')), 'Emptied directories should be removed')
+        self.assertEqual(
+            os.stat(os.path.join(export_path, 'kept.txt')).st_ino,
+            os.stat(os.path.join(self.base_path, 'kept.txt')).st_ino,
+            'Unchanged files should be hardlinked',
+        )
+
+        # the previous export is left untouched
+        self.assertEqual(self._read_files(self.base_path), {
+            'kept.txt': 'kept',
+            'modified.txt': 'base',
+            'deleted.txt': 'deleted',
+            'old/renamed.txt': 'renamed',
+        })
+
+    def test_export_from_previous_no_diff(self):
+        with patch('odoo.addons.runbot.models.commit.Commit._get_export_diff', return_value=None), \
+                mute_logger('odoo.addons.runbot.models.commit'):
+            export_path = self.commit.export()
+        self.assertEqual(self.archive_calls, [None], 'A full export should be done when the diff cannot be computed')
+        self.assertEqual(self._read_files(export_path), self.new_files)
+
+    def test_export_from_previous_copy_failure(self):
+        with patch('odoo.addons.runbot.models.commit.Commit._get_export_diff', return_value=self.diff), \
+                patch('odoo.addons.runbot.models.commit.subprocess.check_output', side_effect=subprocess.CalledProcessError(1, 'cp')), \
+                mute_logger('odoo.addons.runbot.models.commit'):
+            export_path = self.commit.export()
+        self.assertEqual(self.archive_calls, [None], 'A full export should be done when the copy fails')
+        self.assertEqual(self._read_files(export_path), self.new_files)
+        self.assertFalse(os.path.exists(f'{export_path}.tmp'))
+
+    def test_source_cleanup_export_in_progress(self):
+        tmp_path = f'{self.commit._source_path()}.tmp'
+        os.makedirs(tmp_path)
+        with patch('odoo.addons.runbot.models.runbot.rmtree_background') as mock_rmtree:
+            self.env['runbot.runbot']._source_cleanup()
+        deleted = [call[0][0] for call in mock_rmtree.call_args_list]
+        self.assertEqual(deleted, [self.base_path])
+        self.assertNotIn(tmp_path, deleted, 'Exports in progress should not be deleted')
@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import logging
+import threading
 
 from unittest.mock import patch, mock_open
 
 from odoo.tests.common import Form, tagged, HttpCase
 from .common import RunbotCase
+from ..container import DOCKERUSER
+from ..models import host
 
 _logger = logging.getLogger(__name__)
 
@@ -65,3 +69,44 @@ class TestDockerfile(RunbotCase, HttpCase):
             file_handle_mock = file_mock.return_value.__enter__.return_value
             file_handle_mock.write.side_effect = write_side_effect
             rb_host._docker_build()
+
+    def test_docker_build_cache(self):
+        template = self.env['ir.ui.view'].create({
+            'name': 'docker_cache_test',
+            'type': 'qweb',
+            'key': 'docker.docker_cache_test',
+            'arch_db': '<t>FROM ubuntu:focal</t>'
+        })
+        dockerfile = self.env['runbot.dockerfile'].create({
+            'name': 'Tests cache',
+            'template_id': template.id,
+            'to_build': True
+        })
+        self.env['runbot.dockerfile'].search([('id', '!=', dockerfile.id)]).update({'to_build': False})
+        dockerfile_hash = hashlib.sha256((dockerfile.dockerfile + DOCKERUSER).encode()).hexdigest()
+
+        docker_build_mock = self.patchers['docker_build']
+        docker_build_mock.return_value = 0
+        rb_host = self.env['runbot.host'].create({'name': 'runbotxxx.odoo.com'})
+        with patch('builtins.open', mock_open()):
+            rb_host._docker_build()
+            docker_build_mock.assert_called_once()
+            self.assertEqual(docker_build_mock.call_args[1]['labels'], {'runbot.dockerfile_hash': dockerfile_hash})
+
+            # an image built from the same content is not built again
+            docker_build_mock.reset_mock()
+            self.patchers['docker_image_label'].return_value = dockerfile_hash
+            rb_host._docker_build()
+            docker_build_mock.assert_not_called()
+
+            # in background mode, the scheduler does not wait for the build
+            self.patchers['docker_image_label'].return_value = None
+            self.env['ir.config_parameter'].set_param('runbot.runbot_docker_build_background', True)
+            build_done = threading.Event()
+            docker_build_mock.side_effect = lambda *args, **kwargs: build_done.wait(10) and 1
+            rb_host._docker_build()
+            self.assertEqual(rb_host._get_building_image_tags(), {dockerfile.image_tag})
+            build_done.set()
+            host._docker_build_executor.submit(lambda: None).result()  # wait for the pending build to finish
+            self.assertEqual(rb_host._get_building_image_tags(), set())
+            self.assertFalse(dockerfile.to_build, 'A failed build should disable the dockerfile')
@@ -55,6 +55,51 @@ class TestIrLogging(RunbotCase):
         log_lines = self.env['ir.logging'].search([('type', '=', 'runbot'), ('name', '=', 'odoo.runbot'), ('func', '=', 'runbot function'), ('message', '=', 'runbot message'), ('level', '=', 'INFO')])
         self.assertEqual(len(log_lines), 1, '_log should be able to add logs from the runbot')
 
+    def test_bulk_insert(self):
+        build = self.Build.create({
+            'params_id': self.base_params.id,
+        })
+        build.log_counter = 10
+
+        def log_values(message, level='INFO', log_type='server'):
+            return {
+                'build_id': build.id,
+                'level': level,
+                'type': log_type,
+                'name': 'test',
+                'message': message,
+                'path': 'test',
+                'func': 'bulk function',
+                'line': '0',
+            }
+
+        self.env['ir.logging']._bulk_insert(
+            [log_values('bulk message') for _ in range(3)] +
+            [log_values('bulk warning', level='WARNING'), log_values('runbot message', log_type='runbot')]
+        )
+        self.assertEqual(build.log_counter, 6, 'server lines should decrement the build log_counter once per line')
+        self.assertEqual(build.triggered_result, 'warn', 'A warning log should sets the build in warn')
+
+        self.env['ir.logging']._bulk_insert([log_values('limit message') for _ in range(8)])
+        log_lines = self.env['ir.logging'].search([('build_id', '=', build.id), ('type', '=', 'server'), ('func', '=', 'bulk function')])
+        self.assertEqual(len(log_lines), 9, 'Log lines over the log limit should be dropped')
+        last_log_line = self.env['ir.logging'].search([('build_id', '=', build.id)], order='id DESC', limit=1)
+        self.assertIn('Log limit reached', last_log_line.message)
+        self.assertEqual(last_log_line.level, 'SEPARATOR')
+
+    def test_buffered_logs(self):
+        build = self.Build.create({
+            'params_id': self.base_params.id,
+        })
+        self.env['ir.config_parameter'].set_param('runbot.runbot_bulk_log', True)
+        with build._buffered_logs():
+            build._log('buffered function', 'first message')
+            build._log('buffered function', 'second message', level='ERROR')
+            self.assertFalse(self.env['ir.logging'].search([('func', '=', 'buffered function')]))
+        log_lines = self.env['ir.logging'].search([('build_id', '=', build.id), ('func', '=', 'buffered function')])
+        self.assertEqual(log_lines.mapped('message'), ['first message', 'second message'])
+        self.assertEqual(build.triggered_result, 'ko')
+
     def test_markdown(self):
         log = self.env['ir.logging'].create({
             'name': 'odoo.runbot',
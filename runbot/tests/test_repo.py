@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 import datetime
 import re
+from functools import partial
+import subprocess
+import tempfile
 from unittest import skip
 from unittest.mock import patch, Mock
 from subprocess import CalledProcessError
@@ -10,6 +13,7 @@ import logging
 import odoo
 import time
 
+from odoo.addons.runbot.git_batch import batch_check, close_batch_check
 from .common import RunbotCase, RunbotCaseMinimalSetup
 
 _logger = logging.getLogger(__name__)
@@ -295,6 +299,47 @@ class TestRepo(RunbotCaseMinimalSetup):
 
         _logger.info('Create pending builds took: %ssec', (time.time() - inserted_time))
 
+    @patch('odoo.addons.runbot.models.repo.Repo._read_ref_snapshot')
+    def test_get_refs_snapshot(self, mock_read_ref_snapshot):
+        """ Test that only refs changed since the last snapshot are returned """
+        self.start_patchers()
+        now = datetime.datetime.now()
+        refs = [
+            (
+                f'refs/{self.remote_server.remote_name}/heads/{name}',
+                sha,
+                date.strftime("%Y-%m-%d %H:%M:%S +0200"),
+                'Marc Bidule',
+                '<marc.bidule@somewhere.com>',
+                'A nice subject',
+                'Marc Bidule',
+                '<marc.bidule@somewhere.com>',
+            ) for name, sha, date in [
+                ('unchanged', 'd0d0caca', now),
+                ('updated', 'deadbeef', now),
+                ('new', 'cacad0d0', now),
+                ('too-old', 'f00dcafe', now - datetime.timedelta(days=31)),
+                ('ignored', 'c0ffee00', now),
+            ]
+        ]
+        self.commit_list[self.repo_server.id] = refs
+        deleted_ref = f'refs/{self.remote_server.remote_name}/heads/deleted'
+        mock_read_ref_snapshot.return_value = {
+            refs[0][0]: 'd0d0caca',
+            refs[1][0]: 'baadf00d',
+            refs[4][0]: 'abadcafe',
+            deleted_ref: 'beefcafe',
+        }
+        with patch('odoo.addons.runbot.models.repo.partial', wraps=partial) as mock_partial:
+            self.assertEqual(self.repo_server._get_refs(max_age=30, ignore={'ignored'}), refs[1:3])
+        # refs skipped in this turn are not recorded as processed
+        self.assertEqual(mock_partial.call_args[0][2], {
+            refs[0][0]: 'd0d0caca',
+            refs[1][0]: 'deadbeef',
+            refs[2][0]: 'cacad0d0',
+            refs[4][0]: 'abadcafe',
+        })
+
     @common.warmup
     def test_times(self):
         def _test_times(model, setter, field_name):
@@ -389,11 +434,19 @@ class TestFetch(RunbotCase):
                 return True
         return mock_git
 
+    def mock_check_output(self, cmd, *args, **kwargs):
+        self.assertEqual(cmd[-3:], ['fetch', '-p', '--all'])
+        self.fetch_count += 1
+        if self.fetch_count < 3 or self.force_failure:
+            raise CalledProcessError(128, cmd, 'Dummy Error'.encode('utf-8'))
+        return b''
+
     @patch('time.sleep', return_value=None)
     def test_update_fetch_cmd(self, mock_time):
         """ Test that git fetch is tried multiple times before disabling host """
 
         host = self.env['runbot.host']._get_current()
+        self.start_patcher('check_output_patcher', 'odoo.addons.runbot.models.repo.subprocess.check_output', new=self.mock_check_output)
 
         self.assertFalse(host.assigned_only)
         # Ensure that Host is not disabled if fetch succeeds after 3 tries
@@ -410,6 +463,102 @@ class TestFetch(RunbotCase):
         self.assertTrue(host.assigned_only)
         self.assertEqual(self.fetch_count, 5)
 
+    @patch('time.sleep', return_value=None)
+    @patch('odoo.addons.runbot.models.repo.Repo._need_update', return_value=True)
+    def test_update_concurrently(self, mock_need_update, mock_time):
+        """ Test that repos are fetched in parallel and only yielded once fetched """
+        host = self.env['runbot.host']._get_current()
+        failing_path = self.repo_addons.path
+
+        def mock_check_output(cmd, *args, **kwargs):
+            self.assertEqual(cmd[-3:], ['fetch', '-p', '--all'])
+            if failing_path in cmd:
+                raise CalledProcessError(128, cmd, 'Dummy Error'.encode('utf-8'))
+            return b''
+
+        self.start_patcher('check_output_patcher', 'odoo.addons.runbot.models.repo.subprocess.check_output', new=mock_check_output)
+        repos = self.repo_server | self.repo_addons
+        with mute_logger("odoo.addons.runbot.models.repo"):
+            updated = list(repos._update_concurrently(max_workers=2))
+        self.assertEqual(updated, [self.repo_server])
+        self.assertTrue(host.assigned_only, "Host should be disabled when a fetch fails")
+        self.assertEqual(mock_need_update.call_count, 2)
+
+    @patch('odoo.addons.runbot.models.repo.Repo._need_update', return_value=True)
+    def test_update_concurrently_override(self, mock_need_update):
+        """ Test that the concurrent fetch uses the overridable fetch of the repos """
+        fetched = []
+        repos = self.repo_server | self.repo_addons
+
+        def get_fetch(repo):
+            return lambda: fetched.append(repo.name)
+
+        with patch('odoo.addons.runbot.models.repo.Repo._get_fetch', autospec=True, side_effect=get_fetch):
+            updated = list(repos._update_concurrently(max_workers=2))
+        self.assertEqual(set(updated), set(repos))
+        self.assertEqual(sorted(fetched), sorted(repos.mapped('name')))
+
+
+class TestGitBatch(RunbotCase):
+
+    def test_hashes_exist(self):
+        self.patchers['repo_root_patcher'].return_value = tempfile.mkdtemp()
+        self.repo_server.invalidate_cache(['path'])
+        path = self.repo_server.path
+        self.addCleanup(close_batch_check, path)
+        git = ['git', '-C', path, '-c', 'user.name=runbot', '-c', 'user.email=runbot@example.com']
+
+        def commit(message):
+            subprocess.check_output(git + ['commit', '-q', '--allow-empty', '-m', message])
+            return subprocess.check_output(git + ['rev-parse', 'HEAD']).decode().strip()
+
+        subprocess.check_output(['git', 'init', '-q', path])
+        first_sha = commit('First commit')
+        self.assertEqual(self.repo_server._hashes_exist([first_sha, 'f' * 40]), {first_sha})
+        # the process is reused and finds objects created after its start
+        second_sha = commit('Second commit')
+        self.assertTrue(self.repo_server._hash_exists(second_sha))
+        self.assertFalse(self.repo_server._hash_exists('f' * 40))
+
+    def test_batch_check_timeout(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(close_batch_check, path)
+        checker = batch_check(path)
+
+        def start_stuck_process():
+            checker.process = subprocess.Popen(['sleep', '60'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+
+        with patch.object(checker, '_start', side_effect=start_stuck_process), \
+                patch('odoo.addons.runbot.git_batch.BATCH_CHECK_TIMEOUT', 0.1), \
+                mute_logger('odoo.addons.runbot.git_batch'):
+            with self.assertRaises(TimeoutError):
+                checker.exist(['f' * 40])
+        self.assertIsNone(checker.process, 'A stuck process should be killed')
+
+    def test_compare_commits(self):
+        calls = []
+
+        def mock_git(cmd):
+            calls.append(cmd[0])
+            return {
+                'merge-base': 'compare_merge_base\n',
+                'rev-list': '2\t3\n',
+                'diff': '10\t2\tfile.py\n-\t-\timage.png\n',
+            }[cmd[0]]
+
+        expected = {
+            'merge_base': 'compare_merge_base',
+            'base_ahead': 2,
+            'base_behind': 3,
+            'file_changed': 2,
+            'diff_add': 10,
+            'diff_remove': 2,
+        }
+        with patch('odoo.addons.runbot.models.repo.Repo._git', side_effect=mock_git):
+            self.assertEqual(self.repo_server._compare_commits('compare_head', 'compare_base'), expected)
+            self.assertEqual(self.repo_server._compare_commits('compare_head', 'compare_base'), expected)
+        self.assertEqual(calls, ['merge-base', 'rev-list', 'diff'], 'Second comparison should be memoised')
+
 
 class TestIdentityFile(RunbotCase):
 
@@ -491,3 +640,152 @@ class TestRepoScheduler(RunbotCase):
         builds[0].write({'local_state': 'done'})
 
         self.Runbot._scheduler(host)
+
+    @patch('odoo.addons.runbot.models.build.BuildResult._kill')
+    @patch('odoo.addons.runbot.models.build.BuildResult._schedule')
+    @patch('odoo.addons.runbot.models.build.BuildResult._init_pendings')
+    def test_repo_scheduler_batched(self, mock_init_pendings, mock_schedule, mock_kill):
+        self.env['ir.config_parameter'].set_param('runbot.runbot_workers', 6)
+        self.env['ir.config_parameter'].set_param('runbot.runbot_batched_scheduler', True)
+        builds = self.Build
+        for _ in range(6):
+            builds |= self.Build.create({
+                'params_id': self.base_params.id,
+                'build_type': 'normal',
+                'local_state': 'testing',
+                'host': 'host.runbot.com'
+            })
+        scheduled_build = self.Build.create({
+            'params_id': self.base_params.id,
+            'build_type': 'scheduled',
+            'local_state': 'pending',
+        })
+        build = self.Build.create({
+            'params_id': self.base_params.id,
+            'build_type': 'normal',
+            'local_state': 'pending',
+        })
+        host = self.env['runbot.host']._get_current()
+        timings = self.Runbot._scheduler(host)
+        self.assertEqual(set(timings), {'load', 'gc_testing', 'requested_actions', 'schedule', 'assign', 'prefetch', 'init', 'gc_running', 'nginx'})
+        self.assertEqual(mock_schedule.call_count, 6)
+        self.assertFalse(build.host)
+        self.assertFalse(scheduled_build.host)
+
+        builds[0].write({'local_state': 'done'})
+        self.Runbot._scheduler(host)
+        self.assertEqual(build.host, 'host.runbot.com')
+        self.assertFalse(scheduled_build.host)
+        mock_init_pendings.assert_called_once()
+
+    def test_repo_scheduler_batched_requested_actions(self):
+        self.env['ir.config_parameter'].set_param('runbot.runbot_batched_scheduler', True)
+        woken_up = self.Build
+        for _ in range(2):
+            woken_up |= self.Build.create({
+                'params_id': self.base_params.id,
+                'local_state': 'done',
+                'requested_action': 'wake_up',
+                'host': 'host.runbot.com',
+            })
+        commit_counts = []
+
+        def process_requested_actions(build):
+            commit_counts.append(self.patchers['repo_commit'].call_count)
+
+        with patch('odoo.addons.runbot.models.build.BuildResult._process_requested_actions', autospec=True, side_effect=process_requested_actions):
+            self.Runbot._scheduler(self.env['runbot.host']._get_current())
+        self.assertEqual(len(commit_counts), 2)
+        self.assertEqual(commit_counts[1], commit_counts[0] + 1, 'Each woken up build should be committed since a docker is started for it')
+
+    def test_allocate_builds_locality(self):
+        host = self.env['runbot.host']._get_current()
+        dockerfile = self.env['runbot.dockerfile'].create({'name': 'Warm image'})
+        host.dockerfile_ids = dockerfile
+        cold_build = self.Build.create({'params_id': self.base_params.id, 'local_state': 'pending'})
+        warm_build = self.Build.create({'params_id': self.base_params.copy({'dockerfile_id': dockerfile.id}).id, 'local_state': 'pending'})
+        self.env['ir.config_parameter'].set_param('runbot.runbot_locality_allocation', True)
+
+        # the build with its docker image on the host is taken first
+        allocated = self.Runbot._allocate_builds(host, 1)
+        self.assertEqual(allocated, [(warm_build.id,)])
+
+        # a build waiting for too long is taken whatever its locality
+        warm_build.host = False
+        self.Build.flush()
+        self.env.cr.execute("UPDATE runbot_build SET create_date = create_date - interval '1 hour' WHERE id = %s", [cold_build.id])
+        allocated = self.Runbot._allocate_builds(host, 1)
+        self.assertEqual(allocated, [(cold_build.id,)])
+
+    def test_allocate_builds_fair_queue(self):
+        host = self.env['runbot.host']._get_current()
+
+        def create_build(bundle, build_type='normal', **values):
+            batch = self.env['runbot.batch'].create({'bundle_id': bundle.id})
+            params = self.base_params.copy({'create_batch_id': batch.id, 'extra_params': '--batch=%s' % batch.id})
+            return self.Build.create(dict(params_id=params.id, build_type=build_type, local_state='pending', **values))
+
+        bundle_a = self.Bundle.create({'name': 'master-dev-a', 'project_id': self.project.id})
+        bundle_b = self.Bundle.create({'name': 'master-dev-b', 'project_id': self.project.id})
+        priority_bundle = self.Bundle.create({'name': 'master-dev-c', 'project_id': self.project.id, 'priority': True})
+        create_build(bundle_a, local_state='testing', host='other.runbot.com')
+        builds_a = create_build(bundle_a) | create_build(bundle_a)
+        nightly = create_build(bundle_b, build_type='scheduled')
+        build_b = create_build(bundle_b)
+        priority_build = create_build(priority_bundle)
+        self.assertEqual(builds_a[0].queue_bundle_id, bundle_a)
+        self.assertGreater(priority_build.queue_priority, build_b.queue_priority)
+        self.assertGreater(build_b.queue_priority, nightly.queue_priority)
+        bundle_b.priority = True
+        self.assertEqual(build_b.queue_priority, priority_build.queue_priority, 'Queue priority should follow the bundle priority')
+        bundle_b.priority = False
+        self.env['ir.config_parameter'].set_param('runbot.runbot_fair_queue', True)
+
+        # priority first, then the bundle with the fewest allocated builds
+        self.assertEqual(self.Runbot._allocate_builds(host, 1), [(priority_build.id,)])
+        self.assertEqual(self.Runbot._allocate_builds(host, 1), [(build_b.id,)])
+        self.assertEqual(len(self.Runbot._allocate_builds(host, 2)), 2)
+        self.Build.invalidate_cache(['host'])
+        self.assertEqual(builds_a.mapped('host'), ['host.runbot.com', 'host.runbot.com'])
+        self.assertFalse(nightly.host)
+
+        # a build waiting for too long is taken whatever its priority
+        self.env.cr.execute("UPDATE runbot_build SET create_date = create_date - interval '1 hour' WHERE id = %s", [nightly.id])
+        create_build(priority_bundle)
+        self.assertEqual(self.Runbot._allocate_builds(host, 1), [(nightly.id,)])
+
+    @patch('odoo.addons.runbot.models.runbot._prefetching', new_callable=dict)
+    @patch('odoo.addons.runbot.models.runbot._prefetch_executor')
+    def test_prefetch_sources(self, mock_executor, mock_prefetching):
+        self.env['ir.config_parameter'].set_param('runbot.runbot_workers', 2)
+        self.env['ir.config_parameter'].set_param('runbot.runbot_prefetch_workers', 1)
+        self.patchers['isdir'].return_value = False
+        mock_executor.submit.return_value = Mock(done=Mock(return_value=False))
+
+        commit = self.Commit.create({'name': 'd0d0caca', 'repo_id': self.repo_server.id})
+        params = self.BuildParameters.create({
+            'version_id': self.version_13.id,
+            'project_id': self.project.id,
+            'config_id': self.default_config.id,
+            'commit_link_ids': [(0, 0, {'commit_id': commit.id})],
+        })
+        build = self.Build.create({
+            'params_id': params.id,
+            'local_state': 'pending',
+            'host': 'host.runbot.com',
+        })
+        other_build = self.Build.create({
+            'params_id': self.base_params.id,
+            'local_state': 'pending',
+            'host': 'host.runbot.com',
+        })
+        host = self.env['runbot.host']._get_current()
+        self.Runbot._prefetch_sources(host)
+        mock_executor.submit.assert_called_once()
+        self.assertEqual(self.Runbot._get_builds_to_init(host), other_build, 'Build should wait the end of the prefetch')
+
+        self.Runbot._prefetch_sources(host)
+        mock_executor.submit.assert_called_once()
+
+        mock_executor.submit.return_value.done.return_value = True
+        self.assertEqual(self.Runbot._get_builds_to_init(host), build | other_build)
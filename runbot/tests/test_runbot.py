@@ -1,6 +1,17 @@
 # -*- coding: utf-8 -*-
+import importlib.util
 import logging
+import os
+import signal
+import tempfile
+import threading
 
+from collections import defaultdict
+
+from unittest.mock import MagicMock, patch, mock_open
+
+from odoo.addons.runbot import metrics
+from odoo.sql_db import Cursor
 from .common import RunbotCase
 
 _logger = logging.getLogger(__name__)
@@ -12,3 +23,144 @@ class TestRunbot(RunbotCase):
         warning = self.env['runbot.runbot'].warning('Test warning message')
 
         self.assertTrue(self.env['runbot.warning'].browse(warning.id).exists())
+
+    @patch('odoo.addons.runbot.models.runbot.gc_pending', return_value=0)
+    @patch('odoo.addons.runbot.models.runbot.Runbot._gc_evict_builds', return_value=0)
+    @patch('odoo.addons.runbot.models.runbot.Runbot._gc_evict_sources', return_value=2)
+    @patch('odoo.addons.runbot.models.runbot.Runbot._get_disk_usage')
+    def test_gc_disk_pressure(self, mock_disk_usage, mock_evict_sources, mock_evict_builds, mock_gc_pending):
+        Runbot = self.env['runbot.runbot']
+        host = self.env['runbot.host']._get_current()
+        self.env['ir.config_parameter'].set_param('runbot.runbot_gc_high_watermark', 90)
+        self.env['ir.config_parameter'].set_param('runbot.runbot_gc_low_watermark', 80)
+
+        mock_disk_usage.return_value = 85
+        Runbot._gc_disk_pressure(host)
+        mock_evict_sources.assert_not_called()
+
+        # above the high watermark, sources are evicted first
+        mock_disk_usage.return_value = 95
+        Runbot._gc_disk_pressure(host)
+        mock_evict_sources.assert_called_once_with(10)
+        mock_evict_builds.assert_not_called()
+
+        # eviction continues until the low watermark is reached, builds are evicted when no source is left
+        mock_disk_usage.return_value = 85
+        mock_evict_sources.return_value = 0
+        Runbot._gc_disk_pressure(host)
+        mock_evict_builds.assert_called_once_with(host, 10)
+
+        mock_disk_usage.return_value = 79
+        Runbot._gc_disk_pressure(host)
+        mock_disk_usage.return_value = 85
+        Runbot._gc_disk_pressure(host)
+        self.assertEqual(mock_evict_builds.call_count, 1)
+
+        # nothing is evicted while previous deletions are pending
+        mock_disk_usage.return_value = 95
+        mock_gc_pending.return_value = 1
+        Runbot._gc_disk_pressure(host)
+        self.assertEqual(mock_evict_sources.call_count, 2)
+
+    @patch('odoo.addons.runbot.models.host._last_metrics_save', 0)
+    def test_metrics(self):
+        metrics.reset()
+        host = self.env['runbot.host']._get_current()
+        metrics.inc('runbot_github_requests_total', method='get')
+        metrics.inc('runbot_github_requests_total', method='get')
+        metrics.observe('runbot_fetch_seconds', 1.5, repo='server')
+        metrics.observe('runbot_fetch_seconds', 0.5, repo='server')
+        with self.env['runbot.runbot']._timed_phase({}, 'assign'):
+            pass
+        host._save_metrics('builder')
+        self.assertEqual(set(host.loop_metrics), {'builder'})
+        self.Build.create({'params_id': self.base_params.id, 'local_state': 'pending'})
+        self.Build.flush()
+
+        content = self.env['runbot.runbot']._get_metrics()
+        lines = content.splitlines()
+        self.assertIn('# TYPE runbot_github_requests_total counter', lines)
+        self.assertIn('runbot_github_requests_total{host="host.runbot.com",method="get",process="builder"} 2.0', lines)
+        self.assertIn('runbot_fetch_seconds_count{host="host.runbot.com",process="builder",repo="server"} 2', lines)
+        self.assertIn('runbot_fetch_seconds_sum{host="host.runbot.com",process="builder",repo="server"} 2.0', lines)
+        self.assertIn('runbot_scheduler_phase_seconds_count{host="host.runbot.com",phase="assign",process="builder"} 1', lines)
+        self.assertTrue(any(line.startswith('runbot_builds{allocated="false",state="pending"} ') for line in lines))
+        metrics.reset()
+
+    @patch('odoo.addons.runbot.models.host.os.makedirs')
+    def test_add_profile(self, mock_makedirs):
+        host = self.env['runbot.host']._get_current()
+        mock_profile = MagicMock()
+        with patch('odoo.addons.runbot.models.host.open', mock_open()) as mocked_open:
+            profile = host._add_profile(10, 12.5, 300, 1.5, 'report first line\nreport second line', mock_profile)
+        self.assertEqual(profile.host_id, host)
+        self.assertEqual(profile.query_count, 300)
+        self.assertTrue(profile.report_path.endswith('/profiles/%s.txt' % profile.name))
+        self.assertEqual(profile.report_url, 'http://host.runbot.com/runbot/static/profiles/%s.txt' % profile.name)
+        mocked_open().write.assert_called_once_with('report first line\nreport second line')
+        mock_profile.dump_stats.assert_called_once()
+
+    @patch('odoo.addons.runbot.models.runbot.subprocess.call', return_value=0)
+    def test_reload_nginx(self, mock_call):
+        for patcher_name in ('reload_nginx', 'isfile', 'isdir', 'makedirs', 'mkdir'):
+            self.stop_patcher(patcher_name)
+        root = tempfile.mkdtemp()
+        self.patchers['repo_root_patcher'].return_value = root
+        builds_dir = os.path.join(root, 'nginx', 'builds')
+        build = self.Build.create({'params_id': self.base_params.id, 'local_state': 'running', 'host': 'host.runbot.com', 'port': 2000})
+
+        self.assertTrue(self.Runbot._reload_nginx())
+        self.assertTrue(os.path.isfile(os.path.join(root, 'nginx', 'nginx.conf')))
+        self.assertEqual(os.listdir(builds_dir), [f'{build.dest}.conf'])
+        with open(os.path.join(builds_dir, f'{build.dest}.conf')) as build_conf:
+            self.assertIn('proxy_pass http://127.0.0.1:2000;', build_conf.read())
+        self.assertEqual(mock_call.call_count, 1)  # no pid file, nginx is started
+
+        with patch('odoo.addons.base.models.ir_ui_view.View.render_template') as mock_render:
+            self.assertFalse(self.Runbot._reload_nginx())
+        mock_render.assert_not_called()
+
+        build.local_state = 'done'
+        self.assertTrue(self.Runbot._reload_nginx())
+        self.assertEqual(os.listdir(builds_dir), [])
+
+    def _load_builder_tools(self):
+        tools_path = os.path.join(os.path.dirname(__file__), '..', '..', 'runbot_builder', 'tools.py')
+        spec = importlib.util.spec_from_file_location('runbot_builder_tools', tools_path)
+        tools = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(tools)
+        return tools
+
+    @patch('odoo.addons.runbot.models.host.Host._bootstrap')
+    def test_runbot_client_main_loop(self, mock_bootstrap):
+        tools = self._load_builder_tools()
+
+        class TestClient(tools.RunbotClient):
+            def loop_turn(self):
+                self.ask_interrupt.set()
+                return 0
+
+        client = TestClient(self.env)
+        handlers = {}
+        with patch.object(tools.signal, 'signal', side_effect=lambda signum, handler: handlers.__setitem__(signum, handler)):
+            client.main_loop()
+        self.assertEqual(client.count, 1)
+        self.assertEqual(handlers[signal.SIGINT], client.signal_handler)
+        self.assertEqual(handlers[signal.SIGTERM], client.signal_handler)
+        self.assertEqual(handlers[signal.SIGUSR1], client.profile_handler)
+        with patch.object(tools.os, '_exit') as mock_exit:
+            handlers[signal.SIGINT](signal.SIGINT, None)  # second interrupt
+        mock_exit.assert_called_once_with(1)
+
+    def test_record_queries(self):
+        tools = self._load_builder_tools()
+        queries = defaultdict(lambda: [0, 0])
+        with patch('odoo.sql_db.Cursor.execute') as mock_execute:
+            with tools.record_queries(queries):
+                Cursor.execute(None, 'SELECT  1')
+                thread = threading.Thread(target=Cursor.execute, args=(None, 'SELECT 2'))
+                thread.start()
+                thread.join()
+            self.assertEqual(mock_execute.call_count, 2)
+        self.assertEqual(list(queries), ['SELECT 1'], 'Only the queries of the profiled thread should be recorded')
+        self.assertEqual(queries['SELECT 1'][0], 1)
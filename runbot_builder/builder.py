@@ -1,12 +1,15 @@
 #!/usr/bin/python3
 from tools import RunbotClient, run
 import logging
+import time
 
 _logger = logging.getLogger(__name__)
 
 class BuilderClient(RunbotClient):
 
     def on_start(self):
+        from odoo.addons.runbot.container import container_watcher
+        self.container_watcher = container_watcher
         self.env['runbot.repo'].search([('mode', '!=', 'disabled')])._update(force=True)
 
     def loop_turn(self):
@@ -16,8 +19,17 @@ class BuilderClient(RunbotClient):
             self.env['runbot.runbot']._docker_cleanup()
             self.host.set_psql_conn_count()
             self.host._docker_build()
+        # the turn reads the containers states, changes notified from now on wake up the next sleep
+        self.container_watcher.clear()
         return self.env['runbot.runbot']._scheduler_loop_turn(self.host)
 
+    def sleep(self, t):
+        # wake up as soon as a container starts or stops instead of waiting the full sleep time
+        end = time.time() + t
+        while not self.ask_interrupt.is_set() and time.time() < end:
+            if self.container_watcher.wait(min(1, end - time.time())):
+                return
+
 
 if __name__ == '__main__':
     run(BuilderClient)
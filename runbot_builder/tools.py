@@ -1,11 +1,18 @@
 #!/usr/bin/python3
 import argparse
+import cProfile
+import io
 import logging
 import os
+import pstats
+import re
 import sys
 import threading
 import signal
+import time
 
+from collections import defaultdict
+from contextlib import contextmanager
 from logging.handlers import WatchedFileHandler
 
 LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
@@ -16,11 +23,84 @@ logging.addLevelName(25, "!NFO")
 _logger = logging.getLogger(__name__)
 
 
+@contextmanager
+def record_queries(queries):
+    """Count and time the sql queries executed by the current thread, by query, in queries {query: [count, duration]}
+    Queries of the other threads (prefetch, fetch, status, ...) are not recorded.
+    """
+    from odoo.sql_db import Cursor
+    execute = Cursor.execute
+    recording_thread = threading.current_thread()
+    lock = threading.Lock()
+
+    def recording_execute(cursor, query, *args, **kwargs):
+        if threading.current_thread() is not recording_thread:
+            return execute(cursor, query, *args, **kwargs)
+        start = time.time()
+        try:
+            return execute(cursor, query, *args, **kwargs)
+        finally:
+            duration = time.time() - start
+            with lock:
+                stat = queries[re.sub(r'\s+', ' ', str(query)).strip()[:300]]
+                stat[0] += 1
+                stat[1] += duration
+
+    Cursor.execute = recording_execute
+    try:
+        yield
+    finally:
+        Cursor.execute = execute
+
+
+class LoopProfiler():
+    """Profile nb_turns consecutive loop turns with cProfile and record their sql queries"""
+
+    def __init__(self, nb_turns):
+        self.nb_turns = nb_turns
+        self.turns = 0
+        self.duration = 0
+        self.profile = cProfile.Profile()
+        self.queries = defaultdict(lambda: [0, 0])
+
+    @property
+    def done(self):
+        return self.turns >= self.nb_turns
+
+    def run(self, func):
+        start = time.time()
+        try:
+            with record_queries(self.queries):
+                self.profile.enable()
+                try:
+                    return func()
+                finally:
+                    self.profile.disable()
+        finally:
+            self.turns += 1
+            self.duration += time.time() - start
+
+    def report(self, limit=40):
+        """Return a text report of the profiled turns, the slowest functions and queries"""
+        query_count = sum(count for count, _ in self.queries.values())
+        query_time = sum(duration for _, duration in self.queries.values())
+        output = io.StringIO()
+        output.write(f'{self.turns} turns in {self.duration:.3f}s, {query_count} queries in {query_time:.3f}s\n\n')
+        output.write('Slowest queries (count, total time, query):\n')
+        for query, (count, duration) in sorted(self.queries.items(), key=lambda item: -item[1][1])[:limit]:
+            output.write(f'{count:>8} {duration:>10.3f}s  {query}\n')
+        output.write('\n')
+        pstats.Stats(self.profile, stream=output).sort_stats('cumulative').print_stats(limit)
+        return output.getvalue(), query_count, query_time
+
+
 class RunbotClient():
 
     def __init__(self, env):
         self.env = env
         self.ask_interrupt = threading.Event()
+        self.ask_profile = threading.Event()
+        self.profiler = None
         self.host = None
         self.count = 0
         self.max_count = 60
@@ -34,6 +114,7 @@ class RunbotClient():
         signal.signal(signal.SIGINT, self.signal_handler)
         signal.signal(signal.SIGTERM, self.signal_handler)
         signal.signal(signal.SIGQUIT, self.dump_stack)
+        signal.signal(signal.SIGUSR1, self.profile_handler)
         self.host = self.env['runbot.host']._get_current()
         self.host._bootstrap()
         logging.info(
@@ -48,7 +129,7 @@ class RunbotClient():
                 self.host.last_start_loop = fields.Datetime.now()
                 self.env.cr.commit()
                 self.count = self.count % self.max_count
-                sleep_time = self.loop_turn()
+                sleep_time = self.profiled_loop_turn()
                 self.count += 1
                 self.host.last_end_loop = fields.Datetime.now()
                 self.env.cr.commit()
@@ -73,6 +154,42 @@ class RunbotClient():
         _logger.info("Interrupt detected")
         self.ask_interrupt.set()
 
+    def profiled_loop_turn(self):
+        """
+        Run loop_turn, profiling it when asked by SIGUSR1 or by the profile_next_turns
+        flag of the host, for runbot_profile_turns consecutive turns
+        """
+        if self.profiler is None and (self.ask_profile.is_set() or self.host.profile_next_turns):
+            self.ask_profile.clear()
+            nb_turns = int(self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_profile_turns', default=10))
+            _logger.info('Profiling the next %s turns', nb_turns)
+            self.profiler = LoopProfiler(nb_turns)
+            self.host.profile_next_turns = False
+            self.env.cr.commit()
+        if self.profiler is None:
+            return self.loop_turn()
+        try:
+            return self.profiler.run(self.loop_turn)
+        finally:
+            if self.profiler.done:
+                profiler, self.profiler = self.profiler, None
+                self.save_profile(profiler)
+
+    def save_profile(self, profiler):
+        """Save the report with a dedicated cursor, the transaction of the loop may be aborted"""
+        from odoo import api, SUPERUSER_ID
+        report, query_count, query_time = profiler.report()
+        with self.env.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            profile = env['runbot.host'].browse(self.host.id)._add_profile(
+                profiler.turns, profiler.duration, query_count, query_time, report, profiler.profile
+            )
+            _logger.info('Profile of %s turns written in %s', profiler.turns, profile.report_path)
+
+    def profile_handler(self, _signal, _frame):
+        _logger.info("Profiling requested")
+        self.ask_profile.set()
+
     def dump_stack(self, _signal, _frame):
         import odoo
         odoo.tools.misc.dumpstacks()
@@ -1,10 +1,41 @@
+import hashlib
+import logging
+import random
+
+from datetime import timedelta
+
+from psycopg2.extras import execute_values
+
 from odoo import models, fields, api
 from unittest.mock import patch
 from odoo.tools import mute_logger
 
-import logging
 _logger = logging.getLogger(__name__)
 
+SCALE_ERRORS = [
+    'Traceback (most recent call last):\n  File "/data/build/odoo/addons/%s/models/model.py", line 42, in _compute\nKeyError: %s',
+    'FAIL: test_flow (odoo.addons.%s.tests.test_flow.TestFlow)\nAssertionError: %s != 0',
+    'Module %s: invalid view definition at line %s',
+]
+SCALE_MODULES = ['account', 'base', 'crm', 'hr', 'mail', 'mrp', 'project', 'purchase', 'sale', 'stock', 'web', 'website']
+
+
+def demo_git(command):
+    """ Minimal answers to the git commands used by batch._prepare """
+    if command[0] == 'merge-base':
+        _, sha1, sha2 = command
+        return sha1 if sha1 == sha2 else sha2 #if bundle.is_base else '%s_%s' % (sha1, sha2)
+    elif command[0] == 'rev-list':
+        _, _, _, shas = command
+        sha1, sha2 = shas.split('...')
+        return '0\t0' if command[1] == command[2] else '3\t5'
+    elif command[0] == 'diff':
+        _, _, sha1, sha2 = command
+        return '' if sha1 == sha2 else '0 5 _\n1 8 _'
+    else:
+        _logger.info(command)
+
+
 # after this point, not realy a repo buisness
 class Runbot(models.AbstractModel):
     _inherit = 'runbot.runbot'
@@ -94,21 +125,7 @@ class Runbot(models.AbstractModel):
                         branch.head = commit
                         batch._new_commit(branch)
 
-                def git(command):
-                    if command[0] == 'merge-base':
-                        _, sha1, sha2 = command
-                        return sha1 if sha1 == sha2 else sha2 #if bundle.is_base else '%s_%s' % (sha1, sha2)
-                    elif command[0] == 'rev-list':
-                        _, _, _, shas = command
-                        sha1, sha2 = shas.split('...')
-                        return '0\t0' if command[1] == command[2] else '3\t5'
-                    elif command[0] == 'diff':
-                        _, _, sha1, sha2 = command
-                        return '' if sha1 == sha2 else '0 5 _\n1 8 _'
-                    else:
-                        _logger.info(command)
-
-                mock_git.side_effect = git
+                mock_git.side_effect = demo_git
                 with mute_logger('odoo.addons.runbot.models.batch'):
                     batch._prepare()
 
@@ -142,3 +159,129 @@ class Runbot(models.AbstractModel):
 
 
                 batch._process()
+
+    @api.model
+    def _populate_scale(self, project, nb_bundles=100, nb_batches=5, nb_logs=20, nb_stats=10, stat_category='perf', chunk_size=50, seed=0):
+        """
+        Generate production shaped data in project: nb_bundles bundles with a branch
+        in each repo, nb_batches batches per bundle and one build per trigger and batch.
+        The builds of the last batch of each bundle are pending, the other ones are done
+        with nb_logs log lines and nb_stats stats in stat_category. About 30% of the done
+        builds are failing with some server errors in their logs.
+
+        Small records are created with the orm, by chunk of chunk_size bundles, while
+        logs and stats are inserted with raw sql since they are the biggest tables.
+        :return: the created bundles
+        """
+        rand = random.Random(seed)
+        Bundle = self.env['runbot.bundle']
+        triggers = project.trigger_ids
+        repos = triggers.repo_ids | triggers.dependency_ids
+        if not Bundle.search([('project_id', '=', project.id), ('is_base', '=', True)]):
+            Bundle.create({'name': 'master', 'project_id': project.id, 'is_base': True})
+        step_ids = {trigger.id: trigger.config_id.step_ids()[:1].id or None for trigger in triggers}
+        prefix = hashlib.sha1(f'{project.id}-{fields.Datetime.now()}'.encode()).hexdigest()[:6]
+        now = fields.Datetime.now()
+
+        bundles = Bundle
+        for chunk_start in range(0, nb_bundles, chunk_size):
+            names = [f'master-scale-{prefix}-{index}' for index in range(chunk_start, min(chunk_start + chunk_size, nb_bundles))]
+            heads = {}
+            for repo in repos:
+                branches = self.env['runbot.branch'].create([
+                    {'remote_id': repo.main_remote_id.id, 'name': name, 'is_pr': False} for name in names
+                ])
+                for branch in branches:
+                    heads[(branch.bundle_id.id, repo.id)] = branch
+            chunk_bundles = Bundle.search([('name', 'in', names), ('project_id', '=', project.id)])
+            bundles |= chunk_bundles
+
+            done_builds = self.env['runbot.build']
+            for bundle in chunk_bundles:
+                batches = self.env['runbot.batch'].create([{
+                    'bundle_id': bundle.id,
+                    'state': 'done' if index < nb_batches - 1 else 'ready',
+                    'last_update': now - timedelta(hours=nb_batches - index),
+                } for index in range(nb_batches)])
+                for batch in batches:
+                    commits = self.env['runbot.commit'].create([{
+                        'name': hashlib.sha1(f'{prefix}-{batch.id}-{repo.id}'.encode()).hexdigest(),
+                        'repo_id': repo.id,
+                        'date': batch.last_update,
+                        'author': 'Author',
+                        'author_email': 'author@example.com',
+                        'committer': 'Committer',
+                        'committer_email': 'committer@example.com',
+                        'subject': f'[IMP] {rand.choice(SCALE_MODULES)}: some improvement',
+                    } for repo in repos])
+                    batch.commit_link_ids = self.env['runbot.commit.link'].create([{
+                        'commit_id': commit.id,
+                        'match_type': 'new',
+                        'branch_id': heads[(bundle.id, commit.repo_id.id)].id,
+                    } for commit in commits])
+                    for commit in commits:
+                        heads[(bundle.id, commit.repo_id.id)].head = commit
+                    pending = batch.state == 'ready'
+                    slots = []
+                    builds_values = []
+                    for trigger in triggers:
+                        trigger_repos = trigger.repo_ids | trigger.dependency_ids
+                        params = self.env['runbot.build.params'].create({
+                            'version_id': bundle.version_id.id,
+                            'project_id': project.id,
+                            'trigger_id': trigger.id,
+                            'config_id': trigger.config_id.id,
+                            'create_batch_id': batch.id,
+                            'commit_link_ids': [(6, 0, batch.commit_link_ids.filtered(lambda link: link.commit_id.repo_id in trigger_repos).ids)],
+                        })
+                        slots.append({'batch_id': batch.id, 'trigger_id': trigger.id, 'params_id': params.id, 'link_type': 'created'})
+                        start = batch.last_update + timedelta(minutes=rand.randint(1, 30))
+                        builds_values.append({
+                            'params_id': params.id,
+                            'local_state': 'pending' if pending else 'done',
+                            'local_result': False if pending else rand.choices(['ok', 'ko', 'warn'], [65, 30, 5])[0],
+                            'build_start': False if pending else start,
+                            'build_end': False if pending else start + timedelta(minutes=rand.randint(5, 90)),
+                        })
+                    builds = self.env['runbot.build'].create(builds_values)
+                    self.env['runbot.batch.slot'].create([dict(slot, build_id=build.id) for slot, build in zip(slots, builds)])
+                    if not pending:
+                        done_builds |= builds
+                bundle.last_batch = batches[-1]
+
+            self.env['base'].flush()
+            self._populate_scale_logs(done_builds, nb_logs, rand)
+            self._populate_scale_stats(done_builds, nb_stats, stat_category, step_ids, rand)
+            self.env.cache.invalidate()
+            _logger.info('Populated %s/%s bundles', len(bundles), nb_bundles)
+        return bundles
+
+    def _populate_scale_logs(self, builds, nb_logs, rand):
+        rows = []
+        for build in builds:
+            failing = build.local_result == 'ko'
+            for index in range(nb_logs):
+                if failing and index % 5 == 4:
+                    module = rand.choice(SCALE_MODULES)
+                    message = rand.choice(SCALE_ERRORS) % (module, rand.randint(1, 3))
+                    rows.append((build.id, 'server', 'ERROR', f'odoo.addons.{module}', message, 'model.py', '_compute', '42'))
+                else:
+                    rows.append((build.id, 'runbot', 'INFO', 'odoo.runbot', f'Step {index} finished', 'runbot', f'step_{index}', '0'))
+        if rows:
+            execute_values(self.env.cr._obj, """
+                INSERT INTO ir_logging (create_date, build_id, type, level, name, message, path, func, line)
+                VALUES %s
+            """, rows, template="(now() at time zone 'UTC', %s, %s, %s, %s, %s, %s, %s, %s)", page_size=1000)
+
+    def _populate_scale_stats(self, builds, nb_stats, stat_category, step_ids, rand):
+        modules = [SCALE_MODULES[index] if index < len(SCALE_MODULES) else f'module_{index}' for index in range(nb_stats)]
+        rows = [
+            (build.id, step_ids.get(build.params_id.trigger_id.id), f'{stat_category}.{module}', rand.uniform(1, 500))
+            for build in builds
+            for module in modules
+        ]
+        if rows:
+            execute_values(self.env.cr._obj, """
+                INSERT INTO runbot_build_stat (build_id, config_step_id, key, value)
+                VALUES %s
+            """, rows, page_size=1000)
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+
+from contextlib import contextmanager
+from unittest.mock import patch
+
+from odoo.addons.runbot.tests.common import RunbotCase
+from odoo.tests.common import HttpCase, tagged
+from odoo.tools import mute_logger
+
+from ..models.runbot import demo_git
+
+_logger = logging.getLogger(__name__)
+
+
+@tagged('-standard', '-at_install', 'post_install', 'runbot_benchmark')
+class TestScale(RunbotCase, HttpCase):
+    """
+    Benchmark of the hot paths of runbot on production shaped data, not run by default:
+
+        odoo-bin -i runbot_populate --test-tags runbot_benchmark
+
+    The data size is multiplied by the RUNBOT_BENCHMARK_SCALE environment variable (default 1).
+    The query count and wall-clock time of each benchmark are logged and written as json
+    in RUNBOT_BENCHMARK_OUTPUT if defined. If RUNBOT_BENCHMARK_BASELINE points to such a
+    json file, the benchmark fails when a query count grows by more than 10% or when a
+    duration more than doubles compared to the baseline.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.scale = int(os.environ.get('RUNBOT_BENCHMARK_SCALE', 1))
+        self.results = {}
+        self.workdir = tempfile.mkdtemp(prefix='runbot_benchmark_')
+        self.start_patcher('repo_root_patcher', 'odoo.addons.runbot.models.runbot.Runbot._root', self.workdir)
+        self.env['ir.config_parameter'].set_param('runbot.runbot_workers', 8)
+        self.env['runbot.host']._get_current().nb_worker = 8
+
+        with mute_logger('odoo.addons.runbot.models.build', 'odoo.addons.runbot.models.batch', 'odoo.addons.runbot.models.branch'):
+            self.bundles = self.env['runbot.runbot']._populate_scale(
+                self.project,
+                nb_bundles=100 * self.scale,
+                nb_batches=5,
+                nb_logs=50,
+                nb_stats=20,
+            )
+
+    @contextmanager
+    def benchmark(self, name):
+        self.env['base'].flush()
+        self.env.cache.invalidate()
+        query_count = self.cr.sql_log_count
+        start = time.time()
+        yield
+        self.env['base'].flush()
+        self.results[name] = {'queries': self.cr.sql_log_count - query_count, 'duration': time.time() - start}
+        _logger.info('Benchmark %s: %s queries in %.3fs', name, self.results[name]['queries'], self.results[name]['duration'])
+
+    def check_results(self):
+        if os.environ.get('RUNBOT_BENCHMARK_OUTPUT'):
+            with open(os.environ['RUNBOT_BENCHMARK_OUTPUT'], 'w') as output:
+                json.dump({'scale': self.scale, 'results': self.results}, output, indent=2)
+        if os.environ.get('RUNBOT_BENCHMARK_BASELINE'):
+            with open(os.environ['RUNBOT_BENCHMARK_BASELINE']) as baseline_file:
+                baseline = json.load(baseline_file)
+            self.assertEqual(baseline['scale'], self.scale, 'Baseline was recorded with another scale')
+            for name, reference in baseline['results'].items():
+                if name not in self.results:
+                    continue
+                with self.subTest(benchmark=name):
+                    self.assertLessEqual(self.results[name]['queries'], reference['queries'] * 1.1 + 5)
+                    self.assertLessEqual(self.results[name]['duration'], reference['duration'] * 2 + 0.5)
+
+    def make_git_remote(self, nb_branches):
+        """ Create a local git repository with a master branch and nb_branches dev branches to fetch from """
+        path = os.path.join(self.workdir, 'remotes', 'bench', 'server')
+        git = ['git', '-C', path, '-c', 'user.name=Bench', '-c', 'user.email=bench@example.com']
+        subprocess.check_output(['git', 'init', '-q', path])
+        subprocess.check_output(git + ['commit', '-q', '--allow-empty', '-m', 'Initial commit'])
+        subprocess.check_output(git + ['branch', '-M', 'master'])
+        for index in range(nb_branches):
+            subprocess.check_output(git + ['checkout', '-q', '-b', f'master-bench-{index}', 'master'])
+            subprocess.check_output(git + ['commit', '-q', '--allow-empty', '-m', f'[IMP] bench: change {index}'])
+        return path
+
+    def test_scale(self):
+        category_id = self.env.ref('runbot.default_category').id
+        bundles = self.bundles.with_context(category_id=category_id)
+
+        with self.benchmark('compute_last_batchs'):
+            bundles.mapped('last_batchs')
+        self.assertLess(self.results['compute_last_batchs']['queries'], len(bundles), 'last_batchs should be computed in batch')
+
+        with self.benchmark('bundles_page'):
+            response = self.url_open(f'/runbot/{self.project.id}')
+        self.assertEqual(response.status_code, 200)
+
+        trigger = self.project.trigger_ids[0]
+        with self.benchmark('stats_json'):
+            response = self.url_open('/runbot/stats/', data=json.dumps({'params': {
+                'bundle_id': bundles[0].id,
+                'trigger_id': trigger.id,
+                'key_category': 'perf',
+            }}), headers={'Content-Type': 'application/json'})
+        self.assertEqual(response.status_code, 200)
+
+        failing_builds = self.Build.search([('id', 'in', bundles.mapped('last_batchs.slot_ids.build_id').ids), ('local_result', '=', 'ko')])
+        with self.benchmark('parse_logs'), mute_logger('odoo.addons.runbot.models.build_error'):
+            failing_builds._parse_logs()
+        self.assertTrue(failing_builds.build_error_ids)
+
+        with self.benchmark('batch_prepare'), patch('odoo.addons.runbot.models.repo.Repo._git', side_effect=demo_git):
+            batch = bundles[0]._force()
+            batch._prepare()
+        self.assertEqual(batch.state, 'ready')
+
+        # only the scheduling overhead is measured, not the build steps themselves
+        host = self.env['runbot.host']._get_current()
+        with self.benchmark('scheduler'), \
+                patch('odoo.addons.runbot.models.build.BuildResult._init_pendings'), \
+                patch('odoo.addons.runbot.models.build.BuildResult._schedule'):
+            self.Runbot._scheduler(host)
+        self.assertEqual(self.Build.search_count([('host', '=', host.name)]), 8)
+
+        # fetch a real local repository, all the git related patchers need to be stopped
+        for patcher_name in ('git_patcher', 'isdir', 'isfile', 'makedirs', 'mkdir', 'getmtime'):
+            self.stop_patcher(patcher_name)
+        self.env['runbot.repo'].search([]).mode = 'disabled'
+        remote_path = self.make_git_remote(20 * self.scale)
+        repo = self.Repo.create({'name': 'bench', 'project_id': self.project.id, 'mode': 'poll'})
+        self.Remote.create({'name': remote_path, 'repo_id': repo.id})
+        with self.benchmark('fetch_loop_turn'):
+            self.Runbot._fetch_loop_turn(host, {})
+        self.assertFalse(host.last_exception)
+        self.assertEqual(self.env['runbot.branch'].search_count([('remote_id.repo_id', '=', repo.id)]), 20 * self.scale + 1)
+
+        self.check_results()